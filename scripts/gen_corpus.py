@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Synthetic notification corpus generator for scale testing.
+
+Uses the fixtures under tests/data as templates and streams realistic
+NOTIFY_* contexts, either as an iterator (generate()) or as NDJSON. Memory
+only depends on the host/service cardinality (a few bytes of state per
+object), never on the number of generated notifications.
+
+Usage:
+    scripts/gen_corpus.py --count 1000000 --hosts 5000 --services 40 -o corpus.ndjson
+"""
+import argparse
+import datetime
+import json
+import math
+import random
+import sys
+from array import array
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+DATA_DIR = ROOT / "tests" / "data"
+
+SERVICE_STATES = ["OK", "WARNING", "CRITICAL", "UNKNOWN"]
+HOST_STATES = ["UP", "DOWN", "UNREACHABLE"]
+SERVICE_NAMES = [
+    "CPU load", "CPU utilization", "Memory", "Filesystem /", "Filesystem /var", "Interface eth0",
+    "Check_MK", "Check_MK Discovery", "NTP Time", "Systemd Service Summary", "HTTP", "HTTPS",
+    "TCP Connections", "Disk IO SUMMARY", "Kernel Performance", "Mount options of /", "Uptime",
+    "Postfix Queue", "MySQL Connections", "Number of threads",
+]
+OUTPUT_LINES = {
+    "OK": "OK - all metrics within thresholds, last value %i",
+    "WARNING": "WARN - 85.3%% used (42.65 of 50.00 GB), trend: +0.8 GB / 24 hours (!) %i",
+    "CRITICAL": "CRIT - 98.7%% used (49.35 of 50.00 GB), trend: +1.2 GB / 24 hours (!!) %i",
+    "UNKNOWN": "UNKNOWN - item not found in monitoring data %i",
+    "UP": "Packet received via smart PING, rta %i ms",
+    "DOWN": "CRIT - 10.0.0.32: rta nan, lost 100%% %i",
+    "UNREACHABLE": "CRIT - parent host is down %i",
+}
+
+
+def load_templates(version: Optional[str] = None) -> Dict[str, dict]:
+    """Load the fixtures of a CheckMK version (latest by default) as templates"""
+    if version is None:
+        version = sorted(d.name for d in DATA_DIR.iterdir() if d.is_dir())[-1]
+    templates = {}
+    for path in sorted((DATA_DIR / version).glob("*/*.json")):
+        with open(path, "r") as f:
+            templates["%s/%s" % (path.parent.name, path.stem)] = json.load(f)
+    return templates
+
+
+def parse_weights(text: str) -> Dict[str, float]:
+    """Parse a distribution like "OK=5,WARNING=2,CRITICAL=2,UNKNOWN=1\""""
+    weights = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        weights[name.strip().upper()] = float(weight)
+    return weights
+
+
+def _output(state: str, size: int, rng: random.Random) -> str:
+    """Build a plugin output of about size bytes"""
+    line = OUTPUT_LINES[state] % rng.randint(0, 999)
+    if size <= len(line):
+        return line
+    lines = [line]
+    length = len(line)
+    while length < size:
+        extra = OUTPUT_LINES[state] % rng.randint(0, 999)
+        lines.append(extra)
+        length += len(extra) + 1
+    return "\n".join(lines)
+
+
+def generate(
+    count: int,
+    hosts: int = 1000,
+    services: int = 20,
+    host_ratio: float = 0.1,
+    service_states: Optional[Dict[str, float]] = None,
+    host_states: Optional[Dict[str, float]] = None,
+    flapping: float = 0.02,
+    acknowledgements: float = 0.02,
+    renotifications: float = 0.05,
+    output_median: int = 80,
+    output_sigma: float = 1.0,
+    rate: float = 10.0,
+    start: Optional[datetime.datetime] = None,
+    site: str = "monitoring",
+    version: Optional[str] = None,
+    seed: int = 0,
+) -> Iterator[dict]:
+    """Generate count notifications as NOTIFY_* environment dicts
+
+    Objects move between states according to the state distributions, so
+    every notification reports the correct previous state. A fraction of the
+    notifications are flapping, acknowledgement or repeated problem
+    notifications (with increasing notification numbers). Output sizes
+    follow a log-normal distribution, and notifications arrive as a Poisson
+    process with the given rate per second.
+    """
+    rng = random.Random(seed)
+    templates = load_templates(version)
+    service_states = service_states or {"OK": 4, "WARNING": 3, "CRITICAL": 2, "UNKNOWN": 1}
+    host_states = host_states or {"UP": 6, "DOWN": 3, "UNREACHABLE": 1}
+    now = start or datetime.datetime(2025, 11, 11, 12, 0, 0)
+    # Per object: index of the current state (0 is OK/UP) and notification number
+    host_state = bytearray(hosts)
+    service_state = bytearray(hosts * services)
+    host_number = array("I", bytes(4 * hosts))
+    service_number = array("I", bytes(4 * hosts * services))
+
+    for _ in range(count):
+        now += datetime.timedelta(seconds=rng.expovariate(rate))
+        host = rng.randrange(hosts)
+        is_host = rng.random() < host_ratio
+        if is_host:
+            states, weights, current, number = HOST_STATES, host_states, host_state, host_number
+            index = host
+        else:
+            states, weights, current, number = SERVICE_STATES, service_states, service_state, service_number
+            index = host * services + rng.randrange(services)
+
+        previous = states[current[index]]
+        roll = rng.random()
+        if roll < flapping:
+            notification_type = rng.choice(["FLAPPINGSTART", "FLAPPINGSTOP"])
+            state = previous
+        elif roll < flapping + acknowledgements and previous not in ("OK", "UP"):
+            notification_type = "ACKNOWLEDGEMENT"
+            state = previous
+        elif roll < flapping + acknowledgements + renotifications and previous not in ("OK", "UP"):
+            notification_type = "PROBLEM"
+            state = previous
+            number[index] += 1
+        else:
+            candidates = [s for s in states if s != previous]
+            state = rng.choices(candidates, [weights.get(s, 0) for s in candidates])[0]
+            notification_type = "RECOVERY" if state in ("OK", "UP") else "PROBLEM"
+            current[index] = states.index(state)
+            number[index] = 1 if notification_type == "PROBLEM" else 0
+
+        size = int(rng.lognormvariate(math.log(max(output_median, 1)), output_sigma))
+        output = _output(state, size, rng)
+        service = index % services
+        service_name = SERVICE_NAMES[service] if service < len(SERVICE_NAMES) else "Service %i" % service
+
+        yield _render(
+            templates, is_host, notification_type, "host%05i" % host, service_name,
+            previous, state, output, now, site, number[index], rng,
+        )
+
+
+def _render(templates, is_host, notification_type, hostname, service, previous, state, output,
+            now, site, number, rng) -> dict:
+    """Fill a template for a single notification"""
+    if is_host:
+        name = {"RECOVERY": "recovery_up", "PROBLEM": "unreachable" if state == "UNREACHABLE" else "problem_down"}
+        template = templates.get("host/" + name.get(notification_type, "downtime_start")) \
+            or templates["host/problem_down"]
+    else:
+        name = {"RECOVERY": "recovery_ok", "ACKNOWLEDGEMENT": "acknowledgement",
+                "PROBLEM": "problem_warning" if state == "WARNING" else "problem_critical"}
+        template = templates.get("service/" + name.get(notification_type, "problem_critical")) \
+            or templates["service/problem_critical"]
+
+    env = dict(template)
+    env["NOTIFY_WHAT"] = "HOST" if is_host else "SERVICE"
+    env["NOTIFY_NOTIFICATIONTYPE"] = notification_type
+    env["NOTIFY_OMD_SITE"] = site
+    for key in ("NOTIFY_HOSTNAME", "NOTIFY_HOSTALIAS", "NOTIFY_HOSTFORURL"):
+        env[key] = hostname
+    env["NOTIFY_HOSTURL"] = "/check_mk/index.py?start_url=view.py?view_name%%3Dhoststatus%%26host%%3D%s%%26site%%3D%s" \
+        % (hostname, site)
+    env["NOTIFY_SHORTDATETIME"] = now.strftime("%Y-%m-%d %H:%M:%S")
+    env["NOTIFY_DATE"] = now.strftime("%Y-%m-%d")
+    env["NOTIFY_MICROTIME"] = str(int(now.timestamp() * 1000000))
+    if is_host:
+        for key in ("NOTIFY_HOSTSTATE", "NOTIFY_HOSTSHORTSTATE"):
+            env[key] = state
+        for key in ("NOTIFY_LASTHOSTSTATE", "NOTIFY_PREVIOUSHOSTHARDSTATE", "NOTIFY_PREVIOUSHOSTHARDSHORTSTATE"):
+            if key in env or key == "NOTIFY_PREVIOUSHOSTHARDSTATE":
+                env[key] = previous
+        env["NOTIFY_HOSTOUTPUT"] = output
+        env["NOTIFY_HOSTNOTIFICATIONNUMBER"] = str(number)
+        env["NOTIFY_HOSTPROBLEMID"] = str(rng.randrange(1, 10 ** 6))
+    else:
+        env["NOTIFY_SERVICEDESC"] = service
+        env["NOTIFY_SERVICEFORURL"] = service
+        env["NOTIFY_SERVICEURL"] = (
+            "/check_mk/index.py?start_url=view.py?view_name%%3Dservice%%26host%%3D%s%%26service%%3D%s%%26site%%3D%s"
+            % (hostname, service.replace(" ", "%20"), site)
+        )
+        env["NOTIFY_SERVICESTATE"] = state
+        for key in ("NOTIFY_LASTSERVICESTATE", "NOTIFY_PREVIOUSSERVICEHARDSTATE"):
+            if key in env or key == "NOTIFY_PREVIOUSSERVICEHARDSTATE":
+                env[key] = previous
+        env["NOTIFY_SERVICEOUTPUT"] = output
+        env["NOTIFY_SERVICENOTIFICATIONNUMBER"] = str(number)
+        env["NOTIFY_SERVICEPROBLEMID"] = str(rng.randrange(1, 10 ** 6))
+    return env
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=10000, help="number of notifications")
+    parser.add_argument("--hosts", type=int, default=1000, help="number of distinct hosts")
+    parser.add_argument("--services", type=int, default=20, help="number of services per host")
+    parser.add_argument("--host-ratio", type=float, default=0.1, help="fraction of HOST notifications")
+    parser.add_argument("--service-states", type=parse_weights, help="e.g. OK=4,WARNING=3,CRITICAL=2,UNKNOWN=1")
+    parser.add_argument("--host-states", type=parse_weights, help="e.g. UP=6,DOWN=3,UNREACHABLE=1")
+    parser.add_argument("--flapping", type=float, default=0.02, help="fraction of flapping notifications")
+    parser.add_argument("--acknowledgements", type=float, default=0.02, help="fraction of acknowledgements")
+    parser.add_argument("--renotifications", type=float, default=0.05, help="fraction of repeated problems")
+    parser.add_argument("--output-median", type=int, default=80, help="median output size in bytes")
+    parser.add_argument("--output-sigma", type=float, default=1.0, help="log-normal sigma of output sizes")
+    parser.add_argument("--rate", type=float, default=10.0, help="notifications per second (simulated time)")
+    parser.add_argument("--site", default="monitoring", help="OMD site name")
+    parser.add_argument("--version", help="fixture version used as template (default: latest)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--output", "-o", help="NDJSON output file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        for env in generate(
+            args.count, hosts=args.hosts, services=args.services, host_ratio=args.host_ratio,
+            service_states=args.service_states, host_states=args.host_states, flapping=args.flapping,
+            acknowledgements=args.acknowledgements, renotifications=args.renotifications,
+            output_median=args.output_median,
+            output_sigma=args.output_sigma, rate=args.rate, site=args.site, version=args.version,
+            seed=args.seed,
+        ):
+            out.write(json.dumps(env))
+            out.write("\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+In-process microbenchmarks for the hot functions of cmk_discord.py.
+
+Every function runs over all fixtures under tests/data and over synthetic
+notifications with large outputs. Results are written as JSON with ops/sec,
+the peak number of bytes allocated per call and the noise (how much slower
+the slowest of the repeated runs was than the fastest). With --runs, the
+whole suite runs several times in fresh state and the median is kept; the
+noise then also covers the spread between the runs, which is how baselines
+should be recorded. A comparison allows the threshold plus the larger noise
+of the baseline and the current run, capped at --max-noise so that a noisy
+machine cannot hide real regressions. The "dns" set compares a
+DnsCache hit with a lookup through a stub resolver that takes --dns-latency
+seconds, and reports the latency saved per invocation.
+
+Usage:
+    scripts/microbench.py [--output results.json] [--duration 0.05] [--repeat 5]
+    scripts/microbench.py --runs 5 -o scripts/microbench_baseline.json
+    scripts/microbench.py --compare scripts/microbench_baseline.json [--threshold 0.25] [--max-noise 0.05]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from unittest.mock import patch
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src" / "notifications"))
+
+import cmk_discord  # noqa: E402
+
+
+def load_fixtures() -> dict:
+    """Load every fixture as raw NOTIFY_* environment, keyed by version/path"""
+    fixtures = {}
+    for path in sorted((ROOT / "tests" / "data").glob("*/*/*.json")):
+        with open(path, "r") as f:
+            fixtures[str(path.relative_to(ROOT / "tests" / "data"))] = json.load(f)
+    return fixtures
+
+
+def synthetic_large(fixtures: dict) -> dict:
+    """Build notifications with large outputs and comments from the fixtures"""
+    large = {}
+    for name, env in fixtures.items():
+        if not name.endswith("problem_critical.json") and not name.endswith("problem_down.json"):
+            continue
+        env = dict(env)
+        line = "CRIT - /var/log 98.7%% used (49.35 of 50.00 GB), trend: +1.2 GB / 24 hours (!!) %s\n"
+        output = "".join(line % i for i in range(400))
+        env["NOTIFY_SERVICEOUTPUT" if env.get("NOTIFY_WHAT") == "SERVICE" else "NOTIFY_HOSTOUTPUT"] = output
+        env["NOTIFY_NOTIFICATIONCOMMENT"] = "Escalated by on-call. " * 50
+        large["large/" + name] = env
+    return large
+
+
+def strip_prefix(env: dict) -> dict:
+    """Strip the NOTIFY_ prefix like Context.from_env() does"""
+    return {key[7:]: value for (key, value) in env.items() if key.startswith("NOTIFY_")}
+
+
+# Template reproducing the hard-coded layout, to compare with Embed.to_dict
+LAYOUT_TEMPLATE = {
+    "title": "{{ emoji }} {{ notification_type }}: {{ subject }}",
+    "description": "**{{ previous_state }} -> {{ state }}**\n\n{{ output }}"
+                   "{% if notification_comment %}\n\n{{ notification_comment }}{% endif %}",
+}
+
+
+def prepare(env: dict, template: "cmk_discord.Template") -> dict:
+    """Prepare the callables to benchmark for a single notification"""
+    data = strip_prefix(env)
+    ctx = cmk_discord.Context.from_dict(data)
+    embed = cmk_discord.Embed.from_context(ctx)
+    webhook = cmk_discord.DiscordWebhook(ctx.webhook_url, embed, ctx.omd_site)
+    payload = webhook._build_payload()
+    templated = cmk_discord.Embed.from_context(ctx)
+    templated.template = template
+    state = ctx.service_state if ctx.what == "SERVICE" else ctx.host_state
+    return {
+        "Context.from_dict": lambda: cmk_discord.Context.from_dict(data),
+        "Context.from_env": cmk_discord.Context.from_env,
+        "Embed.from_context": lambda: cmk_discord.Embed.from_context(ctx),
+        "Embed.get_emoji": lambda: cmk_discord.Embed.get_emoji(ctx.notification_type),
+        "Embed.get_alert_color": lambda: cmk_discord.Embed.get_alert_color(state),
+        "Embed.to_dict": embed.to_dict,
+        "Embed.to_dict (template)": templated.to_dict,
+        "DiscordWebhook._build_payload": webhook._build_payload,
+        "json.dumps": lambda: json.dumps(payload),
+    }
+
+
+def time_calls(func, duration: float, repeat: int) -> tuple:
+    """Time func in repeat runs of about duration seconds, return (calls, fastest seconds, slowest seconds)"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration / 2:
+            break
+        number *= 2
+    # The calibration run counts towards the fastest only, it may include warm-up
+    best = elapsed
+    worst = None
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        worst = elapsed if worst is None else max(worst, elapsed)
+    return number, best, best if worst is None else worst
+
+
+def noise(best: float, worst: float) -> float:
+    """Get the relative ops/sec drop from the fastest to the slowest run"""
+    return 1 - best / worst
+
+
+def allocated_per_call(func) -> int:
+    """Measure the peak number of bytes allocated by a single call"""
+    func()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        func()
+        return max(tracemalloc.get_traced_memory()[1] - base, 0)
+    finally:
+        tracemalloc.stop()
+
+
+def run_dns(duration: float, repeat: int, latency: float) -> dict:
+    """Compare a DnsCache hit with a lookup through a slow stub resolver"""
+    address = (2, 1, 6, "", ("162.159.128.233", 443))
+
+    def resolver(host, port):
+        time.sleep(latency)
+        return [address], 300
+
+    with tempfile.TemporaryDirectory() as tmp, patch.dict(os.environ, {"CMK_DISCORD_STATE_DIR": tmp}):
+        cache = cmk_discord.DnsCache(resolver=resolver)
+        cache.resolve("discord.com", 443)
+        functions = {
+            "DnsCache.resolve (hit)": lambda: cache.resolve("discord.com", 443),
+            "resolver (miss)": lambda: resolver("discord.com", 443),
+        }
+        results = {}
+        for name, func in functions.items():
+            calls, seconds, slowest = time_calls(func, duration, repeat)
+            results[name] = {
+                "ops_per_sec": round(calls / seconds, 1),
+                "bytes_allocated_per_call": allocated_per_call(func),
+                "noise": round(noise(seconds, slowest), 3),
+                "cases": 1,
+            }
+    saved = 1000 / results["resolver (miss)"]["ops_per_sec"] - 1000 / results["DnsCache.resolve (hit)"]["ops_per_sec"]
+    sys.stderr.write("DNS cache saves %.2f ms per invocation (stub resolver latency %.0f ms)\n" % (
+        saved, latency * 1000))
+    return results
+
+
+def run(duration: float, repeat: int) -> dict:
+    """Run all benchmarks and aggregate them per function and case set"""
+    fixtures = load_fixtures()
+    case_sets = {"fixtures": fixtures, "large": synthetic_large(fixtures)}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        template_path = os.path.join(tmp, "layout.json")
+        with open(template_path, "w") as f:
+            json.dump(LAYOUT_TEMPLATE, f)
+        with patch.dict(os.environ, {"CMK_DISCORD_STATE_DIR": tmp}):
+            template = cmk_discord.Template.load(template_path)
+
+    for set_name, cases in case_sets.items():
+        for env in cases.values():
+            with patch.dict(os.environ, env, clear=True):
+                for name, func in prepare(env, template).items():
+                    calls, seconds, slowest = time_calls(func, duration, repeat)
+                    allocated = allocated_per_call(func)
+                    entry = results.setdefault(set_name, {}).setdefault(
+                        name, {"calls": 0, "seconds": 0.0, "allocated": 0, "noise": 0.0, "cases": 0}
+                    )
+                    entry["calls"] += calls
+                    entry["seconds"] += seconds
+                    entry["allocated"] += allocated
+                    entry["noise"] += noise(seconds, slowest)
+                    entry["cases"] += 1
+
+    return {
+        set_name: {
+            name: {
+                "ops_per_sec": round(entry["calls"] / entry["seconds"], 1),
+                "bytes_allocated_per_call": entry["allocated"] // entry["cases"],
+                "noise": round(entry["noise"] / entry["cases"], 3),
+                "cases": entry["cases"],
+            }
+            for name, entry in functions.items()
+        }
+        for set_name, functions in results.items()
+    }
+
+
+def merge(runs: list) -> dict:
+    """Merge the results of several runs: median ops/sec, noise including the spread between runs"""
+    merged = {}
+    for set_name, functions in runs[0].items():
+        for name, entry in functions.items():
+            ops = sorted(run[set_name][name]["ops_per_sec"] for run in runs)
+            noises = sorted(run[set_name][name]["noise"] for run in runs)
+            median = ops[len(ops) // 2]
+            merged.setdefault(set_name, {})[name] = dict(
+                entry,
+                ops_per_sec=median,
+                noise=round(max(1 - ops[0] / median, noises[len(noises) // 2]), 3),
+            )
+    return merged
+
+
+def compare(results: dict, baseline: dict, threshold: float, max_noise: float = 0.05) -> list:
+    """Get the benchmarks whose ops/sec dropped more than threshold plus the noise (at most max_noise)"""
+    regressions = []
+    for set_name, functions in baseline.items():
+        for name, expected in functions.items():
+            actual = results.get(set_name, {}).get(name)
+            if actual is None:
+                continue
+            ratio = actual["ops_per_sec"] / expected["ops_per_sec"]
+            allowance = min(max(expected.get("noise", 0.0), actual.get("noise", 0.0)), max_noise)
+            if ratio < 1 - threshold - allowance:
+                regressions.append("%s %s: %.1f ops/sec vs %.1f baseline (%.0f%%)" % (
+                    set_name, name, actual["ops_per_sec"], expected["ops_per_sec"], (ratio - 1) * 100
+                ))
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", "-o", help="write the results to this JSON file (default: stdout)")
+    parser.add_argument("--duration", type=float, default=0.05, help="seconds per run of a function and case")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per function and case (fastest is kept)")
+    parser.add_argument("--runs", type=int, default=1, help="runs of the whole suite (median is kept)")
+    parser.add_argument("--dns-latency", type=float, default=0.02, help="stub resolver latency in seconds")
+    parser.add_argument("--compare", metavar="BASELINE", help="fail on regressions against this results file")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed relative ops/sec drop")
+    parser.add_argument("--max-noise", type=float, default=0.05, help="most measured noise added to the threshold")
+    args = parser.parse_args(argv)
+
+    runs = []
+    for _ in range(max(args.runs, 1)):
+        results = run(args.duration, args.repeat)
+        results["dns"] = run_dns(args.duration, args.repeat, args.dns_latency)
+        runs.append(results)
+    results = merge(runs) if len(runs) > 1 else runs[0]
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            regressions = compare(results, json.load(f), args.threshold, args.max_noise)
+        for line in regressions:
+            sys.stderr.write("Regression: %s\n" % line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
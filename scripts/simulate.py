@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Discrete-event simulator for delivery under alert storms.
+
+Replays a notification trace, recorded (NDJSON of NOTIFY_* dicts, like the
+batch command reads) or synthetic (scripts/gen_corpus.py), in simulated
+time. Routing, rendering and the adaptive Batcher of cmk_discord.py run
+unmodified against a model of Discord: a fixed-window rate limit per
+webhook answered with 429 and Retry-After, log-normal latencies and a
+server error rate. Failed sends are retried like Checkmk does, up to
+--attempts times every --retry-interval seconds.
+
+Reports delivery delay percentiles (event time to acknowledgement), the
+number of requests and 429s, alerts merged into shared messages and alerts
+dropped after the last attempt. Settings come from the "routes" and
+"batching" sections of --config; --no-batching sends one embed per request.
+
+The stages before the batcher (correlation, throttle, dedupe, catch-up and
+failover) keep their state in wall-clock time and are not simulated: every
+alert of the trace is sent, so configs relying on them see more requests
+than in production. Such sections of --config are reported and ignored.
+
+Usage:
+    scripts/simulate.py --trace backlog.ndjson [--config cmk_discord.json]
+    scripts/simulate.py --count 86400 --rate 1 --hosts 2000 [--limit 5 --window 2 --latency 0.2]
+"""
+import argparse
+import heapq
+import itertools
+import json
+import math
+import random
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src" / "notifications"))
+sys.path.insert(0, str(ROOT / "scripts"))
+
+import cmk_discord  # noqa: E402
+from gen_corpus import generate  # noqa: E402
+
+
+class Response:
+    """Response of the simulated Discord"""
+
+    def __init__(self, status_code: int, headers: dict):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = ""
+
+
+class Discord:
+    """Model of Discord: fixed-window rate limit per webhook, log-normal latency and server errors"""
+
+    def __init__(self, limit: int = 5, window: float = 2.0, latency: float = 0.2, sigma: float = 0.5,
+                 error_rate: float = 0.0, seed: int = 0):
+        self.limit = limit
+        self.window = window
+        self.latency = latency
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        # url -> (window start, requests in the window)
+        self.buckets = {}
+        self.throttled = 0
+        self.errors = 0
+
+    def request(self, url: str, now: float) -> tuple:
+        """Answer a request arriving at now, return (latency, response)"""
+        latency = self.rng.lognormvariate(math.log(self.latency), self.sigma)
+        start, count = self.buckets.get(url, (now, 0))
+        if now >= start + self.window:
+            start, count = now, 0
+        reset_after = "%.3f" % (start + self.window - now)
+        if count >= self.limit:
+            self.throttled += 1
+            return latency, Response(429, {"Retry-After": reset_after})
+        self.buckets[url] = (start, count + 1)
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            return latency, Response(502, {})
+        headers = {"X-RateLimit-Remaining": str(self.limit - count - 1), "X-RateLimit-Reset-After": reset_after}
+        return latency, Response(204, headers)
+
+
+def event_time(data: dict) -> float:
+    """Get the event time of a notification in seconds"""
+    if data.get("MICROTIME"):
+        return int(data["MICROTIME"]) / 1000000
+    return time.mktime(time.strptime(data["SHORTDATETIME"], "%Y-%m-%d %H:%M:%S"))
+
+
+def load_trace(path: str):
+    """Read a recorded trace as stripped notification dicts"""
+    return cmk_discord.read_notifications([path])
+
+
+def synthetic_trace(args):
+    """Generate a synthetic trace as stripped notification dicts"""
+    for env in generate(args.count, hosts=args.hosts, rate=args.rate, seed=args.seed):
+        yield {key[7:]: value for (key, value) in env.items()}
+
+
+# Sections of the configuration that the simulation ignores
+UNSIMULATED = ("correlation", "throttle", "dedupe", "catch_up", "failover")
+
+
+class Simulation:
+    """Event loop driving the real routing and batching logic in simulated time"""
+
+    def __init__(self, config: "cmk_discord.Config", discord: Discord, batching: bool = True,
+                 attempts: int = 3, retry_interval: float = 60.0):
+        self.now = 0.0
+        self.config = config
+        self.discord = discord
+        self.attempts = attempts
+        self.retry_interval = retry_interval
+        section = config.section("batching")
+        self.batcher = cmk_discord.Batcher(
+            max_delay=section.get("max_delay", 2.0),
+            target_latency=section.get("target_latency", 0.5),
+            low_budget=section.get("low_budget", 1),
+            max_inflight=section.get("max_inflight", 1),
+            clock=lambda: self.now,
+        )
+        if not batching:
+            self.batcher.MAX_EMBEDS = 1
+            self.batcher.max_delay = 0.0
+        self.events = []
+        self.sequence = itertools.count()
+        self.timer = None
+        self.delays = []
+        self.alerts = 0
+        self.dropped = 0
+        self.merged = 0
+
+    def schedule(self, at: float, kind: str, *payload) -> None:
+        heapq.heappush(self.events, (at, next(self.sequence), kind, payload))
+
+    def submit(self, data: dict, at: float, attempt: int = 1) -> None:
+        """Route and queue a notification like deliver() does"""
+        ctx = cmk_discord.Context.from_dict(data)
+        embed = cmk_discord.Embed.from_context(ctx)
+        for url in self.config.router.route(ctx):
+            self.batcher.add(
+                url, ctx.omd_site, self.config.apply_template(embed, url).to_dict(),
+                lambda sent, response, data=data, at=at, attempt=attempt: self.done(data, at, attempt, sent),
+            )
+
+    def done(self, data: dict, at: float, attempt: int, sent: bool) -> None:
+        if sent:
+            self.delays.append(self.now - at)
+        elif attempt < self.attempts:
+            self.schedule(self.now + self.retry_interval, "retry", data, at, attempt + 1)
+        else:
+            self.dropped += 1
+
+    def dispatch(self) -> None:
+        """Send every message the batcher considers ready, and arm its timer"""
+        while True:
+            message = self.batcher.take()
+            if message is None:
+                break
+            url, site, batch = message
+            if len(batch) > 1:
+                self.merged += len(batch)
+            latency, response = self.discord.request(url, self.now)
+            self.schedule(self.now + latency, "response", message, latency, response)
+        wakeup = self.batcher.wakeup()
+        if wakeup is not None and (self.timer is None or wakeup < self.timer):
+            self.timer = max(wakeup, self.now)
+            self.schedule(self.timer, "timer")
+
+    def run(self, trace) -> None:
+        trace = iter(trace)
+        start = None
+        pending = next(trace, None)
+        while pending is not None or self.events:
+            if pending is not None:
+                at = event_time(pending)
+                start = at if start is None else start
+                if not self.events or at - start <= self.events[0][0]:
+                    self.now = max(self.now, at - start)
+                    self.alerts += 1
+                    self.submit(pending, self.now)
+                    pending = next(trace, None)
+                    self.dispatch()
+                    continue
+            self.now, _, kind, payload = heapq.heappop(self.events)
+            if kind == "response":
+                (url, site, batch), latency, response = payload
+                self.batcher.finish(url, site, batch, response.status_code == 204, latency, response)
+            elif kind == "retry":
+                self.submit(payload[0], payload[1], payload[2])
+            elif kind == "timer":
+                self.timer = None
+            self.dispatch()
+
+    def report(self) -> dict:
+        delays = sorted(self.delays)
+
+        def percentile(p):
+            return round(delays[min(int(len(delays) * p), len(delays) - 1)], 3) if delays else None
+
+        return {
+            "alerts": self.alerts,
+            "delivered": len(delays),
+            "dropped": self.dropped,
+            "merged": self.merged,
+            "requests": self.batcher.requests,
+            "throttled": self.discord.throttled,
+            "server_errors": self.discord.errors,
+            "delay": {"p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99),
+                      "max": round(delays[-1], 3) if delays else None},
+            "simulated_seconds": round(self.now, 1),
+        }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trace", help="NDJSON trace of recorded notifications (default: synthetic)")
+    parser.add_argument("--config", help="cmk_discord.json with the routes and batching settings to simulate")
+    parser.add_argument("--no-batching", action="store_true", help="send one embed per request")
+    parser.add_argument("--count", type=int, default=86400, help="synthetic notifications")
+    parser.add_argument("--rate", type=float, default=1.0, help="synthetic notifications per second")
+    parser.add_argument("--hosts", type=int, default=1000, help="synthetic hosts")
+    parser.add_argument("--limit", type=int, default=5, help="requests per webhook and window")
+    parser.add_argument("--window", type=float, default=2.0, help="rate-limit window in seconds")
+    parser.add_argument("--latency", type=float, default=0.2, help="median latency in seconds")
+    parser.add_argument("--sigma", type=float, default=0.5, help="log-normal sigma of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 5xx answers")
+    parser.add_argument("--attempts", type=int, default=3, help="attempts per notification")
+    parser.add_argument("--retry-interval", type=float, default=60.0, help="seconds between attempts")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args(argv)
+
+    config = cmk_discord.Config.load(args.config) if args.config else cmk_discord.Config({})
+    ignored = [name for name in UNSIMULATED if config.section(name)]
+    if ignored:
+        sys.stderr.write("Not simulated, every alert is sent: %s\n" % ", ".join(ignored))
+    discord = Discord(args.limit, args.window, args.latency, args.sigma, args.error_rate, args.seed)
+    simulation = Simulation(config, discord, batching=not args.no_batching, attempts=args.attempts,
+                            retry_interval=args.retry_interval)
+    start = time.monotonic()
+    simulation.run(load_trace(args.trace) if args.trace else synthetic_trace(args))
+    result = simulation.report()
+    result["wall_seconds"] = round(time.monotonic() - start, 2)
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
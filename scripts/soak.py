@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Soak test for the long-running batch mode.
+
+Streams synthetic notifications (scripts/gen_corpus.py) through BatchSender
+with a stubbed Discord that answers every request, sampling the resident set
+size as it goes. Fails when RSS after warm-up grows more than the tolerance.
+
+Usage:
+    scripts/soak.py [--count 1000000] [--slow 0.0005] [--overflow spill] [--tolerance-mb 16]
+"""
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest.mock import patch
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src" / "notifications"))
+sys.path.insert(0, str(ROOT / "scripts"))
+
+import cmk_discord  # noqa: E402
+from gen_corpus import generate  # noqa: E402
+
+
+class StubResponse:
+    status_code = 204
+    headers = {}
+    text = ""
+
+
+def rss_mb() -> float:
+    """Get the current resident set size in MB"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=1000000, help="number of notifications")
+    parser.add_argument("--hosts", type=int, default=5000, help="number of distinct hosts")
+    parser.add_argument("--slow", type=float, default=0.0, help="seconds the stub Discord takes per request")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent sends")
+    parser.add_argument("--queue-bytes", type=int, default=4 * 1024 * 1024, help="memory budget of the queues")
+    parser.add_argument("--overflow", choices=["block", "spill"], default="block", help="backpressure mode")
+    parser.add_argument("--tolerance-mb", type=float, default=16.0, help="allowed RSS growth after warm-up")
+    args = parser.parse_args(argv)
+
+    def post(**kwargs):
+        if args.slow:
+            time.sleep(args.slow)
+        return StubResponse()
+
+    config = cmk_discord.Config({"memory": {"queue_bytes": args.queue_bytes, "overflow": args.overflow}})
+    sender = cmk_discord.BatchSender(config, concurrency=args.concurrency, rate=0)
+    records = (
+        {key[7:]: value for (key, value) in env.items()}
+        for env in generate(args.count, hosts=args.hosts, rate=1000)
+    )
+
+    samples = []
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(0.5):
+            samples.append((sender.sent, rss_mb()))
+            sys.stderr.write("%10i sent  %7.1f MB RSS\n" % samples[-1])
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.monotonic()
+    # Spilled queues and retries go to a scratch state directory
+    with tempfile.TemporaryDirectory() as tmp, patch.dict(os.environ, {"CMK_DISCORD_STATE_DIR": tmp}), \
+            patch("requests.post", post):
+        sender.run(records)
+    stop.set()
+    sampler.join()
+    elapsed = time.monotonic() - start
+
+    warm = [rss for (sent, rss) in samples if sent >= args.count // 10] or [rss_mb()]
+    growth = max(warm) - warm[0]
+    print("Sent %i notifications in %.1fs (%.0f/s), %i failed" % (
+        sender.sent, elapsed, sender.sent / elapsed, sender.failed))
+    print("RSS after warm-up: %.1f MB, max %.1f MB, growth %.1f MB" % (warm[0], max(warm), growth))
+    return 1 if growth > args.tolerance_mb or sender.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
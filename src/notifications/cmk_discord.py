@@ -6,13 +6,34 @@
 # Release date: DEVELOPMENT-SNAPSHOT
 
 import os
+import re
 import sys
+import json
+import math
+import time
+import fcntl
+import signal
+import socket
+import random
+import marshal
+import hashlib
+import itertools
 import datetime
+import threading
+import zlib
+from array import array
+from collections import deque
+from contextlib import nullcontext
 import requests
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass, fields as dataclass_fields, replace
 from enum import IntEnum, Enum
 from http import HTTPStatus
-from typing import Optional
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    """Intern a repeated identifier"""
+    return sys.intern(value) if value else value
 
 
 @dataclass
@@ -47,56 +68,104 @@ class Context:
     # Optional comment
     notification_comment: Optional[str] = None
 
+    # Routing attributes
+    host_tags: Optional[str] = None        # HOSTTAGS, space separated
+    host_labels: Optional[dict] = None     # HOSTLABEL_*
+    contact_groups: Optional[str] = None   # SERVICECONTACTGROUPNAMES or HOSTCONTACTGROUPNAMES
+
+    # Problem identifier (SERVICEPROBLEMID or HOSTPROBLEMID)
+    problem_id: Optional[str] = None
+    # Renotification counter (SERVICENOTIFICATIONNUMBER or HOSTNOTIFICATIONNUMBER)
+    notification_number: Optional[str] = None
+
+    # Event time in microseconds since the epoch
+    microtime: Optional[str] = None
+
+    # Identifiers interned by from_dict() and from_fields()
+    INTERNED = frozenset(("what", "notification_type", "omd_site", "hostname", "webhook_url", "site_url",
+                          "service_desc", "service_state", "previous_service_state", "service_check_command",
+                          "host_state", "previous_host_state", "host_check_command"))
+
+    @classmethod
+    def from_fields(cls, data: dict) -> "Context":
+        """Create Context from its fields, as forwarded or persisted in JSON"""
+        return cls(**{name: _intern(value) if name in cls.INTERNED else value for (name, value) in data.items()})
+
     @classmethod
     def from_dict(cls, data: dict) -> "Context":
-        """Create Context from environment variable dictionary"""
+        """Create Context from environment variable dictionary
+
+        Identifiers that repeat across notifications (names, states, check
+        commands, webhook urls) are interned, so long-running modes keep a
+        single copy of each.
+        """
         return cls(
-            what=data.get("WHAT", ""),
-            notification_type=data.get("NOTIFICATIONTYPE", ""),
+            what=_intern(data.get("WHAT", "")),
+            notification_type=_intern(data.get("NOTIFICATIONTYPE", "")),
             short_datetime=data.get("SHORTDATETIME", ""),
-            omd_site=data.get("OMD_SITE", ""),
-            hostname=data.get("HOSTNAME", ""),
-            webhook_url=data.get("PARAMETER_1"),
-            site_url=data.get("PARAMETER_2"),
-            service_desc=data.get("SERVICEDESC"),
-            service_state=data.get("SERVICESTATE"),
-            previous_service_state=data.get("LASTSERVICESTATE") or data.get("PREVIOUSSERVICEHARDSTATE"),
+            omd_site=_intern(data.get("OMD_SITE", "")),
+            hostname=_intern(data.get("HOSTNAME", "")),
+            webhook_url=_intern(data.get("PARAMETER_1")),
+            site_url=_intern(data.get("PARAMETER_2")),
+            service_desc=_intern(data.get("SERVICEDESC")),
+            service_state=_intern(data.get("SERVICESTATE")),
+            previous_service_state=_intern(data.get("LASTSERVICESTATE") or data.get("PREVIOUSSERVICEHARDSTATE")),
             service_output=data.get("SERVICEOUTPUT"),
-            service_check_command=data.get("SERVICECHECKCOMMAND"),
+            service_check_command=_intern(data.get("SERVICECHECKCOMMAND")),
             service_url=data.get("SERVICEURL"),
-            host_state=data.get("HOSTSTATE"),
-            previous_host_state=data.get("LASTHOSTSTATE") or data.get("PREVIOUSHOSTHARDSTATE"),
+            host_state=_intern(data.get("HOSTSTATE")),
+            previous_host_state=_intern(data.get("LASTHOSTSTATE") or data.get("PREVIOUSHOSTHARDSTATE")),
             host_output=data.get("HOSTOUTPUT"),
-            host_check_command=data.get("HOSTCHECKCOMMAND"),
+            host_check_command=_intern(data.get("HOSTCHECKCOMMAND")),
             host_url=data.get("HOSTURL"),
             notification_comment=data.get("NOTIFICATIONCOMMENT"),
+            host_tags=data.get("HOSTTAGS"),
+            host_labels={key[10:]: value for (key, value) in data.items() if key.startswith("HOSTLABEL_")},
+            contact_groups=data.get("SERVICECONTACTGROUPNAMES") or data.get("HOSTCONTACTGROUPNAMES"),
+            problem_id=data.get("SERVICEPROBLEMID") if data.get("WHAT") == "SERVICE" else data.get("HOSTPROBLEMID"),
+            notification_number=data.get("SERVICENOTIFICATIONNUMBER") if data.get("WHAT") == "SERVICE"
+            else data.get("HOSTNOTIFICATIONNUMBER"),
+            microtime=data.get("MICROTIME"),
         )
 
     @classmethod
-    def from_env(cls) -> "Context":
-        """Create Context from environment variables (NOTIFY_* variables)"""
+    def from_env(cls, recorder: Optional["Recorder"] = None) -> "Context":
+        """Create Context from environment variables (NOTIFY_* variables), recording it if a recorder is given"""
         env_dict = {
             var[7:]: value
             for (var, value) in os.environ.items()
             if var.startswith("NOTIFY_")
         }
+        if recorder is not None:
+            recorder.record(env_dict)
         return cls.from_dict(env_dict)
 
-    def validate(self) -> None:
-        """Validate the context and raise SystemExit if invalid"""
+    def estimate_size(self) -> int:
+        """Estimate the memory held by this context (and an embed of it) in bytes"""
+        size = 1024
+        for value in (self.service_output, self.host_output, self.notification_comment,
+                      self.service_url, self.host_url, self.host_tags, self.short_datetime):
+            if value:
+                size += len(value) + 49
+        for (name, value) in (self.host_labels or {}).items():
+            size += len(name) + len(value) + 200
+        return size
+
+    def problem(self) -> Optional[str]:
+        """Get why the context is invalid, None when it is valid"""
         if not self.webhook_url:
-            sys.stderr.write("Empty webhook url given as parameter 1")
-            sys.exit(2)
-        if not self.webhook_url.startswith("https://discord.com"):
-            sys.stderr.write(
-                "Invalid Discord webhook url given as first parameter (not starting with https://discord.com )"
-            )
-            sys.exit(2)
+            return "Empty webhook url given as parameter 1"
+        if not self.webhook_url.startswith("https://discord.com/"):
+            return "Invalid Discord webhook url given as first parameter (not starting with https://discord.com )"
         if self.site_url and not self.site_url.startswith("http"):
-            sys.stderr.write(
-                "Invalid site url given as second parameter (not starting with http): %s"
-                % self.site_url
-            )
+            return "Invalid site url given as second parameter (not starting with http): %s" % self.site_url
+        return None
+
+    def validate(self) -> None:
+        """Validate the context and raise SystemExit if invalid"""
+        problem = self.problem()
+        if problem is not None:
+            sys.stderr.write(problem)
             sys.exit(2)
 
 
@@ -129,6 +198,7 @@ class NotificationEmoji(str, Enum):
     DOWNTIMESTART = ":alarm_clock:"
     DOWNTIMEEND = ":white_check_mark:"
     DOWNTIMECANCELLED = ":ballot_box_with_check:"
+    CATCHUP = ":clipboard:"
 
 
 @dataclass
@@ -145,6 +215,8 @@ class Embed:
     footer_text: Optional[str]
     url_path: str
     fields: Optional[list] = None
+    notes: Optional[list] = None          # fields added by processing stages, kept with any template
+    template: Optional["Template"] = None
 
     @staticmethod
     def get_alert_color(state: str) -> int:
@@ -175,7 +247,10 @@ class Embed:
     @classmethod
     def from_context(cls, ctx: Context) -> "Embed":
         """Factory method to create the appropriate embed type based on context"""
-        timestamp = str(datetime.datetime.fromisoformat(ctx.short_datetime).astimezone())
+        if ctx.microtime:
+            timestamp = str(datetime.datetime.fromtimestamp(int(ctx.microtime) / 1000000).astimezone())
+        else:
+            timestamp = str(datetime.datetime.fromisoformat(ctx.short_datetime).astimezone())
         embed_class = ServiceEmbed if ctx.what == "SERVICE" else HostEmbed
         return embed_class(ctx, timestamp)
 
@@ -200,6 +275,9 @@ class Embed:
 
     def to_dict(self) -> dict:
         """Convert embed to dictionary format for Discord API"""
+        if self.template is not None:
+            return self.template.render(self.ctx, self)
+
         embed = {
             "title": self._build_title(),
             "description": self._build_description(),
@@ -212,8 +290,8 @@ class Embed:
             embed["footer"] = {"text": self.footer_text}
 
         # Add fields if available
-        if self.fields:
-            embed["fields"] = self.fields
+        if self.fields or self.notes:
+            embed["fields"] = (self.fields or []) + (self.notes or [])
 
         # Add URL if site_url is configured
         if self.ctx.site_url:
@@ -222,6 +300,222 @@ class Embed:
         return embed
 
 
+
+class Template:
+    """Embed layout from a JSON template file, compiled to a Python function
+
+    The file may set "title", "description", "footer" and "fields" (a list of
+    {"name", "value", "inline"}). Strings use {{ name | filter }} for Context
+    attributes or the embed values emoji, state, previous_state, output and
+    subject, and {% if name %}...{% else %}...{% endif %} blocks. Filters are
+    upper, lower, title, truncate(n) and default("text"). Fields with an
+    empty value are left out.
+
+    Templates are compiled on first use and cached by path and mtime, in
+    memory and as marshalled bytecode in the state directory. The bytecode is
+    keyed by COMPILER_VERSION too; bump it whenever compile_source() changes
+    the generated code. Without a usable state directory templates are
+    compiled in memory only.
+    """
+
+    COMPILER_VERSION = 1
+
+    EMBED_NAMES = {
+        "emoji": "_emoji(ctx.notification_type)",
+        "state": "embed.current_state",
+        "previous_state": "embed.previous_state",
+        "output": "embed.output",
+        "subject": "embed.title_subject",
+    }
+    STR_NAMES = {field.name for field in dataclass_fields(Context) if field.type in (str, Optional[str])}
+    TOKEN = re.compile(r"(\{\{.*?\}\}|\{%.*?%\})", re.S)
+    FILTER = re.compile(r"^(\w+)(?:\((.*)\))?$", re.S)
+
+    _cache: Dict[str, tuple] = {}
+
+    def __init__(self, render: Callable):
+        self.render = render
+
+    @classmethod
+    def load(cls, path: str) -> "Template":
+        """Load a template, compiling it only when the file changed"""
+        path = os.path.expanduser(path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError as e:
+            sys.stderr.write("Invalid template %s: %s" % (path, e))
+            sys.exit(2)
+        cached = cls._cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        import importlib.util
+
+        digest = hashlib.sha1(("%i:%s:%i" % (cls.COMPILER_VERSION, path, mtime)).encode()).hexdigest()
+        try:
+            bytecode_path = os.path.join(get_state_dir("templates"), digest + ".bin")
+        except OSError:
+            bytecode_path = None
+        code = None
+        try:
+            if bytecode_path:
+                with open(bytecode_path, "rb") as f:
+                    if f.read(len(importlib.util.MAGIC_NUMBER)) == importlib.util.MAGIC_NUMBER:
+                        code = marshal.loads(f.read())
+        except (OSError, ValueError, EOFError):
+            code = None
+        if code is None:
+            try:
+                with open(path, "r") as f:
+                    spec = json.load(f)
+                code = compile(cls.compile_source(spec), path, "exec")
+            except (OSError, ValueError, SyntaxError) as e:
+                sys.stderr.write("Invalid template %s: %s" % (path, e))
+                sys.exit(2)
+            if bytecode_path:
+                tmp_path = "%s.%i.tmp" % (bytecode_path, os.getpid())
+                try:
+                    with open(tmp_path, "wb") as f:
+                        f.write(importlib.util.MAGIC_NUMBER + marshal.dumps(code))
+                    os.replace(tmp_path, bytecode_path)
+                except OSError:
+                    # The compiled code is still used from memory
+                    try:
+                        os.unlink(tmp_path)
+                    except OSError:
+                        pass
+
+        namespace = {
+            "_s": _template_str,
+            "_emoji": Embed.get_emoji,
+            "_f_upper": lambda value: value.upper(),
+            "_f_lower": lambda value: value.lower(),
+            "_f_title": lambda value: value.title(),
+            "_f_truncate": lambda value, length: value if len(value) <= length else value[:length - 3] + "...",
+            "_f_default": lambda value, default: value or default,
+        }
+        exec(code, namespace)
+        template = cls(namespace["render"])
+        cls._cache[path] = (mtime, template)
+        return template
+
+    @classmethod
+    def compile_source(cls, spec: dict) -> str:
+        """Translate a template specification to the source of render(ctx, embed)
+
+        The generated function builds the complete embed dictionary like
+        Embed.to_dict, using the hard-coded parts the template does not set.
+        """
+        title = cls._compile_text(spec["title"]) if "title" in spec else "embed._build_title()"
+        description = (
+            cls._compile_text(spec["description"]) if "description" in spec else "embed._build_description()"
+        )
+        footer = cls._compile_text(spec["footer"]) if "footer" in spec else "embed.footer_text"
+        if "fields" not in spec:
+            fields = "embed.fields"
+        elif not spec["fields"]:
+            fields = "None"
+        else:
+            fields = "[field for field in (%s,) if field['value']]" % ", ".join(
+                "{'name': %s, 'value': %s, 'inline': %r}" % (
+                    cls._compile_text(field.get("name", "")),
+                    cls._compile_text(field.get("value", "")),
+                    bool(field.get("inline", False)),
+                )
+                for field in spec["fields"]
+            )
+        return "\n".join([
+            "def render(ctx, embed):",
+            "    result = {'title': %s, 'description': %s, 'color': embed.color, 'timestamp': embed.timestamp}"
+            % (title, description),
+            "    footer = %s" % footer,
+            "    if footer:",
+            "        result['footer'] = {'text': footer}",
+            "    fields = %s" % fields,
+            "    if fields or embed.notes:",
+            "        result['fields'] = (fields or []) + (embed.notes or [])",
+            "    if ctx.site_url:",
+            "        result['url'] = ctx.site_url + embed.url_path",
+            "    return result",
+            "",
+        ])
+
+    @classmethod
+    def _compile_text(cls, text: str) -> str:
+        """Translate a template string to a Python expression"""
+        stack = [[]]          # expressions of the open blocks
+        conditions = []       # (condition, then-expressions or None) of the open if blocks
+        for token in cls.TOKEN.split(text):
+            if token.startswith("{{") and token.endswith("}}"):
+                stack[-1].append(cls._compile_expression(token[2:-2]))
+            elif token.startswith("{%") and token.endswith("%}"):
+                words = token[2:-2].split()
+                if len(words) == 2 and words[0] == "if":
+                    conditions.append([cls._compile_name(words[1]), None])
+                    stack.append([])
+                elif words == ["else"] and conditions and conditions[-1][1] is None:
+                    conditions[-1][1] = stack.pop()
+                    stack.append([])
+                elif words == ["endif"] and conditions:
+                    condition, then = conditions.pop()
+                    otherwise = stack.pop()
+                    if then is None:
+                        then, otherwise = otherwise, []
+                    stack[-1].append("(%s if %s else %s)" % (
+                        cls._join(then), condition, cls._join(otherwise)))
+                else:
+                    raise SyntaxError("Invalid template block %r" % token)
+            elif token:
+                stack[-1].append(repr(token))
+        if conditions:
+            raise SyntaxError("Missing {%% endif %%} in %r" % text)
+        return cls._join(stack[0])
+
+    @staticmethod
+    def _join(expressions: List[str]) -> str:
+        if not expressions:
+            return "''"
+        if len(expressions) == 1:
+            return expressions[0]
+        return "(%s)" % " + ".join(expressions)
+
+    @classmethod
+    def _compile_name(cls, name: str) -> str:
+        """Translate a name to the expression of its value"""
+        if name in cls.EMBED_NAMES:
+            return cls.EMBED_NAMES[name]
+        if name in {field.name for field in dataclass_fields(Context)}:
+            return "ctx." + name
+        raise SyntaxError("Unknown template name %r" % name)
+
+    @classmethod
+    def _compile_expression(cls, expression: str) -> str:
+        """Translate "name | filter(args) | ..." to a Python expression"""
+        import ast
+
+        name, *filters = [part.strip() for part in expression.split("|")]
+        if name in cls.STR_NAMES or name in cls.EMBED_NAMES:
+            code = "(%s or '')" % cls._compile_name(name)
+        else:
+            code = "_s(%s)" % cls._compile_name(name)
+        for item in filters:
+            match = cls.FILTER.match(item)
+            if match is None or match.group(1) not in ("upper", "lower", "title", "truncate", "default"):
+                raise SyntaxError("Invalid template filter %r" % item)
+            args = match.group(2)
+            if args:
+                args = ast.literal_eval("(%s,)" % args)
+                code = "_f_%s(%s, %s)" % (match.group(1), code, ", ".join(repr(arg) for arg in args))
+            else:
+                code = "_f_%s(%s)" % (match.group(1), code)
+        return code
+
+
+def _template_str(value) -> str:
+    """Render a template value (nothing for missing values)"""
+    return "" if value is None else str(value)
+
+
 class ServiceEmbed(Embed):
     """Discord embed for service notifications"""
 
@@ -264,43 +558,3009 @@ class DiscordWebhook:
     """Discord webhook for sending CheckMK notifications"""
 
     AVATAR_URL = "https://checkmk.com/android-chrome-192x192.png"
+    # Shared requests.Session of resident processes, keeping connections open
+    session = None
+    # Seconds to wait for Discord to connect and to answer ("timeout" in the configuration)
+    timeout = 10.0
 
-    def __init__(self, url: str, embed: Embed, site_name: str):
+    @classmethod
+    def configure(cls, config: "Config") -> None:
+        """Apply the webhook settings of the configuration"""
+        cls.timeout = config.data.get("timeout", 10.0)
+
+    def __init__(self, url: str, embed: Optional[Embed], site_name: str, embeds: Optional[List[dict]] = None):
         self.url = url
         self.embed = embed
         self.site_name = site_name
+        self.embeds = embeds
+        self.response = None
 
     def _build_payload(self) -> dict:
         """Build the complete webhook payload"""
         return {
             "username": "Checkmk - " + self.site_name,
             "avatar_url": self.AVATAR_URL,
-            "embeds": [self.embed.to_dict()],
+            "embeds": self.embeds if self.embeds is not None else [self.embed.to_dict()],
         }
 
-    def send(self) -> None:
-        """Send the webhook to Discord"""
-        response = requests.post(url=self.url, json=self._build_payload())
-        if response.status_code != HTTPStatus.NO_CONTENT.value:
+    def _check(self, response, expected: HTTPStatus) -> None:
+        """Exit when Discord did not answer with the expected status"""
+        self.response = response
+        if response.status_code != expected.value:
             sys.stderr.write(
                 "Unexpected response when calling webhook url %s: %i. Response body: %s"
                 % (self.url, response.status_code, response.text)
             )
             sys.exit(1)
 
+    def send(self, wait: bool = False) -> Optional[dict]:
+        """Send the webhook to Discord, returning the created message when waiting for it"""
+        if wait:
+            response = (self.session or requests).post(url=self.url, params={"wait": "true"},
+                                                       json=self._build_payload(), timeout=self.timeout)
+            self._check(response, HTTPStatus.OK)
+            return response.json()
+        response = (self.session or requests).post(url=self.url, json=self._build_payload(), timeout=self.timeout)
+        self._check(response, HTTPStatus.NO_CONTENT)
+        return None
+
+    def edit(self, message_id: str) -> None:
+        """Replace the embeds of a message previously sent through this webhook"""
+        response = (self.session or requests).patch(
+            url="%s/messages/%s" % (self.url, message_id),
+            json={"embeds": self._build_payload()["embeds"]},
+            timeout=self.timeout,
+        )
+        self._check(response, HTTPStatus.OK)
+
+
+class PrefixIndex:
+    """Rules indexed by the literal prefix of patterns matched at the start of a value
+
+    A lookup costs one dict access per distinct prefix length, however many
+    rules there are. Rules with a pattern without a literal prefix are
+    combined into a single pattern that rejects non-matching values with one
+    search.
+    """
+
+    def __init__(self):
+        self.by_prefix: Dict[str, List[int]] = {}
+        self.lengths: List[int] = []
+        self.fallback: List[int] = []
+        self.patterns: List[str] = []
+        self.any_pattern = None
+
+    def state(self) -> tuple:
+        """Get the index as plain data, see Router.state()"""
+        return self.by_prefix, self.lengths, self.fallback, self.patterns
+
+    @classmethod
+    def from_state(cls, state: tuple) -> "PrefixIndex":
+        index = cls()
+        index.by_prefix, index.lengths, index.fallback, index.patterns = state
+        return index
+
+    @staticmethod
+    def literal_prefix(pattern: str) -> str:
+        """Get the literal text every match of a pattern starts with (empty when unknown)"""
+        if "|" in pattern:
+            return ""
+        prefix = ""
+        for char in pattern:
+            if char in ".^$*+?{}[]()\\":
+                # A quantifier makes the previous character optional
+                return prefix[:-1] if char in "*?{" else prefix
+            prefix += char
+        return prefix
+
+    def add(self, index: int, patterns: List[str]) -> None:
+        """Index a rule matching when any of its patterns matches"""
+        prefixes = [self.literal_prefix(pattern) for pattern in patterns]
+        if all(prefixes):
+            for prefix in set(prefixes):
+                self.by_prefix.setdefault(prefix, []).append(index)
+        else:
+            self.fallback.append(index)
+            self.patterns.extend(patterns)
+
+    def compile(self) -> None:
+        self.lengths = sorted({len(prefix) for prefix in self.by_prefix})
+        self._any_pattern()
+
+    def _any_pattern(self):
+        """Get the combined pattern of the rules without a literal prefix, compiling it on first use"""
+        if self.any_pattern is None and self.patterns:
+            self.any_pattern = re.compile("|".join("(?:%s)" % p for p in self.patterns))
+        return self.any_pattern
+
+    def lookup(self, value: str) -> List[int]:
+        """Get the indices of the rules that may match a value"""
+        candidates = []
+        for length in self.lengths:
+            if length > len(value):
+                break
+            candidates.extend(self.by_prefix.get(value[:length], ()))
+        if self.patterns and self._any_pattern().match(value):
+            candidates.extend(self.fallback)
+        return candidates
+
+
+class Router:
+    """Compiled set of routing rules mapping notifications to webhooks
+
+    Every set-like condition (host tags, host labels and contact groups) is
+    assigned a bit in a shared vocabulary, so a rule matches those conditions
+    when its mask is contained in the mask of the notification. Each rule is
+    indexed once, by its most selective condition: exact hostnames, the
+    longer literal prefix of its hostname or service patterns, or else the
+    lowest bit of its mask. Only the rules found through the index are evaluated.
+
+    Regexes are kept as text and compiled on first use, so a router loaded
+    from its persisted state (see load()) only compiles the regexes that the
+    notification needs.
+    """
+
+    COMPILER_VERSION = 1
+    STATE = ("bits", "rules", "by_hostname", "by_bit", "templates")
+
+    def __init__(self, rules: List[dict]):
+        self.bits: Dict[str, int] = {}
+        self.rules = []
+        self.regexes: Dict[str, "re.Pattern"] = {}
+        self.by_hostname: Dict[str, List[int]] = {}
+        self.by_host_pattern = PrefixIndex()
+        self.by_service = PrefixIndex()
+        self.by_bit: Dict[int, List[int]] = {}
+        self.templates: Dict[str, str] = {}
+        for index, rule in enumerate(rules):
+            self.rules.append(self._compile_rule(rule))
+            if rule.get("template"):
+                for url in rule.get("webhooks") or []:
+                    self.templates.setdefault(url, rule["template"])
+            hostnames = self._list(rule.get("hostname"))
+            host_patterns = [self._hostname_pattern(name) for name in hostnames]
+            services = self._list(rule.get("service"))
+            mask = self.rules[index][0]
+            # The shortest literal prefix of each pattern list, 0 when one pattern has none
+            host_prefix = min(map(len, map(PrefixIndex.literal_prefix, host_patterns)), default=0)
+            service_prefix = min(map(len, map(PrefixIndex.literal_prefix, services)), default=0)
+            if hostnames and not any(name.startswith("~") for name in hostnames):
+                for name in hostnames:
+                    self.by_hostname.setdefault(name, []).append(index)
+            elif host_prefix and host_prefix >= service_prefix:
+                self.by_host_pattern.add(index, host_patterns)
+            elif service_prefix:
+                self.by_service.add(index, services)
+            elif mask:
+                self.by_bit.setdefault(mask & -mask, []).append(index)
+            elif hostnames:
+                self.by_host_pattern.add(index, host_patterns)
+            elif services:
+                self.by_service.add(index, services)
+            else:
+                self.by_bit.setdefault(0, []).append(index)
+        self.by_host_pattern.compile()
+        self.by_service.compile()
+
+    @classmethod
+    def load(cls, rules: List[dict], path: Optional[str] = None, mtime: Optional[int] = None) -> "Router":
+        """Compile the rules of a configuration file, reusing the state persisted for this path and mtime
+
+        Without a path or a usable state directory the rules are compiled in
+        memory only.
+        """
+        if not rules or path is None or mtime is None:
+            return cls(rules)
+        digest = hashlib.sha1(("%i:%s:%i" % (cls.COMPILER_VERSION, path, mtime)).encode()).hexdigest()
+        try:
+            state_path = os.path.join(get_state_dir("routers"), digest + ".bin")
+        except OSError:
+            return cls(rules)
+        try:
+            with open(state_path, "rb") as f:
+                return cls.from_state(marshal.loads(f.read()))
+        except (OSError, ValueError, EOFError, TypeError, KeyError):
+            pass
+        router = cls(rules)
+        tmp_path = "%s.%i.tmp" % (state_path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(marshal.dumps(router.state()))
+            os.replace(tmp_path, state_path)
+        except OSError:
+            # The router is still used from memory
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+        return router
+
+    def state(self) -> dict:
+        """Get the compiled rules as plain data, to persist with marshal"""
+        state = {name: getattr(self, name) for name in self.STATE}
+        state["by_host_pattern"] = self.by_host_pattern.state()
+        state["by_service"] = self.by_service.state()
+        return state
+
+    @classmethod
+    def from_state(cls, state: dict) -> "Router":
+        router = cls([])
+        for name in cls.STATE:
+            setattr(router, name, state[name])
+        router.by_host_pattern = PrefixIndex.from_state(state["by_host_pattern"])
+        router.by_service = PrefixIndex.from_state(state["by_service"])
+        return router
+
+    def _regex(self, pattern: str) -> "re.Pattern":
+        """Get a compiled regex, compiling it on first use"""
+        regex = self.regexes.get(pattern)
+        if regex is None:
+            regex = self.regexes[pattern] = re.compile(pattern)
+        return regex
+
+    @staticmethod
+    def _list(value) -> List[str]:
+        if not value:
+            return []
+        return [value] if isinstance(value, str) else list(value)
+
+    @staticmethod
+    def _hostname_pattern(name: str) -> str:
+        """Translate a hostname condition to a regex (`~` prefix marks a regex)"""
+        if name.startswith("~"):
+            return name[1:]
+        return re.escape(name) + "$"
+
+    def _bit(self, key: str) -> int:
+        """Get the bit for a condition key, assigning a new one if needed"""
+        if key not in self.bits:
+            self.bits[key] = 1 << len(self.bits)
+        return self.bits[key]
+
+    def _compile_rule(self, rule: dict) -> tuple:
+        """Compile a single rule to (mask, hostname regex, service regex, webhooks, final), regexes as text"""
+        mask = 0
+        for tag in rule.get("host_tags") or []:
+            mask |= self._bit("tag:" + tag)
+        for name, value in (rule.get("host_labels") or {}).items():
+            mask |= self._bit("label:%s:%s" % (name, value))
+        for group in rule.get("contact_groups") or []:
+            mask |= self._bit("group:" + group)
+
+        hostnames = self._list(rule.get("hostname"))
+        host_regex = None
+        if any(name.startswith("~") for name in hostnames):
+            host_regex = "|".join("(?:%s)" % self._hostname_pattern(name) for name in hostnames)
+            self._regex(host_regex)
+
+        services = self._list(rule.get("service"))
+        service_regex = None
+        if services:
+            service_regex = "|".join("(?:%s)" % s for s in services)
+            self._regex(service_regex)
+
+        webhooks = rule.get("webhooks") or []
+        for url in webhooks:
+            if not url.startswith("https://discord.com"):
+                sys.stderr.write("Invalid Discord webhook url in routing rule: %s" % url)
+                sys.exit(2)
+        return mask, host_regex, service_regex, tuple(webhooks), bool(rule.get("final"))
+
+    def _mask(self, ctx: Context) -> int:
+        """Build the condition mask of a notification"""
+        bits = self.bits
+        mask = 0
+        for tag in (ctx.host_tags or "").split():
+            mask |= bits.get("tag:" + tag, 0)
+        for name, value in (ctx.host_labels or {}).items():
+            mask |= bits.get("label:%s:%s" % (name, value), 0)
+        for group in (ctx.contact_groups or "").split(","):
+            mask |= bits.get("group:" + group.strip(), 0)
+        return mask
+
+    def _candidates(self, ctx: Context, mask: int) -> List[int]:
+        """Get the indices of the rules whose index allows this notification and mask"""
+        candidates = self.by_bit.get(0, []) + self.by_hostname.get(ctx.hostname, [])
+        while mask:
+            bit = mask & -mask
+            candidates.extend(self.by_bit.get(bit, []))
+            mask ^= bit
+        candidates.extend(self.by_host_pattern.lookup(ctx.hostname))
+        if ctx.what == "SERVICE":
+            candidates.extend(self.by_service.lookup(ctx.service_desc or ""))
+        return sorted(set(candidates))
+
+    def route(self, ctx: Context) -> List[str]:
+        """Get the webhook urls for a notification, defaulting to parameter 1"""
+        mask = self._mask(ctx)
+        webhooks = []
+        for index in self._candidates(ctx, mask):
+            rule_mask, host_regex, service_regex, rule_webhooks, final = self.rules[index]
+            if rule_mask & mask != rule_mask:
+                continue
+            if host_regex is not None and not self._regex(host_regex).match(ctx.hostname):
+                continue
+            if service_regex is not None and not (
+                    ctx.what == "SERVICE" and self._regex(service_regex).match(ctx.service_desc or "")):
+                continue
+            webhooks.extend(url for url in rule_webhooks if url not in webhooks)
+            if final:
+                break
+        return webhooks or [ctx.webhook_url]
+
+
+class Config:
+    """Optional plugin configuration read from a JSON file"""
+
+    ENV_VAR = "CMK_DISCORD_CONFIG"
+    DEFAULT_PATH = "~/etc/check_mk/cmk_discord.json"
+
+    _cache: Dict[str, tuple] = {}
+
+    def __init__(self, data: dict, path: Optional[str] = None, mtime: Optional[int] = None):
+        self.data = data
+        self.path = path
+        self.mtime = mtime
+        self._router = None
+        self._pools = None
+
+    @classmethod
+    def get_path(cls) -> str:
+        """Get the configuration file path (the site's etc/check_mk by default)"""
+        return os.path.expanduser(os.environ.get(cls.ENV_VAR) or cls.DEFAULT_PATH)
+
+    @classmethod
+    def load(cls, path: Optional[str] = None) -> "Config":
+        """Load the configuration, reusing the compiled one while the file is unchanged"""
+        path = path or cls.get_path()
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return cls({}, path)
+        cached = cls._cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            sys.stderr.write("Invalid configuration file %s: %s" % (path, e))
+            sys.exit(2)
+        config = cls(data, path, mtime)
+        cls._cache[path] = (mtime, config)
+        return config
+
+    def section(self, name: str) -> dict:
+        """Get a configuration section, empty when not configured"""
+        return self.data.get(name) or {}
+
+    @property
+    def router(self) -> Router:
+        """Get the compiled routing rules"""
+        if self._router is None:
+            self._router = Router.load(self.data.get("routes") or [], self.path, self.mtime)
+        return self._router
+
+    def apply_template(self, embed: Embed, url: str) -> Embed:
+        """Get the embed to send to a webhook, with the template of its routing rule or the default one"""
+        path = self.router.templates.get(url)
+        if path is None and url in self.pools:
+            path = next((self.router.templates[u] for u in self.pools[url].urls if u in self.router.templates), None)
+        path = path or self.data.get("template")
+        if not path:
+            return embed
+        import copy
+
+        embed = copy.copy(embed)
+        embed.template = Template.load(path)
+        return embed
+
+    @property
+    def pools(self) -> Dict[str, "WebhookPool"]:
+        """Get the webhook pools by the url of each of their webhooks"""
+        if self._pools is None:
+            self._pools = {}
+            section = self.section("pools")
+            for urls in section.get("webhooks") or []:
+                pool = WebhookPool(urls, section.get("strategy", "consistent"))
+                self._pools.update((url, pool) for url in urls)
+        return self._pools
+
+
+def get_state_dir(*parts: str) -> str:
+    """Get (and create) a directory for state shared by all invocations on the site"""
+    path = os.path.join(
+        os.path.expanduser(os.environ.get("CMK_DISCORD_STATE_DIR") or "~/var/check_mk/cmk_discord"), *parts
+    )
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class StateStore:
+    """Small JSON file store shared by all invocations on the site
+
+    Use it as a context manager: the file is locked exclusively while the
+    block runs, so concurrent invocations see each other's changes. Threads
+    sharing one store take turns, as the entries are kept on the store.
+    Entries expire after ttl seconds unless set with an explicit expiry.
+    """
+
+    def __init__(self, name: str, ttl: float, directory: Optional[str] = None):
+        self.path = os.path.join(directory or get_state_dir(), name + ".json")
+        self.ttl = ttl
+        self.entries: Dict[str, list] = {}
+        self._mutex = threading.Lock()
+        self._lock = None
+        self._dirty = False
+
+    def __enter__(self) -> "StateStore":
+        self._mutex.acquire()
+        try:
+            self._lock = open(self.path + ".lock", "a")
+            fcntl.flock(self._lock, fcntl.LOCK_EX)
+        except BaseException:
+            if self._lock is not None:
+                self._lock.close()
+                self._lock = None
+            self._mutex.release()
+            raise
+        try:
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        now = time.time()
+        expired = [key for (key, (expires, _)) in self.entries.items() if expires <= now]
+        for key in expired:
+            del self.entries[key]
+        self._dirty = bool(expired)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        try:
+            if self._dirty:
+                tmp_path = "%s.%i.tmp" % (self.path, os.getpid())
+                with open(tmp_path, "w") as f:
+                    json.dump(self.entries, f, separators=(",", ":"))
+                os.replace(tmp_path, self.path)
+        finally:
+            self._lock.close()
+            self._lock = None
+            self._mutex.release()
+
+    def get(self, key: str, default=None):
+        """Get the value of a key"""
+        entry = self.entries.get(key)
+        return default if entry is None else entry[1]
+
+    def expires(self, key: str) -> Optional[float]:
+        """Get the expiry time of a key"""
+        entry = self.entries.get(key)
+        return None if entry is None else entry[0]
+
+    def set(self, key: str, value, expires: Optional[float] = None) -> None:
+        """Set the value of a key, expiring after the store's ttl by default"""
+        self.entries[key] = [expires if expires is not None else time.time() + self.ttl, value]
+        self._dirty = True
+
+    def delete(self, key: str) -> None:
+        """Remove a key"""
+        if self.entries.pop(key, None) is not None:
+            self._dirty = True
+
+
+class ShardedStateStore:
+    """StateStore split into shards by key hash, for stores with many entries
+
+    An operation locks and rewrites only the shard of its key, so its cost
+    does not grow with the number of entries in the store.
+    """
+
+    def __init__(self, name: str, ttl: float, shards: int = 256):
+        directory = get_state_dir(name)
+        self.shards = [StateStore("%02x" % i, ttl, directory) for i in range(shards)]
+
+    def shard(self, key: str) -> StateStore:
+        """Get the shard holding a key, to use as a context manager"""
+        return self.shards[zlib.crc32(key.encode()) % len(self.shards)]
+
+    def entries(self) -> Dict[str, list]:
+        """Get the [expires, value] entries of all shards"""
+        entries = {}
+        for shard in self.shards:
+            with shard:
+                entries.update(shard.entries)
+        return entries
+
+
+class DnsCache:
+    """File-backed DNS cache shared by all invocations on the site
+
+    While installed, lookups done by the HTTP transport are answered from the
+    cache until their TTL expires. Misses, expired entries and any problem
+    with the cache itself go to the resolver (the system resolver by default,
+    using the record TTLs when dnspython is available), once: its errors are
+    raised to the caller.
+    """
+
+    def __init__(self, ttl: float = 300, resolver: Optional[Callable] = None):
+        self.ttl = ttl
+        self.resolver = resolver or self.system_resolver
+        self._getaddrinfo = socket.getaddrinfo
+
+    @classmethod
+    def from_config(cls, config: "Config") -> Optional["DnsCache"]:
+        """Create the DNS cache if it is configured"""
+        section = config.section("dns_cache")
+        if not section:
+            return None
+        return cls(ttl=section.get("ttl", 300))
+
+    def system_resolver(self, host: str, port: int) -> tuple:
+        """Resolve host with the system resolver, return (addresses, ttl)"""
+        try:
+            import dns.resolver
+        except ImportError:
+            return self._getaddrinfo(host, port, 0, socket.SOCK_STREAM), self.ttl
+
+        addresses, ttl = [], self.ttl
+        for (record_type, family) in (("A", socket.AF_INET), ("AAAA", socket.AF_INET6)):
+            try:
+                answer = dns.resolver.resolve(host, record_type)
+            except Exception:
+                continue
+            ttl = min(ttl, answer.rrset.ttl)
+            sockaddr = (lambda ip: (ip, port)) if family == socket.AF_INET else (lambda ip: (ip, port, 0, 0))
+            addresses.extend(
+                (family, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", sockaddr(record.to_text())) for record in answer
+            )
+        if not addresses:
+            return self._getaddrinfo(host, port, 0, socket.SOCK_STREAM), self.ttl
+        return addresses, ttl
+
+    def resolve(self, host: str, port: int) -> list:
+        """Get the addresses of host in getaddrinfo() format"""
+        key = "%s:%s" % (host, port)
+        resolved = None
+        try:
+            with StateStore("dns", self.ttl) as store:
+                cached = store.get(key)
+                if cached is not None:
+                    return [(family, kind, proto, name, tuple(sockaddr))
+                            for (family, kind, proto, name, sockaddr) in cached]
+                # A failed lookup is passed on below, not retried as a problem of the cache
+                try:
+                    resolved = self.resolver(host, port)
+                except OSError as e:
+                    resolved = e
+                else:
+                    addresses, ttl = resolved
+                    store.set(key, [list(address) for address in addresses], expires=time.time() + ttl)
+        except OSError:
+            pass
+        if resolved is None:
+            resolved = self.resolver(host, port)
+        if isinstance(resolved, OSError):
+            raise resolved
+        return resolved[0]
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        """Drop-in replacement for socket.getaddrinfo answering TCP lookups from the cache"""
+        if not isinstance(host, str) or type not in (0, socket.SOCK_STREAM) or flags:
+            return self._getaddrinfo(host, port, family, type, proto, flags)
+        try:
+            addresses = self.resolve(host, port)
+        except OSError:
+            # The lookup itself failed, another one would only wait again
+            raise
+        except Exception:
+            return self._getaddrinfo(host, port, family, type, proto, flags)
+        return [address for address in addresses if family in (0, address[0])] or \
+            self._getaddrinfo(host, port, family, type, proto, flags)
+
+    def __enter__(self) -> "DnsCache":
+        socket.getaddrinfo = self.getaddrinfo
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        socket.getaddrinfo = self._getaddrinfo
+
+
+def rate_limit(response) -> Optional[tuple]:
+    """Get the rate-limit budget reported in a response as (remaining, reset after seconds)"""
+    if response is None:
+        return None
+    headers = response.headers
+    if response.status_code == HTTPStatus.TOO_MANY_REQUESTS.value:
+        return 0, float(headers.get("Retry-After") or headers.get("X-RateLimit-Reset-After") or 1)
+    if "X-RateLimit-Remaining" in headers and "X-RateLimit-Reset-After" in headers:
+        return int(headers["X-RateLimit-Remaining"]), float(headers["X-RateLimit-Reset-After"])
+    return None
+
+
+class WebhookPool:
+    """Pool of webhooks posting to the same channel, to multiply the rate limit
+
+    Sends are spread by consistent (rendezvous) hashing of the host, so all
+    notifications of a host keep their order through one webhook, or to the
+    least loaded webhook. Both skip webhooks whose rate-limit budget, as
+    reported by Discord and shared by all invocations, is used up.
+    """
+
+    STRATEGIES = ("consistent", "least_loaded")
+
+    def __init__(self, urls: List[str], strategy: str = "consistent"):
+        if strategy not in self.STRATEGIES:
+            sys.stderr.write("Invalid webhook pool strategy: %s" % strategy)
+            sys.exit(2)
+        self.urls = urls
+        self.strategy = strategy
+
+    @staticmethod
+    def _key(url: str) -> str:
+        """Get the rate-limit state key of a webhook (without storing its token)"""
+        return hashlib.sha1(url.encode()).hexdigest()[:16]
+
+    def _ranked(self, ctx: Context) -> List[str]:
+        """Rank the webhooks by rendezvous hash of the host"""
+        host = "%s/%s" % (ctx.omd_site, ctx.hostname)
+        return sorted(self.urls, key=lambda url: hashlib.sha1((host + url).encode()).digest(), reverse=True)
+
+    def select(self, ctx: Context) -> str:
+        """Select the webhook to send a notification to and reserve one request of its budget"""
+        now = time.time()
+        with StateStore("ratelimits", 3600) as store:
+            budgets = {}
+            for url in self._ranked(ctx):
+                limit = store.get(self._key(url))
+                if limit is None or limit["reset"] <= now:
+                    budgets[url] = (float("inf"), now)
+                else:
+                    budgets[url] = (limit["remaining"], limit["reset"])
+
+            available = [url for (url, (remaining, _)) in budgets.items() if remaining > 0]
+            if not available:
+                url = min(budgets, key=lambda url: budgets[url][1])
+            elif self.strategy == "least_loaded":
+                url = max(available, key=lambda url: budgets[url][0])
+            else:
+                url = available[0]
+
+            remaining, reset = budgets[url]
+            if remaining != float("inf"):
+                store.set(self._key(url), {"remaining": max(remaining - 1, 0), "reset": reset}, expires=reset)
+        return url
+
+    def observe(self, url: str, response) -> None:
+        """Record the rate-limit budget Discord reported for a webhook"""
+        limit = rate_limit(response)
+        if limit is None:
+            return
+        remaining, reset_after = limit
+        reset = time.time() + reset_after
+        with StateStore("ratelimits", 3600) as store:
+            store.set(self._key(url), {"remaining": remaining, "reset": reset}, expires=reset)
+
+
+class CircuitBreaker:
+    """Per-webhook health with fail-fast failover to a fallback webhook
+
+    Consecutive failed sends (anything but success and rate limiting) are
+    counted per webhook in a shared store. After failures of them the
+    circuit opens: sends go straight to the fallback webhook, or fail fast
+    without one. Once cooldown seconds passed, the next send first probes
+    the webhook (a GET, which posts nothing); success closes the circuit,
+    failure keeps it open for another cooldown. A rate limit whose
+    Retry-After exceeds max_retry_after seconds opens the circuit right away,
+    until the rate limit is over.
+    """
+
+    def __init__(self, fallbacks: Dict[str, str], fallback: Optional[str] = None, failures: int = 3,
+                 cooldown: float = 60, probe_timeout: float = 5, max_retry_after: float = 60):
+        self.fallbacks = fallbacks
+        self.fallback = fallback
+        self.failures = failures
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self.max_retry_after = max_retry_after
+        self.store = StateStore("health", 7 * 86400)
+
+    @classmethod
+    def from_config(cls, config: "Config") -> Optional["CircuitBreaker"]:
+        """Create the circuit breaker if it is configured"""
+        section = config.section("failover")
+        if not section:
+            return None
+        return cls(
+            fallbacks=section.get("webhooks") or {},
+            fallback=section.get("fallback"),
+            failures=section.get("failures", 3),
+            cooldown=section.get("cooldown", 60),
+            probe_timeout=section.get("probe_timeout", 5),
+            max_retry_after=section.get("max_retry_after", 60),
+        )
+
+    def probe(self, url: str) -> bool:
+        """Check whether a webhook answers"""
+        try:
+            response = (DiscordWebhook.session or requests).get(url, timeout=self.probe_timeout)
+        except requests.RequestException:
+            return False
+        return response.status_code == HTTPStatus.OK.value
+
+    def _available(self, url: str, now: float) -> bool:
+        """Check whether sends may go to a webhook, probing it when its cooldown passed"""
+        with self.store as store:
+            health = store.get(WebhookPool._key(url))
+            if health is None or health["failures"] < self.failures:
+                return True
+            if now < health["opened"] + self.cooldown:
+                return False
+            # Hold off other probes while this one runs
+            health["opened"] = now + self.probe_timeout - self.cooldown
+            store.set(WebhookPool._key(url), health)
+        healthy = self.probe(url)
+        with self.store as store:
+            if healthy:
+                store.delete(WebhookPool._key(url))
+            else:
+                store.set(WebhookPool._key(url), {"failures": self.failures, "opened": now})
+        return healthy
+
+    def select(self, url: str, now: Optional[float] = None) -> Optional[str]:
+        """Get the webhook to send to instead of url, None when neither it nor its fallback is available"""
+        now = time.time() if now is None else now
+        if self._available(url, now):
+            return url
+        fallback = self.fallbacks.get(url, self.fallback)
+        if fallback and fallback != url and self._available(fallback, now):
+            return fallback
+        return None
+
+    def observe(self, url: str, sent: bool, response, now: Optional[float] = None) -> None:
+        """Count a send to a webhook towards its health"""
+        now = time.time() if now is None else now
+        if response is not None and response.status_code == HTTPStatus.TOO_MANY_REQUESTS.value:
+            retry_after = rate_limit(response)[1]
+            if retry_after > self.max_retry_after:
+                # Rate limited for long: fail over until the limit is over, then probe
+                with self.store as store:
+                    store.set(WebhookPool._key(url),
+                              {"failures": self.failures, "opened": now + retry_after - self.cooldown})
+            return
+        with self.store as store:
+            key = WebhookPool._key(url)
+            health = store.get(key)
+            if sent:
+                if health is not None:
+                    store.delete(key)
+                return
+            failures = (health or {"failures": 0})["failures"] + 1
+            opened = now if failures == self.failures else (health or {}).get("opened", now)
+            store.set(key, {"failures": failures, "opened": opened})
+
+
+class Deduplicator:
+    """Skip sends identical to one that is in flight or already done
+
+    Checkmk runs the script once per matching contact and retries failed
+    notifications, so the same incident can reach the same webhook several
+    times. Each send is fingerprinted and claimed in a shared store; a send
+    whose fingerprint is claimed is skipped, unless the claim is an in-flight
+    send older than the in-flight timeout (its process probably died).
+    """
+
+    def __init__(self, ttl: float = 3600, inflight_timeout: float = 60):
+        self.ttl = ttl
+        self.inflight_timeout = inflight_timeout
+        self.store = ShardedStateStore("sent", ttl)
+
+    @classmethod
+    def from_config(cls, config: "Config") -> Optional["Deduplicator"]:
+        """Create the deduplicator if it is configured"""
+        section = config.section("dedupe")
+        if not section:
+            return None
+        return cls(ttl=section.get("ttl", 3600), inflight_timeout=section.get("inflight_timeout", 60))
+
+    @staticmethod
+    def fingerprint(ctx: Context, url: str) -> str:
+        """Fingerprint a send of a notification to a webhook"""
+        state = ctx.service_state if ctx.what == "SERVICE" else ctx.host_state
+        parts = (url, ctx.omd_site, ctx.hostname, ctx.service_desc or "", ctx.notification_type,
+                 state or "", ctx.problem_id or "", ctx.short_datetime)
+        return hashlib.sha1("\0".join(parts).encode()).hexdigest()
+
+    def claim(self, ctx: Context, url: str) -> Optional[str]:
+        """Claim a send, returning its fingerprint, or None when it must be skipped"""
+        key = self.fingerprint(ctx, url)
+        now = time.time()
+        with self.store.shard(key) as store:
+            claimed = store.get(key)
+            if claimed is not None and (claimed["done"] or now - claimed["since"] < self.inflight_timeout):
+                return None
+            store.set(key, {"since": now, "done": False})
+        return key
+
+    def done(self, key: str) -> None:
+        """Mark a claimed send as done"""
+        with self.store.shard(key) as store:
+            store.set(key, {"since": time.time(), "done": True})
+
+    def release(self, key: str) -> None:
+        """Give up a claimed send that failed, so a retry can send it"""
+        with self.store.shard(key) as store:
+            store.delete(key)
+
+
+class Throttle:
+    """Suppress or shorten renotifications of unchanged problems
+
+    The state, a hash of the output and the start of the problem are kept
+    per object and notification rule (its webhook url) in a shared store,
+    once a full message was sent. A renotification (notification number
+    above 1) with the same state and output is suppressed, or reduced to a
+    short "still CRITICAL for 3h" line. A full message is sent again when the
+    notification number reaches one of the escalation numbers, or when the
+    last full message is older than escalate_every seconds.
+    """
+
+    SEND = "send"
+    SUMMARIZE = "summarize"
+    SUPPRESS = "suppress"
+    NUMBERS = re.compile(r"\d+(?:\.\d+)?")
+
+    def __init__(self, mode: str = SUMMARIZE, escalate: Optional[List[int]] = None,
+                 escalate_every: Optional[float] = None, ignore_numbers: bool = False, hold: float = 7 * 86400):
+        if mode not in (self.SUMMARIZE, self.SUPPRESS):
+            sys.stderr.write("Invalid throttle mode: %s" % mode)
+            sys.exit(2)
+        self.mode = mode
+        self.escalate = set(escalate or [])
+        self.escalate_every = escalate_every
+        self.ignore_numbers = ignore_numbers
+        self.store = ShardedStateStore("throttle", hold)
+
+    @classmethod
+    def from_config(cls, config: "Config") -> Optional["Throttle"]:
+        """Create the throttle if it is configured"""
+        section = config.section("throttle")
+        if not section:
+            return None
+        return cls(
+            mode=section.get("mode", cls.SUMMARIZE),
+            escalate=section.get("escalate"),
+            escalate_every=section.get("escalate_every"),
+            ignore_numbers=section.get("ignore_numbers", False),
+            hold=section.get("hold", 7 * 86400),
+        )
+
+    @staticmethod
+    def _key(ctx: Context) -> str:
+        return "%s/%s/%s/%s" % (ctx.omd_site, ctx.hostname, ctx.service_desc or "", ctx.webhook_url or "")
+
+    def _digest(self, output: Optional[str]) -> str:
+        """Hash an output, optionally ignoring the numbers in it"""
+        output = output or ""
+        if self.ignore_numbers:
+            output = self.NUMBERS.sub("#", output)
+        return hashlib.sha1(output.encode()).hexdigest()[:12]
+
+    def check(self, ctx: Context, now: Optional[float] = None) -> tuple:
+        """Decide how to send a notification, return (action, problem start time)
+
+        A full message is only remembered by sent(), once it was delivered.
+        """
+        now = time.time() if now is None else now
+        state = ctx.service_state if ctx.what == "SERVICE" else ctx.host_state
+        key = self._key(ctx)
+        with self.store.shard(key) as store:
+            if ctx.notification_type != "PROBLEM" or state in ("OK", "UP"):
+                if ctx.notification_type == "RECOVERY" or state in ("OK", "UP"):
+                    store.delete(key)
+                return self.SEND, now
+
+            digest = self._digest(ctx.service_output if ctx.what == "SERVICE" else ctx.host_output)
+            number = int(ctx.notification_number or 1)
+            # Per object: [state, output hash, problem start, last full message]
+            entry = store.get(key)
+            if entry is None or number <= 1 or entry[0] != state or entry[1] != digest:
+                return self.SEND, entry[2] if entry is not None and entry[0] == state else now
+            if number in self.escalate or (self.escalate_every and now - entry[3] >= self.escalate_every):
+                return self.SEND, entry[2]
+            return self.mode, entry[2]
+
+    def sent(self, ctx: Context, since: float, now: Optional[float] = None) -> None:
+        """Remember the full message of a problem sent after check() returned SEND"""
+        now = time.time() if now is None else now
+        state = ctx.service_state if ctx.what == "SERVICE" else ctx.host_state
+        if ctx.notification_type != "PROBLEM" or state in ("OK", "UP"):
+            return
+        digest = self._digest(ctx.service_output if ctx.what == "SERVICE" else ctx.host_output)
+        key = self._key(ctx)
+        with self.store.shard(key) as store:
+            store.set(key, [state, digest, since, now])
+
+    @staticmethod
+    def duration(seconds: float) -> str:
+        """Format a duration like 45m, 3h or 2d 4h"""
+        minutes = int(seconds // 60)
+        if minutes < 60:
+            return "%im" % minutes
+        hours, minutes = divmod(minutes, 60)
+        if hours < 24:
+            return "%ih" % hours if hours >= 3 or not minutes else "%ih %im" % (hours, minutes)
+        days, hours = divmod(hours, 24)
+        return "%id %ih" % (days, hours) if hours else "%id" % days
+
+    def summarize(self, embed: Embed, since: float, now: Optional[float] = None) -> None:
+        """Reduce an embed to a short line saying how long the problem lasts"""
+        now = time.time() if now is None else now
+        embed.output = "Still %s for %s (notification %s), output unchanged" % (
+            embed.current_state, self.duration(now - since), embed.ctx.notification_number or "?")
+
+
+class HostCorrelation:
+    """Fold service problems on a DOWN or UNREACHABLE host into the host message
+
+    A host problem is sent as usual and remembered per site. Service problems
+    on that host within the window are not sent separately: the host message
+    is edited to list them instead. Recoveries of folded services are dropped
+    (until the outage is forgotten after hold seconds, or window seconds after
+    the host recovered) and the host recovery lists the folded services.
+    """
+
+    HOST_PROBLEM_STATES = ("DOWN", "UNREACHABLE")
+
+    def __init__(self, window: float = 600, hold: float = 86400, max_listed: int = 20):
+        self.window = window
+        self.max_listed = max_listed
+        self.store = StateStore("correlation", hold)
+
+    @classmethod
+    def from_config(cls, config: "Config") -> Optional["HostCorrelation"]:
+        """Create the correlation stage if it is configured"""
+        section = config.section("correlation")
+        if not section:
+            return None
+        return cls(
+            window=section.get("window", 600),
+            hold=section.get("hold", 86400),
+            max_listed=section.get("max_listed", 20),
+        )
+
+    @staticmethod
+    def _key(ctx: Context) -> str:
+        return "%s/%s" % (ctx.omd_site, ctx.hostname)
+
+    def opens_outage(self, ctx: Context) -> bool:
+        """Check whether the notification is a host problem to correlate with"""
+        return (
+            ctx.what == "HOST"
+            and ctx.notification_type == "PROBLEM"
+            and ctx.host_state in self.HOST_PROBLEM_STATES
+        )
+
+    def record(self, ctx: Context, messages: Dict[str, str]) -> None:
+        """Remember a host problem and the messages (per webhook url) it was sent as
+
+        A renotification of an outage keeps its start and folded services,
+        and its messages are edited from then on.
+        """
+        with self.store as store:
+            key = self._key(ctx)
+            outage = store.get(key)
+            if outage is None or outage["released"]:
+                outage = {"since": time.time(), "messages": {}, "services": {}, "released": False}
+            outage["ctx"] = asdict(ctx)
+            outage["messages"].update(messages)
+            outage["revision"] = outage.get("revision", 0) + 1
+            store.set(key, outage)
+
+    def _services_field(self, services: Dict[str, str]) -> dict:
+        """Build the embed field listing the folded services"""
+        listed = ["%s (%s)" % (name, state) for (name, state) in list(services.items())[:self.max_listed]]
+        if len(services) > len(listed):
+            listed.append("... and %i more" % (len(services) - len(listed)))
+        return {
+            "name": "Services affected: %i" % len(services),
+            "value": "\n".join(listed)[:1024] or "-",
+            "inline": False,
+        }
+
+    def absorb(self, ctx: Context, config: "Config") -> bool:
+        """Fold a service notification into its host message, return True when folded"""
+        if ctx.what != "SERVICE" or ctx.notification_type not in ("PROBLEM", "RECOVERY"):
+            return False
+        with self.store as store:
+            key = self._key(ctx)
+            outage = store.get(key)
+            if outage is None:
+                return False
+            expires = store.expires(key)
+            if ctx.notification_type == "RECOVERY" or ctx.service_state == "OK":
+                if ctx.service_desc not in outage["services"]:
+                    return False
+                # The problem was never sent on its own, so neither is the recovery
+                del outage["services"][ctx.service_desc]
+                store.set(key, outage, expires=expires)
+                return True
+            if outage["released"] or time.time() - outage["since"] > self.window:
+                return False
+
+            outage["services"][ctx.service_desc] = ctx.service_state
+            outage["revision"] = outage.get("revision", 0) + 1
+            store.set(key, outage, expires=expires)
+        self._edit(key, outage, config)
+        return True
+
+    def _edit(self, key: str, outage: dict, config: "Config") -> None:
+        """Edit the host messages without holding the lock
+
+        Edits of concurrent invocations may land in any order, so the edit is
+        repeated with the latest list until no newer one was stored meanwhile.
+        """
+        while True:
+            host_ctx = Context(**outage["ctx"])
+            embed = Embed.from_context(host_ctx)
+            embed.notes = [self._services_field(outage["services"])]
+            for (url, message_id) in outage["messages"].items():
+                DiscordWebhook(url, config.apply_template(embed, url), host_ctx.omd_site).edit(message_id)
+            with self.store as store:
+                current = store.get(key)
+            if current is None or current.get("revision", 0) <= outage.get("revision", 0):
+                return
+            outage = current
+
+    def release(self, ctx: Context, embed: Embed) -> None:
+        """Mention the folded services in a host renotification or recovery, end the outage on recovery"""
+        if ctx.what != "HOST":
+            return
+        if self.opens_outage(ctx):
+            with self.store as store:
+                outage = store.get(self._key(ctx))
+            if outage is not None and not outage["released"] and outage["services"]:
+                embed.notes = [self._services_field(outage["services"])]
+            return
+        if ctx.host_state != "UP":
+            return
+        with self.store as store:
+            key = self._key(ctx)
+            outage = store.get(key)
+            if outage is None or outage["released"]:
+                return
+            outage["released"] = True
+            store.set(key, outage, expires=time.time() + self.window)
+            if outage["services"]:
+                embed.notes = [self._services_field(outage["services"])]
+
+
+class CatchUp:
+    """Collapse a large backlog into per-host summaries
+
+    When more than threshold notifications are waiting (a backlog re-sent
+    after an outage, or persisted by the dispatcher), only the final state of
+    every object is kept. Each host gets one summary listing the final states
+    of its objects, and only objects still in a problem state are sent as
+    individual notifications.
+    """
+
+    PROBLEM_STATES = ("WARNING", "CRITICAL", "UNKNOWN", "DOWN", "UNREACHABLE")
+
+    def __init__(self, threshold: int = 100, max_listed: int = 25):
+        self.threshold = threshold
+        self.max_listed = max_listed
+
+    @classmethod
+    def from_config(cls, config: "Config") -> Optional["CatchUp"]:
+        """Create the catch-up stage if it is configured"""
+        section = config.section("catch_up")
+        if not section:
+            return None
+        return cls(threshold=section.get("threshold", 100), max_listed=section.get("max_listed", 25))
+
+    def exceeded(self, items: Iterable) -> tuple:
+        """Look ahead up to the threshold, return (whether it is exceeded, all items)"""
+        iterator = iter(items)
+        head = []
+        for item in iterator:
+            head.append(item)
+            if len(head) > self.threshold:
+                return True, itertools.chain(head, iterator)
+        return False, iter(head)
+
+    def collapse(self, contexts: Iterable[Context]) -> Iterator[tuple]:
+        """Collapse notifications into (context, embed) summaries and the individual problems to send"""
+        hosts: Dict[tuple, dict] = {}
+        for ctx in contexts:
+            key = (ctx.webhook_url, ctx.omd_site, ctx.hostname)
+            host = hosts.setdefault(key, {"count": 0, "first": ctx, "objects": {}})
+            host["count"] += 1
+            # Keep insertion order of the latest notification per object
+            host["objects"].pop(ctx.service_desc if ctx.what == "SERVICE" else None, None)
+            host["objects"][ctx.service_desc if ctx.what == "SERVICE" else None] = ctx
+
+        for host in hosts.values():
+            problems = [
+                ctx for ctx in host["objects"].values()
+                if (ctx.service_state if ctx.what == "SERVICE" else ctx.host_state) in self.PROBLEM_STATES
+            ]
+            yield self._summary(host, problems)
+            for ctx in problems:
+                yield ctx, Embed.from_context(ctx)
+
+    def _summary(self, host: dict, problems: List[Context]) -> tuple:
+        """Build the summary of a host as (context, embed)"""
+        objects = list(host["objects"].values())
+        last = objects[-1]
+        host_ctx = host["objects"].get(None)
+        ctx = replace(
+            last,
+            what="HOST",
+            notification_type="CATCHUP",
+            host_state=(host_ctx or last).host_state or "UP",
+            previous_host_state=host["first"].previous_host_state or host["first"].host_state,
+            host_output="%i notifications while Discord was unreachable, %i objects still in a problem state" % (
+                host["count"], len(problems)),
+            notification_comment=None,
+            service_desc=None,
+            service_state=None,
+            service_output=None,
+        )
+        embed = Embed.from_context(ctx)
+        states = [
+            "%s: %s" % (o.service_desc if o.what == "SERVICE" else "Host", o.service_state if o.what == "SERVICE"
+                        else o.host_state)
+            for o in objects[:self.max_listed]
+        ]
+        if len(objects) > len(states):
+            states.append("... and %i more" % (len(objects) - len(states)))
+        embed.notes = [{"name": "Final states", "value": "\n".join(states)[:1024], "inline": False}]
+        return ctx, embed
+
+
+class LatencyHistogram:
+    """Delay from the Checkmk event time to Discord's acknowledgement
+
+    Delays are counted in log-scaled buckets (four per doubling, so about
+    19% wide, from 1ms up) per site, webhook and time slot of resolution
+    seconds. Slots are kept in a shared store for retention seconds.
+    """
+
+    BASE = 2 ** 0.25
+
+    def __init__(self, resolution: int = 3600, retention: float = 30 * 86400):
+        self.resolution = resolution
+        self.retention = retention
+        self.store = ShardedStateStore("latency", retention)
+
+    @classmethod
+    def from_config(cls, config: "Config") -> Optional["LatencyHistogram"]:
+        """Create the latency histogram if it is configured"""
+        section = config.section("latency")
+        if not section:
+            return None
+        return cls(resolution=section.get("resolution", 3600), retention=section.get("retention", 30 * 86400))
+
+    @classmethod
+    def bucket(cls, seconds: float) -> int:
+        """Get the bucket of a delay"""
+        if seconds <= 0.001:
+            return 0
+        return int(math.log(seconds * 1000, cls.BASE))
+
+    @classmethod
+    def bucket_value(cls, bucket: int) -> float:
+        """Get the delay in seconds in the middle of a bucket"""
+        return cls.BASE ** (bucket + 0.5) / 1000
+
+    def record(self, ctx: Context, url: str, now: Optional[float] = None) -> None:
+        """Count the delay of a notification acknowledged by Discord now"""
+        if not ctx.microtime:
+            return
+        now = time.time() if now is None else now
+        slot = int(now // self.resolution * self.resolution)
+        key = "%s|%s|%i" % (ctx.omd_site, WebhookPool._key(url), slot)
+        bucket = str(self.bucket(now - int(ctx.microtime) / 1000000))
+        with self.store.shard(key) as store:
+            counts = store.get(key) or {}
+            counts[bucket] = counts.get(bucket, 0) + 1
+            store.set(key, counts, expires=slot + self.retention)
+
+    def query(self, site: Optional[str] = None, url: Optional[str] = None, since: float = 86400,
+              interval: Optional[int] = None, now: Optional[float] = None) -> List[tuple]:
+        """Merge the slots into intervals, return (start, count, p50, p90, p99, max) per interval"""
+        now = time.time() if now is None else now
+        interval = interval or self.resolution
+        webhook = WebhookPool._key(url) if url else None
+        merged: Dict[int, Dict[int, int]] = {}
+        for (key, (_, counts)) in self.store.entries().items():
+            key_site, key_webhook, slot = key.rsplit("|", 2)
+            if (site and key_site != site) or (webhook and key_webhook != webhook) or int(slot) < now - since:
+                continue
+            buckets = merged.setdefault(int(slot) // interval * interval, {})
+            for (bucket, count) in counts.items():
+                buckets[int(bucket)] = buckets.get(int(bucket), 0) + count
+
+        rows = []
+        for start in sorted(merged):
+            buckets = sorted(merged[start].items())
+            total = sum(count for (_, count) in buckets)
+            percentiles = []
+            for fraction in (0.5, 0.9, 0.99):
+                seen = 0
+                for (bucket, count) in buckets:
+                    seen += count
+                    if seen >= fraction * total:
+                        percentiles.append(self.bucket_value(bucket))
+                        break
+            rows.append((start, total, *percentiles, self.bucket_value(buckets[-1][0])))
+        return rows
+
+
+class History:
+    """Append-only local history of sent notifications
+
+    Every send appends one JSON line (time, site, host, service, type,
+    state, webhook, payload hash, status and latency) to the segment of its
+    UTC day. When a day's segment is closed (or queried first), it gets a
+    marshalled index of line offsets by host and service; segments older
+    than retention days are removed when a new segment starts.
+    """
+
+    SHARDS = 64
+
+    def __init__(self, retention: int = 90, directory: Optional[str] = None):
+        self.retention = retention
+        self.directory = os.path.expanduser(directory) if directory else get_state_dir("history")
+
+    @classmethod
+    def from_config(cls, config: "Config") -> Optional["History"]:
+        """Create the history if it is configured"""
+        section = config.section("history")
+        if not section:
+            return None
+        return cls(retention=section.get("retention", 90), directory=section.get("directory"))
+
+    def _shard(self, name: Optional[str]) -> int:
+        return zlib.crc32((name or "").encode()) % self.SHARDS
+
+    def _segment(self, day: str) -> str:
+        return os.path.join(self.directory, day + ".ndjson")
+
+    @staticmethod
+    def _day(timestamp: float) -> str:
+        return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+
+    def append(self, ctx: Context, url: str, payload_hash: str, status: Optional[int],
+               latency: Optional[float], now: Optional[float] = None) -> None:
+        """Append a send to the history"""
+        now = time.time() if now is None else now
+        record = {
+            "t": int(now * 1000) / 1000,
+            "site": ctx.omd_site,
+            "host": ctx.hostname,
+            "service": ctx.service_desc if ctx.what == "SERVICE" else None,
+            "type": ctx.notification_type,
+            "state": ctx.service_state if ctx.what == "SERVICE" else ctx.host_state,
+            "webhook": WebhookPool._key(url),
+            "hash": payload_hash,
+            "status": status,
+            "latency": None if latency is None else round(latency, 3),
+        }
+        path = self._segment(self._day(now))
+        new = not os.path.exists(path)
+        with open(path, "a") as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        if new:
+            self.prune(now)
+            # Index the segment that just closed, so queries find it ready
+            previous = self._day(now - 86400)
+            if os.path.exists(self._segment(previous)):
+                self._index(previous, self._day(now))
+
+    def prune(self, now: Optional[float] = None) -> None:
+        """Remove the segments older than the retention"""
+        oldest = self._day((time.time() if now is None else now) - self.retention * 86400)
+        for name in os.listdir(self.directory):
+            if name[:10] < oldest:
+                os.unlink(os.path.join(self.directory, name))
+
+    def _index(self, day: str, today: str) -> Optional[dict]:
+        """Get the index of a closed segment, building it when missing, or None for today's segment"""
+        if day >= today:
+            return None
+        path = self._segment(day)
+        index_path = path[:-len(".ndjson")] + ".idx"
+        try:
+            with open(index_path, "rb") as f:
+                return marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        offsets = {"host": {}, "service": {}}
+        with open(path, "rb") as f:
+            offset = 0
+            for line in f:
+                record = json.loads(line)
+                offsets["host"].setdefault(record["host"], array("Q")).append(offset)
+                offsets["service"].setdefault(record["service"], array("Q")).append(offset)
+                offset += len(line)
+        # Names are spread over marshalled shards of packed offsets, so a query only decodes one shard
+        index = {}
+        for (key, names) in offsets.items():
+            shards = [{} for _ in range(self.SHARDS)]
+            for (name, values) in names.items():
+                shards[self._shard(name)][name] = values.tobytes()
+            index[key] = [marshal.dumps(shard) for shard in shards]
+        tmp_path = "%s.%i.tmp" % (index_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            marshal.dump(index, f)
+        os.replace(tmp_path, index_path)
+        return index
+
+    def query(self, host: Optional[str] = None, service: Optional[str] = None, since: float = 86400,
+              until: Optional[float] = None, status: Optional[str] = None, limit: int = 100,
+              now: Optional[float] = None) -> List[dict]:
+        """Get the newest matching records within since seconds before until (default now)"""
+        now = time.time() if now is None else now
+        until = now if until is None else until
+        start = until - since
+        today = self._day(now)
+        days = sorted(
+            (name[:10] for name in os.listdir(self.directory) if name.endswith(".ndjson")
+             and self._day(start) <= name[:10] <= self._day(until)),
+            reverse=True,
+        )
+        records = []
+        for day in days:
+            index = self._index(day, today)
+            offsets = None
+            if index is not None and (host or service):
+                candidates = [
+                    set(array("Q", marshal.loads(index[key][self._shard(value)]).get(value, b"")))
+                    for (key, value) in (("host", host), ("service", service)) if value
+                ]
+                offsets = sorted(set.intersection(*candidates))
+            with open(self._segment(day), "rb") as f:
+                if offsets is None:
+                    lines = f.readlines()
+                    # Skip decoding lines that cannot match
+                    for (key, value) in (("host", host), ("service", service)):
+                        if value:
+                            needle = ('"%s":%s' % (key, json.dumps(value))).encode()
+                            lines = [line for line in lines if needle in line]
+                else:
+                    lines = []
+                    for offset in offsets:
+                        f.seek(offset)
+                        lines.append(f.readline())
+            for line in reversed(lines):
+                record = json.loads(line)
+                if not start <= record["t"] <= until:
+                    continue
+                if (host and record["host"] != host) or (service and record["service"] != service):
+                    continue
+                if status == "failed" and record["status"] in (200, 204):
+                    continue
+                if status == "sent" and record["status"] not in (200, 204):
+                    continue
+                records.append(record)
+                if len(records) >= limit:
+                    return records
+        return records
+
+
+class Profiler:
+    """Opt-in cProfile and tracemalloc capture of sampled invocations
+
+    Enabled by the "profile" configuration section or the CMK_DISCORD_PROFILE
+    environment variable, which both give the sampling rate (1 in N). Only the
+    newest reports are kept in the profile directory.
+    """
+
+    ENV_VAR = "CMK_DISCORD_PROFILE"
+
+    def __init__(self, sample: int, directory: str, keep: int = 20, top: int = 25):
+        self.sample = sample
+        self.directory = directory
+        self.keep = keep
+        self.top = top
+
+    @classmethod
+    def from_config(cls, config: "Config") -> Optional["Profiler"]:
+        """Create the profiler if profiling is enabled"""
+        section = config.section("profile")
+        sample = int(os.environ.get(cls.ENV_VAR) or section.get("sample") or 0)
+        if sample <= 0:
+            return None
+        directory = section.get("directory") or get_state_dir("profiles")
+        return cls(sample, directory, keep=section.get("keep", 20), top=section.get("top", 25))
+
+    def run(self, func) -> None:
+        """Run func, profiling it for 1 in sample invocations"""
+        if random.random() * self.sample >= 1:
+            func()
+            return
+
+        import cProfile
+        import tracemalloc
+
+        profile = cProfile.Profile()
+        tracemalloc.start()
+        try:
+            profile.runcall(func)
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            self._write(profile, snapshot)
+
+    def _write(self, profile, snapshot) -> None:
+        """Write the reports of one invocation and drop the oldest ones"""
+        os.makedirs(self.directory, exist_ok=True)
+        name = os.path.join(self.directory, "%s-%i" % (datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f"), os.getpid()))
+        profile.dump_stats(name + ".pstats")
+        with open(name + ".malloc.txt", "w") as f:
+            for stat in snapshot.statistics("lineno")[:self.top]:
+                f.write("%s\n" % stat)
+
+        for suffix in (".pstats", ".malloc.txt"):
+            reports = sorted(
+                (entry for entry in os.scandir(self.directory) if entry.name.endswith(suffix)),
+                key=lambda entry: (entry.stat().st_mtime_ns, entry.name),
+            )
+            for entry in reports[:max(len(reports) - self.keep, 0)]:
+                os.unlink(entry.path)
+
+
+class Recorder:
+    """Opt-in capture of sampled notification contexts into a benchmark corpus
+
+    Enabled by the "record" configuration section or the CMK_DISCORD_RECORD
+    environment variable, which both give the sampling rate (1 in N). Records
+    are redacted and appended as gzipped NDJSON to
+    <directory>/<version>/<host|service>/<type>_<state>.ndjson.gz, the layout
+    of tests/data. Recording stops once the corpus reaches max_bytes.
+    """
+
+    ENV_VAR = "CMK_DISCORD_RECORD"
+    WEBHOOK_PATTERN = re.compile(r"https://(?:[a-z]+\.)?discord(?:app)?\.com/api/webhooks/[^\s\"']+")
+    WEBHOOK_REDACTED = "https://discord.com/api/webhooks/0/redacted"
+
+    def __init__(self, sample: int, directory: str, max_bytes: int = 64 * 1024 * 1024,
+                 redact: Iterable[str] = ("CONTACTEMAIL", "CONTACTPAGER"), version: Optional[str] = None):
+        self.sample = sample
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.redact = {name[7:] if name.startswith("NOTIFY_") else name for name in redact}
+        self.version = version or self.get_version()
+
+    @classmethod
+    def from_config(cls, config: "Config") -> Optional["Recorder"]:
+        """Create the recorder if recording is enabled"""
+        section = config.section("record")
+        sample = int(os.environ.get(cls.ENV_VAR) or section.get("sample") or 0)
+        if sample <= 0:
+            return None
+        directory = os.path.expanduser(section.get("directory") or get_state_dir("corpus"))
+        kwargs = {key: section[key] for key in ("max_bytes", "redact", "version") if key in section}
+        return cls(sample, directory, **kwargs)
+
+    @staticmethod
+    def get_version() -> str:
+        """Get the Checkmk version of the site (e.g. 2.4.0p12), or "unknown" outside a site"""
+        try:
+            version = os.path.basename(os.readlink(os.path.join(os.environ["OMD_ROOT"], "version")))
+        except (KeyError, OSError):
+            return "unknown"
+        # Strip the edition suffix (2.4.0p12.cre)
+        return re.sub(r"\.c[a-z]+$", "", version)
+
+    def redacted(self, data: Dict[str, str]) -> Dict[str, str]:
+        """Get the NOTIFY_* environment of a stripped context without webhook urls and configured fields
+
+        Configured fields get a stable pseudonym of the same length, so value
+        sizes and cardinalities are kept.
+        """
+        record = {}
+        for (key, value) in data.items():
+            if key in self.redact and value:
+                digest = hashlib.sha1(value.encode()).hexdigest()
+                value = (digest * (len(value) // len(digest) + 1))[:len(value)]
+            elif "discord" in value:
+                value = self.WEBHOOK_PATTERN.sub(self.WEBHOOK_REDACTED, value)
+            record["NOTIFY_" + key] = value
+        return record
+
+    def size(self) -> int:
+        """Get the size of the corpus in bytes"""
+        total = 0
+        for (root, _, files) in os.walk(self.directory):
+            for name in files:
+                try:
+                    total += os.stat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+        return total
+
+    def path(self, data: Dict[str, str]) -> str:
+        """Get the corpus file of a stripped notification context"""
+        what = "host" if data.get("WHAT") == "HOST" else "service"
+        state = data.get("HOSTSTATE") if what == "host" else data.get("SERVICESTATE")
+        name = "%s_%s" % (data.get("NOTIFICATIONTYPE") or "", state or "")
+        name = re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+        return os.path.join(self.directory, self.version, what, (name or "unknown") + ".ndjson.gz")
+
+    def record(self, data: Dict[str, str]) -> None:
+        """Append a stripped context to the corpus for 1 in sample invocations
+
+        Recording never fails the notification.
+        """
+        if random.random() * self.sample >= 1:
+            return
+        import gzip
+
+        try:
+            chunk = gzip.compress((json.dumps(self.redacted(data), sort_keys=True) + "\n").encode())
+            if self.size() + len(chunk) > self.max_bytes:
+                return
+            path = self.path(data)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Every record is a gzip member of its own, so concurrent invocations can append
+            with open(path, "ab") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(chunk)
+        except (OSError, ValueError):
+            pass
+
+
+def read_notifications(paths: List[str]) -> Iterator[dict]:
+    """Stream notification contexts from NDJSON files or Checkmk spool files
+
+    Directories are read as Checkmk notification spools (one Python literal
+    per file, oldest first) and "-" is NDJSON on stdin. A Python list literal,
+    like Checkmk's notify/backlog.mk, is read oldest first too. Records are
+    yielded one at a time with their NOTIFY_ prefixes stripped.
+    """
+    for path in paths:
+        if path == "-":
+            lines = (json.loads(line) for line in sys.stdin if line.strip())
+        elif os.path.isdir(path):
+            entries = sorted(
+                (entry for entry in os.scandir(path) if entry.is_file()),
+                key=lambda entry: (entry.stat().st_mtime_ns, entry.name),
+            )
+            lines = (record for entry in entries for record in _read_spool_file(entry.path))
+        elif path.endswith(".gz"):
+            lines = _read_ndjson_file(path)
+        else:
+            with open(path, "r") as f:
+                first = f.readline()
+            try:
+                ndjson = isinstance(json.loads(first), dict)
+            except ValueError:
+                ndjson = False
+            lines = _read_ndjson_file(path) if ndjson else _read_spool_file(path)
+
+        for record in lines:
+            if "context" in record and isinstance(record["context"], dict):
+                if record.get("plugin") not in (None, "cmk_discord", "cmk_discord.py"):
+                    continue
+                record = record["context"]
+            yield {(key[7:] if key.startswith("NOTIFY_") else key): value for (key, value) in record.items()}
+
+
+def _read_ndjson_file(path: str) -> Iterator[dict]:
+    if path.endswith(".gz"):
+        import gzip
+
+        opener = gzip.open
+    else:
+        opener = open
+    with opener(path, "rt") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _read_spool_file(path: str) -> Iterator[dict]:
+    import ast
+
+    with open(path, "r") as f:
+        literal = ast.literal_eval(f.read())
+    if isinstance(literal, list):
+        # The backlog is stored newest first
+        yield from reversed(literal)
+    else:
+        yield literal
+
+
+def _render_chunk(records: List[dict]) -> List[tuple]:
+    """Render a chunk of notifications to (context, embed, error) in a worker process"""
+    rendered = []
+    for data in records:
+        try:
+            ctx = Context.from_dict(data)
+            ctx.validate()
+            rendered.append((ctx, Embed.from_context(ctx), None))
+        except (Exception, SystemExit) as e:
+            rendered.append((None, None, "%s: %s" % (type(e).__name__, e)))
+    return rendered
+
+
+class Pacer:
+    """Token bucket spacing requests to at most rate per second"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.interval = 0.0
+        self.burst = burst
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: float) -> None:
+        """Change the rate, 0 for no limit"""
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+
+    def wait(self) -> None:
+        """Block until the next request may be sent"""
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.next_time = max(self.next_time, now - self.interval * (self.burst - 1))
+            delay = self.next_time - now
+            self.next_time += self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ConcurrencyLimiter:
+    """AIMD limit on the number of concurrent sends
+
+    The limit grows by one per limit successful sends (additive increase)
+    while latency stays below latency_spike times its moving average, and is
+    multiplied by decrease on a rate limit, server error, failed send or
+    latency spike (multiplicative decrease), at most once per round trip.
+    """
+
+    def __init__(self, maximum: int, minimum: int = 1, initial: Optional[int] = None, decrease: float = 0.5,
+                 latency_spike: float = 2.0, clock: Callable[[], float] = time.monotonic):
+        self.maximum = max(maximum, 1)
+        self.minimum = max(min(minimum, self.maximum), 1)
+        self.limit = float(min(max(initial or self.minimum, self.minimum), self.maximum))
+        self.decrease = decrease
+        self.latency_spike = latency_spike
+        self.clock = clock
+        self.inflight = 0
+        self.baseline: Optional[float] = None
+        self.last_decrease = float("-inf")
+        self.increases = 0
+        self.decreases = 0
+        self.condition = threading.Condition()
+
+    @classmethod
+    def from_config(cls, config: "Config", maximum: int) -> Optional["ConcurrencyLimiter"]:
+        """Create the limiter if it is configured"""
+        section = config.section("adaptive_concurrency")
+        if not section:
+            return None
+        return cls(
+            maximum,
+            minimum=section.get("min", 1),
+            initial=section.get("initial"),
+            decrease=section.get("decrease", 0.5),
+            latency_spike=section.get("latency_spike", 2.0),
+        )
+
+    @staticmethod
+    def overloaded(sent: bool, response) -> bool:
+        """Check whether a send signals overload (rate limit, server error or no answer)"""
+        if sent:
+            return False
+        if response is None:
+            return True
+        return response.status_code == HTTPStatus.TOO_MANY_REQUESTS.value or response.status_code >= 500
+
+    def acquire(self) -> None:
+        """Block until a send may start"""
+        with self.condition:
+            while self.inflight >= int(self.limit):
+                self.condition.wait()
+            self.inflight += 1
+
+    def release(self, latency: float, overloaded: bool = False) -> None:
+        """Finish a send and adapt the limit to its outcome"""
+        with self.condition:
+            self.inflight -= 1
+            now = self.clock()
+            spike = self.baseline is not None and latency > self.latency_spike * self.baseline
+            if overloaded or spike:
+                if now - self.last_decrease >= (self.baseline or latency):
+                    self.limit = max(self.limit * self.decrease, self.minimum)
+                    self.last_decrease = now
+                    self.decreases += 1
+            else:
+                self.limit = min(self.limit + 1 / self.limit, self.maximum)
+                self.increases += 1
+                self.baseline = latency if self.baseline is None else 0.9 * self.baseline + 0.1 * latency
+            self.condition.notify_all()
+
+    def stats(self) -> dict:
+        """Get the current limit and its history"""
+        with self.condition:
+            return {
+                "limit": int(self.limit),
+                "inflight": self.inflight,
+                "baseline_latency": None if self.baseline is None else round(self.baseline, 3),
+                "increases": self.increases,
+                "decreases": self.decreases,
+            }
+
+
+class Batcher:
+    """Adaptive batching of embeds into webhook messages
+
+    An embed is sent right away when nothing is in flight to its webhook.
+    While requests are in flight, or the rate-limit budget of the webhook is
+    low, embeds accumulate and are packed into messages of up to 10 embeds
+    and 6000 characters. The number of embeds that makes a message worth
+    sending next to one in flight grows while the observed latency is above
+    the target and shrinks while it is well below. The clock is injectable so
+    the same logic runs in simulated time (scripts/simulate.py).
+
+    With max_bytes, add() blocks while the waiting embeds exceed that many
+    (estimated) bytes; an embed is always accepted when none is waiting.
+    """
+
+    MAX_EMBEDS = 10
+    MAX_CHARS = 6000
+    # Estimated bytes of a waiting embed besides its characters
+    EMBED_BYTES = 1024
+
+    def __init__(self, max_delay: float = 2.0, target_latency: float = 0.5, low_budget: int = 1,
+                 max_inflight: int = 1, pacer: Optional[Pacer] = None,
+                 limiter: Optional[ConcurrencyLimiter] = None, clock: Callable[[], float] = time.monotonic,
+                 max_bytes: Optional[int] = None):
+        self.max_delay = max_delay
+        self.target_latency = target_latency
+        self.low_budget = low_budget
+        self.max_inflight = max(max_inflight, 1)
+        self.pacer = pacer
+        self.limiter = limiter
+        self.clock = clock
+        self.size = 1
+        self.latency: Optional[float] = None
+        # (url, site) -> deque of (embed, characters, added, callback)
+        self.pending: Dict[tuple, deque] = {}
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.inflight: Dict[tuple, int] = {}
+        # id -> batch of the messages in flight
+        self.sending: Dict[int, list] = {}
+        # url -> (remaining, reset time)
+        self.budgets: Dict[str, tuple] = {}
+        self.requests = 0
+        self.embeds = 0
+        self.served: Dict[str, int] = {}  # site -> request count when it was last served
+        self.flushing = False
+        self.condition = threading.Condition()
+        self.threads: List[threading.Thread] = []
+
+    @classmethod
+    def from_config(cls, config: "Config", pacer: Optional[Pacer] = None,
+                    limiter: Optional[ConcurrencyLimiter] = None) -> Optional["Batcher"]:
+        """Create the batcher if it is configured"""
+        section = config.section("batching")
+        if not section:
+            return None
+        return cls(
+            max_delay=section.get("max_delay", 2.0),
+            target_latency=section.get("target_latency", 0.5),
+            low_budget=section.get("low_budget", 1),
+            max_inflight=section.get("max_inflight", 1),
+            pacer=pacer,
+            limiter=limiter,
+            max_bytes=int(config.section("memory").get("queue_bytes", 16 * 1024 * 1024)),
+        )
+
+    @staticmethod
+    def characters(embed: dict) -> int:
+        """Count the characters of an embed towards the limit of a message"""
+        count = len(embed.get("title") or "") + len(embed.get("description") or "")
+        count += len((embed.get("footer") or {}).get("text") or "") + len((embed.get("author") or {}).get("name") or "")
+        for field in embed.get("fields") or []:
+            count += len(field.get("name") or "") + len(field.get("value") or "")
+        return count
+
+    def add(self, url: str, site_name: str, embed: dict, callback: Optional[Callable] = None) -> None:
+        """Queue an embed, callback(sent, response) is called once its message was sent or failed
+
+        Blocks while the waiting embeds are over the byte budget.
+        """
+        characters = self.characters(embed)
+        size = characters + self.EMBED_BYTES
+        with self.condition:
+            while self.max_bytes is not None and self.bytes and self.bytes + size > self.max_bytes:
+                self.condition.wait()
+            key = (url, site_name)
+            self.pending.setdefault(key, deque()).append((embed, characters, self.clock(), callback))
+            self.bytes += size
+            self.condition.notify_all()
+
+    def _ready(self, key: tuple, items: deque, now: float) -> bool:
+        """Check whether the embeds pending for a webhook should be sent now"""
+        inflight = self.inflight.get(key, 0)
+        if inflight >= self.max_inflight:
+            return False
+        remaining, reset = self.budgets.get(key[0], (None, 0))
+        if remaining is not None and reset > now:
+            if remaining <= 0:
+                return False
+            if remaining <= self.low_budget:
+                return self.flushing or self._full(items) or now - items[0][2] >= self.max_delay
+        if inflight == 0 or self.flushing:
+            return True
+        return len(items) >= self.size or now - items[0][2] >= self.max_delay
+
+    def _full(self, items: deque) -> bool:
+        """Check whether the pending embeds fill a message"""
+        if len(items) >= self.MAX_EMBEDS:
+            return True
+        return sum(item[1] for item in items) >= self.MAX_CHARS
+
+    def take(self) -> Optional[tuple]:
+        """Take the next message to send as (url, site, items), or None when nothing is ready"""
+        with self.condition:
+            now = self.clock()
+            ready = [
+                (self.served.get(key[1], -1), items[0][2], key)
+                for (key, items) in self.pending.items() if self._ready(key, items, now)
+            ]
+            if not ready:
+                return None
+            # Least recently served site first, so one site's storm cannot starve the others
+            key = min(ready)[2]
+            self.served[key[1]] = self.requests
+            items = self.pending[key]
+            batch = [items.popleft()]
+            characters = batch[0][1]
+            while items and len(batch) < self.MAX_EMBEDS and characters + items[0][1] <= self.MAX_CHARS:
+                characters += items[0][1]
+                batch.append(items.popleft())
+            if not items:
+                del self.pending[key]
+            self.bytes -= characters + len(batch) * self.EMBED_BYTES
+            self.inflight[key] = self.inflight.get(key, 0) + 1
+            self.sending[id(batch)] = batch
+            self.requests += 1
+            self.embeds += len(batch)
+            self.condition.notify_all()
+            return key[0], key[1], batch
+
+    def finish(self, url: str, site_name: str, batch: list, sent: bool, latency: float, response=None) -> None:
+        """Record the outcome of a message and call the callbacks of its embeds, unless abandoned"""
+        with self.condition:
+            abandoned = self.sending.pop(id(batch), None) is None
+            key = (url, site_name)
+            self.inflight[key] -= 1
+            if not self.inflight[key]:
+                del self.inflight[key]
+            limit = rate_limit(response)
+            if limit is not None:
+                self.budgets[url] = (limit[0], self.clock() + limit[1])
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            if self.latency > self.target_latency or (limit is not None and limit[0] <= self.low_budget):
+                self.size = min(self.size + 1, self.MAX_EMBEDS)
+            elif self.latency < self.target_latency / 2:
+                self.size = max(self.size - 1, 1)
+            self.condition.notify_all()
+        if abandoned:
+            return
+        for (_, _, _, callback) in batch:
+            if callback is None:
+                continue
+            try:
+                callback(sent, response)
+            except Exception as e:
+                # Keep the sending thread alive for the other embeds
+                sys.stderr.write("Failed to record a sent embed: %s\n" % e)
+
+    def wakeup(self) -> Optional[float]:
+        """Get the clock time at which a waiting message may become ready, None when only a finish can help"""
+        with self.condition:
+            times = []
+            for key, items in self.pending.items():
+                if self.inflight.get(key, 0) >= self.max_inflight:
+                    continue
+                remaining, reset = self.budgets.get(key[0], (None, 0))
+                if remaining is not None and remaining <= 0 and reset > self.clock():
+                    times.append(reset)
+                else:
+                    times.append(items[0][2] + self.max_delay)
+            return min(times) if times else None
+
+    def _send(self, url: str, site_name: str, batch: list) -> None:
+        if self.pacer is not None:
+            self.pacer.wait()
+        webhook = DiscordWebhook(url, None, site_name, embeds=[item[0] for item in batch])
+        if self.limiter is not None:
+            self.limiter.acquire()
+        start = self.clock()
+        try:
+            webhook.send()
+            sent = True
+        except (Exception, SystemExit) as e:
+            sys.stderr.write("Failed to send %i embeds: %s\n" % (len(batch), e))
+            sent = False
+        latency = self.clock() - start
+        if self.limiter is not None:
+            self.limiter.release(latency, ConcurrencyLimiter.overloaded(sent, webhook.response))
+        self.finish(url, site_name, batch, sent, latency, webhook.response)
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                message = self.take()
+                while message is None:
+                    if self.flushing and not self.pending:
+                        return
+                    wakeup = self.wakeup()
+                    self.condition.wait(None if wakeup is None else max(wakeup - self.clock(), 0.001))
+                    message = self.take()
+            self._send(*message)
+
+    def start(self, threads: int = 1) -> None:
+        """Start sending on background threads"""
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(max(threads, 1))]
+        for thread in self.threads:
+            thread.start()
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Send everything pending right away and stop the threads"""
+        with self.condition:
+            self.flushing = True
+            self.condition.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+
+    def abandon(self) -> List[Callable]:
+        """Give up the embeds waiting or in flight, return their callbacks
+
+        Messages in flight no longer call the callbacks when they finish, so
+        the caller can call them exactly once, e.g. to persist the embeds.
+        """
+        with self.condition:
+            items = [item for items in self.pending.values() for item in items]
+            items += [item for batch in self.sending.values() for item in batch]
+            self.pending.clear()
+            self.sending.clear()
+            self.bytes = 0
+            self.condition.notify_all()
+        return [callback for (_, _, _, callback) in items if callback is not None]
+
+
+class BoundedQueue:
+    """FIFO queue bounded by the estimated size of its items in bytes
+
+    When the budget is reached, put() either blocks until consumers catch up
+    (backpressure) or, with a spill path, appends the item to a file on disk.
+    Spilled items are read back in order once the in-memory items are
+    consumed. A single item larger than the budget is always accepted when
+    the queue is empty, so nothing can deadlock.
+    """
+
+    def __init__(self, max_bytes: int, spill_path: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.spill_path = spill_path
+        self.items = deque()
+        self.bytes = 0
+        self.spilled = 0
+        self.condition = threading.Condition()
+        self._spill_writer = None
+        self._spill_reader = None
+
+    def __len__(self) -> int:
+        return len(self.items) + self.spilled
+
+    def put(self, item, size: int) -> None:
+        """Add an item, blocking or spilling while the queue is over budget"""
+        with self.condition:
+            if self.spilled or (self.items and self.bytes + size > self.max_bytes):
+                if self.spill_path is not None:
+                    self._spill(item)
+                    self.condition.notify()
+                    return
+                while self.items and self.bytes + size > self.max_bytes:
+                    self.condition.wait()
+            self.items.append((item, size))
+            self.bytes += size
+            self.condition.notify()
+
+    def get(self):
+        """Remove and return the oldest item, blocking while the queue is empty"""
+        with self.condition:
+            while not self.items and not self.spilled:
+                self.condition.wait()
+            if self.items:
+                item, size = self.items.popleft()
+                self.bytes -= size
+            else:
+                item = self._unspill()
+            self.condition.notify_all()
+            return item
+
+    def _spill(self, item) -> None:
+        import pickle
+
+        if self._spill_writer is None:
+            self._spill_writer = open(self.spill_path, "wb")
+            self._spill_reader = open(self.spill_path, "rb")
+        pickle.dump(item, self._spill_writer, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spill_writer.flush()
+        self.spilled += 1
+
+    def _unspill(self):
+        import pickle
+
+        item = pickle.load(self._spill_reader)
+        self.spilled -= 1
+        if not self.spilled:
+            self._spill_writer.close()
+            self._spill_reader.close()
+            self._spill_writer = self._spill_reader = None
+            os.unlink(self.spill_path)
+        return item
+
+
+class FairQueue:
+    """Queue serving its keys (OMD sites) round robin, bounded by estimated bytes
+
+    Items of one key stay in order. While the queue is over budget, put()
+    blocks only for keys holding more than their fair share of the budget,
+    so a storm of one site cannot keep the others from being queued or
+    served. A key with weight n is served n items per turn.
+    """
+
+    def __init__(self, max_bytes: int, weights: Optional[Dict[str, int]] = None):
+        self.max_bytes = max_bytes
+        self.weights = weights or {}
+        self.queues: Dict[Optional[str], deque] = {}
+        self.key_bytes: Dict[Optional[str], int] = {}
+        self.turns = deque()
+        self.served = 0
+        self.bytes = 0
+        self.condition = threading.Condition()
+
+    def __len__(self) -> int:
+        return sum(len(items) for items in self.queues.values())
+
+    def _over_share(self, key: Optional[str], size: int) -> bool:
+        if self.bytes + size <= self.max_bytes or not self.key_bytes.get(key):
+            return False
+        return self.key_bytes[key] + size > self.max_bytes // max(len(self.queues), 1)
+
+    def put(self, item, size: int, key: Optional[str] = None) -> None:
+        """Add an item of a key, blocking while the key is over its share of the budget"""
+        with self.condition:
+            while self._over_share(key, size):
+                self.condition.wait()
+            if key not in self.queues:
+                self.queues[key] = deque()
+                self.key_bytes[key] = 0
+                self.turns.append(key)
+            self.queues[key].append((item, size))
+            self.key_bytes[key] += size
+            self.bytes += size
+            self.condition.notify_all()
+
+    def get(self):
+        """Remove and return the next item in round-robin order, blocking while the queue is empty"""
+        with self.condition:
+            while not self.turns:
+                self.condition.wait()
+            key = self.turns[0]
+            items = self.queues[key]
+            item, size = items.popleft()
+            self.key_bytes[key] -= size
+            self.bytes -= size
+            self.served += 1
+            if not items:
+                del self.queues[key], self.key_bytes[key]
+                self.turns.popleft()
+                self.served = 0
+            elif self.served >= self.weights.get(key, 1):
+                self.turns.rotate(-1)
+                self.served = 0
+            self.condition.notify_all()
+            return item
+
+
+class RetryQueue:
+    """Notifications waiting for another delivery attempt, in an NDJSON file
+
+    Each line holds the Context attributes, the routed webhooks still to
+    deliver to (null for all of them), the number of failed attempts and the
+    time the next attempt is due. The delay doubles with every failed
+    attempt, from interval up to max_interval; a notification is dropped
+    once it failed attempts times. Lines of plain Context attributes, as
+    persisted by earlier versions, are due at once.
+    """
+
+    def __init__(self, path: str, interval: float = 10.0, max_interval: float = 600.0, attempts: int = 10):
+        self.path = path
+        self.interval = interval
+        self.max_interval = max_interval
+        self.attempts = max(attempts, 1)
+        # Earliest due time of the notifications added since the last take()
+        self.due: Optional[float] = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: "Config", path: str, attempts: int = 10) -> "RetryQueue":
+        """Create the retry queue with the configured backoff"""
+        section = config.section("retry")
+        return cls(
+            path,
+            interval=section.get("interval", 10.0),
+            max_interval=section.get("max_interval", 600.0),
+            attempts=section.get("attempts", attempts),
+        )
+
+    def delay(self, attempt: int) -> float:
+        """Get the delay of the next attempt after attempt failed ones"""
+        return min(self.interval * 2 ** max(attempt - 1, 0), self.max_interval)
+
+    def add(self, ctx: Context, routes: Optional[List[str]] = None, attempt: int = 0,
+            due: Optional[float] = None) -> bool:
+        """Queue a notification that failed attempt times, return False when it is dropped instead"""
+        if attempt >= self.attempts:
+            sys.stderr.write("Dropping notification for %s after %i failed attempts\n" % (ctx.hostname, attempt))
+            return False
+        if due is None:
+            due = time.time() + self.delay(attempt) if attempt else time.time()
+        self._append({"context": asdict(ctx), "routes": routes, "attempt": attempt, "due": due})
+        return True
+
+    def _append(self, entry: dict) -> None:
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            self.due = entry["due"] if self.due is None else min(self.due, entry["due"])
+
+    def take(self, now: Optional[float] = None) -> Iterator[tuple]:
+        """Take the notifications due at now (all of them when None) as (context, routes, attempt)
+
+        The file is moved aside while it is read, by one caller at a time.
+        Notifications that are not due yet are queued again; a file left by
+        an interrupted take is read first.
+        """
+        taken = self.path + ".taken"
+        with self.lock:
+            if os.path.exists(self.path):
+                if os.path.exists(taken):
+                    import shutil
+
+                    with open(self.path, "r") as f, open(taken, "a") as target:
+                        shutil.copyfileobj(f, target)
+                    os.unlink(self.path)
+                else:
+                    os.replace(self.path, taken)
+            elif not os.path.exists(taken):
+                return
+            self.due = None
+        with open(taken, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if "context" not in entry:
+                    entry = {"context": entry, "due": 0}
+                if now is not None and entry.get("due", 0) > now:
+                    self._append(entry)
+                    continue
+                yield Context.from_fields(entry["context"]), entry.get("routes"), entry.get("attempt", 0)
+        os.unlink(taken)
+
+
+class BatchSender:
+    """Deliver a stream of notifications with paced, concurrent sends
+
+    Rendering runs on a process pool in chunks, with a bounded number of
+    chunks in flight. Sends run on worker threads, each with a queue bounded
+    by its share of the memory budget ("memory" configuration section);
+    notifications of a host always go to the same worker, so they are
+    delivered in order. Memory stays constant whatever the input size.
+    Notifications are counted once all their routes finished, also when
+    batched; routes that failed are retried from a file in the state
+    directory after the input was sent, up to 3 attempts by default.
+    """
+
+    def __init__(self, config: "Config", processes: int = 0, concurrency: int = 4,
+                 rate: float = 5.0, chunk_size: int = 64, webhook_url: Optional[str] = None):
+        self.config = config
+        self.processes = processes
+        self.concurrency = max(concurrency, 1)
+        self.pacer = Pacer(rate, burst=self.concurrency)
+        self.chunk_size = chunk_size
+        self.webhook_url = webhook_url
+        memory = config.section("memory")
+        self.queue_bytes = int(memory.get("queue_bytes", 16 * 1024 * 1024))
+        self.spill = memory.get("overflow", "block") == "spill"
+        self.limiter = ConcurrencyLimiter.from_config(config, self.concurrency)
+        self.batcher = Batcher.from_config(config, self.pacer, self.limiter)
+        self.retry: Optional[RetryQueue] = None
+        self.sent = 0
+        self.failed = 0
+        self.outstanding = 0
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+
+    def _chunks(self, records: Iterable[dict]) -> Iterator[List[dict]]:
+        chunk = []
+        for data in records:
+            if self.webhook_url and not data.get("PARAMETER_1"):
+                data["PARAMETER_1"] = self.webhook_url
+            chunk.append(data)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _rendered(self, records: Iterable[dict]) -> Iterator[tuple]:
+        """Render the notifications, in order, on the process pool if configured"""
+        if self.processes <= 0:
+            for chunk in self._chunks(records):
+                yield from _render_chunk(chunk)
+            return
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(self.processes) as executor:
+            pending = deque()
+            for chunk in self._chunks(records):
+                pending.append(executor.submit(_render_chunk, chunk))
+                if len(pending) >= 2 * self.processes:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def _worker(self, queue) -> None:
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            ctx, embed, routes, attempt = item
+            limiter = self.limiter if self.batcher is None else None
+            if self.batcher is None:
+                self.pacer.wait()
+            if limiter is not None:
+                limiter.acquire()
+            start = time.monotonic()
+            try:
+                deliver(ctx, self.config, embed, self.batcher, routes=routes,
+                        done=lambda outcomes, item=item, start=start, limiter=limiter:
+                        self._finished(item, start, limiter, outcomes))
+            except (Exception, SystemExit) as e:
+                sys.stderr.write("Failed to send notification for %s: %s\n" % (ctx.hostname, e))
+                self._finished(item, start, limiter, None)
+
+    def _finished(self, item: tuple, start: float, limiter: Optional[ConcurrencyLimiter],
+                  outcomes: Optional[list]) -> None:
+        """Count a finished delivery or queue its failed routes for a retry (all of them when outcomes is None)"""
+        ctx, _, routes, attempt = item
+        failed = routes if outcomes is None else [route for (route, sent, _) in outcomes if not sent]
+        ok = outcomes is not None and not failed
+        if limiter is not None:
+            limiter.release(time.monotonic() - start, outcomes is None or any(
+                ConcurrencyLimiter.overloaded(sent, response) for (_, sent, response) in outcomes))
+        retried = not ok and self.retry.add(ctx, failed, attempt + 1)
+        with self.idle:
+            if ok:
+                self.sent += 1
+            elif not retried:
+                self.failed += 1
+            self.outstanding -= 1
+            self.idle.notify_all()
+
+    def _put(self, queues: list, item: tuple) -> None:
+        ctx = item[0]
+        with self.lock:
+            self.outstanding += 1
+        shard = int(hashlib.sha1(("%s/%s" % (ctx.omd_site, ctx.hostname)).encode()).hexdigest()[:8], 16)
+        queues[shard % self.concurrency].put(item, ctx.estimate_size())
+
+    def _retry(self, queues: list) -> None:
+        """Send the failed notifications again when due, until none is left"""
+        while True:
+            with self.idle:
+                while self.outstanding:
+                    self.idle.wait()
+            if self.retry.due is None:
+                return
+            time.sleep(max(self.retry.due - time.time(), 0))
+            for ctx, routes, attempt in self.retry.take(time.time()):
+                self._put(queues, (ctx, None, routes, attempt))
+
+    def run(self, records: Iterable[dict]) -> None:
+        """Deliver all notifications, returning when all sends finished"""
+        self.send(self._rendered(records))
+
+    def send(self, rendered: Iterable[tuple]) -> None:
+        """Deliver rendered (context, embed, error) notifications, returning when all sends finished"""
+        spill_dir = get_state_dir("spill", str(os.getpid())) if self.spill else None
+        self.retry = RetryQueue.from_config(
+            self.config, os.path.join(get_state_dir("retry"), "%i.ndjson" % os.getpid()), attempts=3)
+        queues = [
+            BoundedQueue(
+                self.queue_bytes // self.concurrency,
+                spill_path=os.path.join(spill_dir, "%i.pickle" % i) if spill_dir else None,
+            )
+            for i in range(self.concurrency)
+        ]
+        workers = [threading.Thread(target=self._worker, args=(q,), daemon=True) for q in queues]
+        for worker in workers:
+            worker.start()
+        if self.batcher is not None:
+            self.batcher.start(self.concurrency)
+        try:
+            for ctx, embed, error in rendered:
+                if error is not None:
+                    sys.stderr.write("Skipping invalid notification: %s\n" % error)
+                    with self.lock:
+                        self.failed += 1
+                    continue
+                self._put(queues, (ctx, embed, None, 0))
+            self._retry(queues)
+        finally:
+            for q in queues:
+                q.put(None, 0)
+            for worker in workers:
+                worker.join()
+            if self.batcher is not None:
+                self.batcher.close()
+            if spill_dir:
+                os.rmdir(spill_dir)
+
+
+class Dispatcher:
+    """Resident dispatcher delivering the notifications forwarded to it
+
+    The notification script forwards each notification as an NDJSON line of
+    Context attributes on a Unix socket; it is acknowledged once queued.
+    Notifications of a host are queued to the same worker, keeping their
+    order. Routes that failed are retried with backoff from the retry queue
+    (pending.ndjson in the state directory); a due backlog above the
+    catch-up threshold is collapsed into per-host summaries. SIGHUP reloads
+    the configuration and swaps it in atomically (an invalid configuration
+    keeps the current one); see reload() for the settings that need a
+    restart instead. SIGTERM stops accepting, lets in-flight sends
+    finish within the drain timeout and persists everything else to the
+    retry queue, which the next dispatcher sends first.
+    """
+
+    def __init__(self, socket_path: str, config_path: Optional[str] = None, concurrency: int = 4,
+                 drain_timeout: float = 10.0):
+        self.socket_path = socket_path
+        self.config_path = config_path
+        self.config = Config.load(config_path)
+        self.concurrency = max(concurrency, 1)
+        self.drain_timeout = drain_timeout
+        section = self.config.section("dispatcher")
+        self.pacer = Pacer(section.get("rate", 5.0), burst=self.concurrency)
+        self.limiter = ConcurrencyLimiter.from_config(self.config, self.concurrency)
+        self.batcher = Batcher.from_config(self.config, self.pacer, self.limiter)
+        queue_bytes = int(self.config.section("memory").get("queue_bytes", 16 * 1024 * 1024))
+        self.queues = [FairQueue(queue_bytes // self.concurrency, section.get("weights"))
+                       for _ in range(self.concurrency)]
+        # Deliveries started but not finished: number -> (context, routes, failed attempts)
+        self.delivering: Dict[int, tuple] = {}
+        self.deliveries = 0
+        self.leftover: List[tuple] = []
+        self.pending_path = os.path.join(get_state_dir(), "pending.ndjson")
+        self.retry = RetryQueue.from_config(self.config, self.pending_path)
+        self.stats = {"received": 0, "sent": 0, "failed": 0, "dropped": 0, "reloads": 0, "persisted": 0}
+        self.sites: Dict[str, int] = {}
+        self.socket_mode = int(str(section.get("socket_mode", "0600")), 8)
+        self.socket_group = section.get("socket_group")
+        self.lock = threading.Lock()
+        self.draining = False
+        self.stopped = threading.Event()
+        self.server = None
+        self.workers: List[threading.Thread] = []
+        self.retrier: Optional[threading.Thread] = None
+
+    def get_stats(self) -> dict:
+        """Get the counters, with the current concurrency limit when it is adaptive"""
+        stats = dict(self.stats)
+        if self.limiter is not None:
+            stats["concurrency"] = self.limiter.stats()
+        return stats
+
+    def _count(self, name: str) -> None:
+        with self.lock:
+            self.stats[name] += 1
+
+    def submit(self, ctx: Context, embed: Optional[Embed] = None, routes: Optional[List[str]] = None,
+               attempt: int = 0) -> None:
+        """Queue a notification for delivery, to the given routes only when retrying after attempt failures"""
+        shard = int(hashlib.sha1(("%s/%s" % (ctx.omd_site, ctx.hostname)).encode()).hexdigest()[:8], 16)
+        self.queues[shard % self.concurrency].put((ctx, embed, routes, attempt), ctx.estimate_size(), ctx.omd_site)
+        self._count("received")
+        with self.lock:
+            self.sites[ctx.omd_site] = self.sites.get(ctx.omd_site, 0) + 1
+
+    def _worker(self, index: int) -> None:
+        queue = self.queues[index]
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            if self.draining:
+                self.leftover.append(item)
+                return
+            ctx, embed, routes, attempt = item
+            with self.lock:
+                self.deliveries += 1
+                number = self.deliveries
+                self.delivering[number] = (ctx, routes, attempt)
+            limiter = self.limiter if self.batcher is None else None
+            if self.batcher is None:
+                self.pacer.wait()
+            if limiter is not None:
+                limiter.acquire()
+            start = time.monotonic()
+            try:
+                deliver(ctx, self.config, embed, self.batcher, routes=routes,
+                        done=lambda outcomes, number=number, start=start, limiter=limiter:
+                        self._finished(number, start, limiter, outcomes))
+            except (Exception, SystemExit) as e:
+                sys.stderr.write("Failed to send notification for %s: %s\n" % (ctx.hostname, e))
+                self._finished(number, start, limiter, None)
+
+    def _finished(self, number: int, start: float, limiter: Optional[ConcurrencyLimiter],
+                  outcomes: Optional[list]) -> None:
+        """Count a finished delivery and queue its failed routes for a retry (all of them when outcomes is None)"""
+        with self.lock:
+            delivery = self.delivering.pop(number, None)
+        if delivery is None:
+            # Persisted by drain() meanwhile
+            return
+        ctx, routes, attempt = delivery
+        failed = routes if outcomes is None else [route for (route, sent, _) in outcomes if not sent]
+        ok = outcomes is not None and not failed
+        if limiter is not None:
+            limiter.release(time.monotonic() - start, outcomes is None or any(
+                ConcurrencyLimiter.overloaded(sent, response) for (_, sent, response) in outcomes))
+        if ok:
+            self._count("sent")
+        elif self.draining:
+            self.retry.add(ctx, failed, attempt, due=0)
+            self._count("persisted")
+        else:
+            self._count("failed")
+            if not self.retry.add(ctx, failed, attempt + 1):
+                self._count("dropped")
+
+    def _serve_connection(self, connection) -> None:
+        with connection, connection.makefile("rwb") as stream:
+            for line in stream:
+                if not line.strip():
+                    continue
+                if line.strip() == b"stats":
+                    stream.write(json.dumps(self.get_stats()).encode() + b"\n")
+                    stream.flush()
+                    continue
+                try:
+                    ctx = Context.from_fields(json.loads(line))
+                    # Other users may reach the socket, so only Discord webhooks are accepted
+                    problem = ctx.problem()
+                    if problem is not None:
+                        raise ValueError(problem)
+                    self.submit(ctx)
+                    stream.write(b"ok\n")
+                except (TypeError, ValueError) as e:
+                    stream.write(("error %s\n" % e).encode())
+                stream.flush()
+
+    def _accept(self) -> None:
+        while not self.draining:
+            try:
+                connection, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            if self.draining:
+                connection.close()
+                return
+            threading.Thread(target=self._serve_connection, args=(connection,), daemon=True).start()
+
+    def _resubmit(self, pending: Iterator[tuple]) -> None:
+        """Submit notifications taken from the retry queue, as catch-up summaries when there are too many"""
+        catch_up = CatchUp.from_config(self.config)
+        exceeded = False
+        if catch_up is not None:
+            exceeded, pending = catch_up.exceeded(pending)
+        if exceeded:
+            # Summaries only go to the routes that failed for their notifications
+            groups: Dict[Optional[tuple], List[Context]] = {}
+            for (ctx, routes, _) in pending:
+                groups.setdefault(tuple(routes) if routes else None, []).append(ctx)
+            pending = ((ctx, embed, list(routes) if routes else None, 0)
+                       for (routes, contexts) in groups.items() for (ctx, embed) in catch_up.collapse(contexts))
+        else:
+            pending = ((ctx, None, routes, attempt) for (ctx, routes, attempt) in pending)
+        for ctx, embed, routes, attempt in pending:
+            if self.draining:
+                # Sent first by the next dispatcher
+                self.retry.add(ctx, routes, attempt, due=0)
+            else:
+                self.submit(ctx, embed, routes, attempt)
+
+    def _retry(self) -> None:
+        """Submit the notifications whose next attempt is due until draining"""
+        while not self.stopped.wait(min(self.retry.interval, 1.0)) and not self.draining:
+            if self.retry.due is not None and self.retry.due <= time.time():
+                self._resubmit(self.retry.take(time.time()))
+
+    def start(self) -> None:
+        """Start the workers, send the persisted notifications and start accepting"""
+        self.workers = [threading.Thread(target=self._worker, args=(i,), daemon=True)
+                        for i in range(self.concurrency)]
+        for worker in self.workers:
+            worker.start()
+        if self.batcher is not None:
+            self.batcher.start(self.concurrency)
+        self._resubmit(self.retry.take())
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        if self.socket_group:
+            import grp
+
+            os.chown(self.socket_path, -1, grp.getgrnam(self.socket_group).gr_gid)
+        os.chmod(self.socket_path, self.socket_mode)
+        self.server.listen(128)
+        self.server.settimeout(0.2)
+        threading.Thread(target=self._accept, daemon=True).start()
+        self.retrier = threading.Thread(target=self._retry, daemon=True)
+        self.retrier.start()
+
+    def reload(self) -> bool:
+        """Load and compile the configuration, then swap it in
+
+        The stages, routes, templates, dispatcher rate and weights, retry
+        backoff and webhook timeout take effect. The queue and batching
+        budgets (memory, batching), the adaptive concurrency limit and the
+        DNS cache keep their settings until a restart.
+        """
+        try:
+            config = Config.load(self.config_path)
+            config.router
+            config.pools
+            retry = RetryQueue.from_config(config, self.pending_path)
+        except (Exception, SystemExit) as e:
+            sys.stderr.write("Keeping the current configuration: %s\n" % e)
+            return False
+        self.config = config
+        section = config.section("dispatcher")
+        self.pacer.set_rate(section.get("rate", 5.0))
+        for queue in self.queues:
+            queue.weights = section.get("weights") or {}
+        with self.retry.lock:
+            self.retry.interval, self.retry.max_interval, self.retry.attempts = (
+                retry.interval, retry.max_interval, retry.attempts)
+        DiscordWebhook.configure(config)
+        self._count("reloads")
+        return True
+
+    def drain(self) -> int:
+        """Stop accepting, wait for in-flight sends and persist the rest, return the number persisted"""
+        self.draining = True
+        self.stopped.set()
+        with self.lock:
+            persisted = self.stats["persisted"]
+        if self.server is not None:
+            self.server.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        for queue in self.queues:
+            queue.put(None, 0)
+        deadline = time.monotonic() + self.drain_timeout
+        for worker in self.workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+        if self.batcher is not None:
+            self.batcher.close(max(deadline - time.monotonic(), 0))
+            # Persisted through the callbacks of their deliveries
+            for callback in self.batcher.abandon():
+                callback(None, None)
+        if self.retrier is not None:
+            self.retrier.join(max(deadline - time.monotonic(), 0))
+
+        with self.lock:
+            remaining = list(self.delivering.values())
+            self.delivering.clear()
+        items = list(self.leftover)
+        for queue in self.queues:
+            while len(queue):
+                items.append(queue.get())
+        remaining += [(item[0], item[2], item[3]) for item in items if item is not None]
+        for ctx, routes, attempt in remaining:
+            self.retry.add(ctx, routes, attempt, due=0)
+        with self.lock:
+            self.stats["persisted"] += len(remaining)
+            return self.stats["persisted"] - persisted
+
+    def serve_forever(self) -> None:
+        """Run until SIGTERM or SIGINT, reloading on SIGHUP"""
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload())
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stopped.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stopped.set())
+        DiscordWebhook.session = requests.Session()
+        self.start()
+        while not self.stopped.wait(1):
+            pass
+        persisted = self.drain()
+        sys.stderr.write("Dispatcher stopped: %s, received per site %s, %i persisted\n" % (
+            self.get_stats(), self.sites, persisted))
+
+
+def forward(ctx: Context, socket_path: str, timeout: float = 5.0) -> bool:
+    """Forward a notification to the dispatcher, return whether it was accepted"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(timeout)
+            connection.connect(os.path.expanduser(socket_path))
+            connection.sendall(json.dumps(asdict(ctx)).encode() + b"\n")
+            connection.shutdown(socket.SHUT_WR)
+            return connection.recv(64).startswith(b"ok")
+    except OSError:
+        return False
+
+
+def stats(args) -> int:
+    """Print the counters of the running dispatcher"""
+    socket_path = os.path.expanduser(args.socket or Config.load().section("dispatcher").get("socket")
+                                     or "~/tmp/run/cmk_discord.sock")
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(5)
+            connection.connect(socket_path)
+            connection.sendall(b"stats\n")
+            connection.shutdown(socket.SHUT_WR)
+            with connection.makefile("rb") as stream:
+                print(json.dumps(json.loads(stream.readline()), indent=2))
+    except (OSError, ValueError) as e:
+        sys.stderr.write("Dispatcher not reachable on %s: %s\n" % (socket_path, e))
+        return 1
+    return 0
+
+
+def serve(args) -> int:
+    """Run the resident dispatcher"""
+    config = Config.load()
+    DiscordWebhook.configure(config)
+    socket_path = os.path.expanduser(args.socket or config.section("dispatcher").get("socket")
+                                     or "~/tmp/run/cmk_discord.sock")
+    dispatcher = Dispatcher(socket_path, concurrency=args.concurrency, drain_timeout=args.drain_timeout)
+    with DnsCache.from_config(config) or nullcontext():
+        dispatcher.serve_forever()
+    return 0
+
+
+def batch(args) -> int:
+    """Deliver notifications from spool files or NDJSON streams"""
+    config = Config.load()
+    DiscordWebhook.configure(config)
+    sender = BatchSender(
+        config,
+        processes=args.processes,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        webhook_url=args.webhook,
+    )
+    records = read_notifications(args.paths or ["-"])
+    catch_up = CatchUp.from_config(config)
+    exceeded = False
+    if catch_up is not None:
+        exceeded, records = catch_up.exceeded(records)
+
+    def contexts() -> Iterator[Context]:
+        for data in records:
+            if args.webhook and not data.get("PARAMETER_1"):
+                data["PARAMETER_1"] = args.webhook
+            try:
+                ctx = Context.from_dict(data)
+                ctx.validate()
+            except (Exception, SystemExit) as e:
+                sys.stderr.write("Skipping invalid notification: %s\n" % e)
+                sender.failed += 1
+                continue
+            yield ctx
+
+    with DnsCache.from_config(config) or nullcontext():
+        if exceeded:
+            sys.stderr.write("Backlog exceeds %i notifications, sending per-host summaries\n" % catch_up.threshold)
+            sender.send((ctx, embed, None) for (ctx, embed) in catch_up.collapse(contexts()))
+        else:
+            sender.run(records)
+    sys.stderr.write("Sent %i notifications, %i failed\n" % (sender.sent, sender.failed))
+    if sender.limiter is not None:
+        sys.stderr.write("Concurrency: %s\n" % sender.limiter.stats())
+    return 1 if sender.failed else 0
+
+
+def duration(text: str) -> int:
+    """Parse a duration like 90, 15m, 6h or 7d to seconds"""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def timestamp(text: str) -> float:
+    """Parse a local date and time like 2026-10-19 or 2026-10-19 02:00 to a timestamp"""
+    return datetime.datetime.fromisoformat(text).timestamp()
+
+
+def latency(args) -> int:
+    """Print delivery delay percentiles over time"""
+    histogram = LatencyHistogram.from_config(Config.load()) or LatencyHistogram()
+    rows = histogram.query(site=args.site, url=args.webhook, since=args.since, interval=args.interval)
+    print("%-16s %8s %9s %9s %9s %9s" % ("time", "count", "p50", "p90", "p99", "max"))
+    for (start, count, *delays) in rows:
+        print("%-16s %8i %s" % (
+            datetime.datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M"), count,
+            " ".join("%8.2fs" % delay for delay in delays),
+        ))
+    return 0
+
+
+def history(args) -> int:
+    """Print the sent notifications matching the query, newest first"""
+    store = History.from_config(Config.load()) or History()
+    start = time.perf_counter()
+    since = args.since
+    if args.start is not None:
+        since = (time.time() if args.until is None else args.until) - args.start
+    records = store.query(host=args.host, service=args.service, since=since, until=args.until,
+                          status=args.status, limit=args.limit)
+    for record in records:
+        print("%s  %-12s %-20s %-24s %-15s %-9s %4s %6s" % (
+            datetime.datetime.fromtimestamp(record["t"]).strftime("%Y-%m-%d %H:%M:%S"), record["site"],
+            record["host"], record["service"] or "-", record["type"], record["state"], record["status"] or "-",
+            "-" if record["latency"] is None else "%.2fs" % record["latency"],
+        ))
+    sys.stderr.write("%i records in %.1f ms\n" % (len(records), (time.perf_counter() - start) * 1000))
+    return 0
+
+
+def cli(argv: List[str]) -> int:
+    """Run the notification (without arguments) or one of the commands"""
+    if not argv:
+        main()
+        return 0
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="cmk_discord.py", description="Discord notifications for Checkmk")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    batch_parser = commands.add_parser("batch", help="send notifications from spool files or NDJSON")
+    batch_parser.add_argument("paths", nargs="*", help="NDJSON files, spool files or spool directories (- is stdin)")
+    batch_parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                              help="render processes (0 renders in the main process)")
+    batch_parser.add_argument("--concurrency", type=int, default=4, help="concurrent sends")
+    batch_parser.add_argument("--rate", type=float, default=5.0, help="maximum sends per second (0: unlimited)")
+    batch_parser.add_argument("--webhook", help="webhook url for records without parameter 1")
+    batch_parser.set_defaults(func=batch)
+
+    serve_parser = commands.add_parser("serve", help="run the resident dispatcher")
+    serve_parser.add_argument("--socket", help="Unix socket to listen on (default: dispatcher socket or "
+                                                "~/tmp/run/cmk_discord.sock)")
+    serve_parser.add_argument("--concurrency", type=int, default=4, help="concurrent sends")
+    serve_parser.add_argument("--drain-timeout", type=float, default=10.0,
+                              help="seconds in-flight sends get to finish on SIGTERM")
+    serve_parser.set_defaults(func=serve)
+
+    stats_parser = commands.add_parser("stats", help="show the counters of the running dispatcher")
+    stats_parser.add_argument("--socket", help="Unix socket of the dispatcher")
+    stats_parser.set_defaults(func=stats)
+
+    latency_parser = commands.add_parser("latency", help="show delivery delay percentiles over time")
+    latency_parser.add_argument("--site", help="only notifications of this OMD site")
+    latency_parser.add_argument("--webhook", help="only notifications sent to this webhook url")
+    latency_parser.add_argument("--since", type=duration, default=86400, help="time range, e.g. 6h or 7d")
+    latency_parser.add_argument("--interval", type=duration, help="length of the rows (default: resolution)")
+    latency_parser.set_defaults(func=latency)
+
+    history_parser = commands.add_parser("history", help="show sent notifications, newest first")
+    history_parser.add_argument("--host", help="only notifications of this host")
+    history_parser.add_argument("--service", help="only notifications of this service")
+    history_parser.add_argument("--since", type=duration, default=86400, help="time range, e.g. 6h or 90d")
+    history_parser.add_argument("--from", dest="start", type=timestamp,
+                                help="start of the time range instead of --since, e.g. \"2026-10-19 02:00\"")
+    history_parser.add_argument("--until", type=timestamp, help="end of the time range (default now)")
+    history_parser.add_argument("--status", choices=["sent", "failed"], help="only sent or failed notifications")
+    history_parser.add_argument("--limit", type=int, default=100, help="maximum number of records")
+    history_parser.set_defaults(func=history)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
 
 def main():
-    ctx = Context.from_env()
+    config = Config.load()
+    DiscordWebhook.configure(config)
+    profiler = Profiler.from_config(config)
+    recorder = Recorder.from_config(config)
+    with DnsCache.from_config(config) or nullcontext():
+        if profiler is not None:
+            profiler.run(lambda: notify(recorder))
+        else:
+            notify(recorder)
+
+
+def notify(recorder: Optional["Recorder"] = None):
+    ctx = Context.from_env(recorder)
     ctx.validate()
+    config = Config.load()
+    socket_path = config.section("dispatcher").get("socket")
+    if socket_path and forward(ctx, socket_path):
+        return
+    deliver(ctx, config)
+
+
+def deliver(ctx: Context, config: "Config", embed: Optional[Embed] = None, batcher: Optional[Batcher] = None,
+            done: Optional[Callable] = None, routes: Optional[List[str]] = None) -> None:
+    """Send a notification to its webhooks through the configured stages, or queue it to the batcher
 
-    embed = Embed.from_context(ctx)
-    webhook = DiscordWebhook(ctx.webhook_url, embed, ctx.omd_site)
-    webhook.send()
+    Without done, it exits with 1 after trying all routes when one of them
+    failed. With done, done(outcomes) is called instead once every route
+    finished, including those queued to the batcher, with a (route, sent,
+    response) tuple per route. routes restricts the sends to these routed
+    webhooks, e.g. to retry those that failed.
+    """
+    correlation = HostCorrelation.from_config(config)
+    if correlation is not None and correlation.absorb(ctx, config):
+        if done is not None:
+            done([])
+        return
+
+    throttle = Throttle.from_config(config)
+    if throttle is not None:
+        action, since = throttle.check(ctx)
+        if action == Throttle.SUPPRESS:
+            if done is not None:
+                done([])
+            return
+    # Remembered by the throttle once the first route delivered the full message
+    full_message = throttle is not None and action == Throttle.SEND
+
+    embed = embed or Embed.from_context(ctx)
+    if throttle is not None and action == Throttle.SUMMARIZE:
+        throttle.summarize(embed, since)
+    if correlation is not None:
+        correlation.release(ctx, embed)
+    dedupe = Deduplicator.from_config(config)
+    latency = LatencyHistogram.from_config(config)
+    breaker = CircuitBreaker.from_config(config)
+    history = History.from_config(config)
+    messages = {}
+    unavailable = []
+    failed = []
+    outcomes = []
+    lock = threading.Lock()
+    # Routes still to finish, plus one for the loop below
+    remaining = 1
+
+    def completed(outcome: Optional[tuple] = None) -> None:
+        nonlocal remaining
+        with lock:
+            if outcome is not None:
+                outcomes.append(outcome)
+            remaining -= 1
+            if remaining:
+                return
+        if done is not None:
+            done(outcomes)
+
+    for url in config.router.route(ctx):
+        if routes is not None and url not in routes:
+            continue
+        route = url
+        claim = None
+        if dedupe is not None:
+            claim = dedupe.claim(ctx, url)
+            if claim is None:
+                continue
+        pool = config.pools.get(url)
+        if pool is not None:
+            url = pool.select(ctx)
+        target = url if breaker is None else breaker.select(url)
+        if target is None:
+            unavailable.append(url)
+            if claim is not None:
+                dedupe.release(claim)
+            with lock:
+                outcomes.append((route, False, None))
+            continue
+        webhook = DiscordWebhook(target, config.apply_template(embed, url), ctx.omd_site)
+        embed_dict = webhook.embed.to_dict() if batcher is not None or history is not None else None
+
+        def finished(sent: Optional[bool], response, url=target, pool=pool, claim=claim, embed_dict=embed_dict,
+                     route=route) -> None:
+            nonlocal full_message
+            # The route is finished even if recording its outcome fails
+            try:
+                if sent is None:
+                    # Abandoned by the batcher before it was sent
+                    if claim is not None:
+                        dedupe.release(claim)
+                    return
+                with lock:
+                    first = full_message and sent
+                    if first:
+                        full_message = False
+                if first:
+                    throttle.sent(ctx, since)
+                if history is not None:
+                    elapsed = getattr(response, "elapsed", None)
+                    history.append(
+                        ctx, url, hashlib.sha1(json.dumps(embed_dict, sort_keys=True).encode()).hexdigest()[:16],
+                        getattr(response, "status_code", None),
+                        elapsed.total_seconds() if isinstance(elapsed, datetime.timedelta) else None,
+                    )
+                if breaker is not None:
+                    breaker.observe(url, sent, response)
+                if latency is not None and sent:
+                    latency.record(ctx, url)
+                if pool is not None:
+                    pool.observe(url, response)
+                if claim is not None and sent:
+                    dedupe.done(claim)
+                elif claim is not None:
+                    dedupe.release(claim)
+            finally:
+                completed((route, bool(sent), response))
+
+        with lock:
+            remaining += 1
+        opens_outage = correlation is not None and correlation.opens_outage(ctx)
+        if batcher is not None and not opens_outage:
+            batcher.add(target, ctx.omd_site, embed_dict, finished)
+            continue
+        # A failing webhook must not keep the other routes from being tried
+        sent = False
+        try:
+            if opens_outage:
+                messages[target] = webhook.send(wait=True)["id"]
+            else:
+                webhook.send()
+            sent = True
+        except SystemExit:
+            failed.append(route)
+        except requests.RequestException as e:
+            sys.stderr.write("Failed to call webhook url %s: %s\n" % (target, e))
+            failed.append(route)
+        finally:
+            finished(sent, webhook.response)
+    if messages:
+        correlation.record(ctx, messages)
+    if unavailable:
+        sys.stderr.write("Circuit open for webhook url %s and no fallback available" % ", ".join(unavailable))
+    if done is None and (failed or unavailable):
+        sys.exit(1)
+    completed()
 
 
 if __name__ == "__main__":
     try:
-        main()
+        sys.exit(cli(sys.argv[1:]))
     except Exception as e:
         sys.stderr.write("Unhandled exception: %s\n" % e)
         sys.exit(2)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+import json
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import get_data_dir, use_state_dir
+
+
+def fixture(path, version="2.4.0p12"):
+    with open(get_data_dir(version) / path, "r") as f:
+        return json.load(f)
+
+
+class TestReadNotifications(unittest.TestCase):
+    """Tests for read_notifications()"""
+
+    def setUp(self):
+        self.tmp = Path(use_state_dir(self))
+
+    def test_ndjson(self):
+        path = self.tmp / "backlog.ndjson"
+        with open(path, "w") as f:
+            for name in ("service/problem_critical.json", "host/problem_down.json"):
+                f.write(json.dumps(fixture(name)) + "\n\n")
+        records = list(cmk_discord.read_notifications([str(path)]))
+        self.assertEqual([r["WHAT"] for r in records], ["SERVICE", "HOST"])
+        self.assertNotIn("NOTIFY_WHAT", records[0])
+
+    def test_spool_directory(self):
+        spool = self.tmp / "spool"
+        spool.mkdir()
+        context = {key[7:]: value for (key, value) in fixture("host/problem_down.json").items()}
+        with open(spool / "a", "w") as f:
+            f.write(repr({"context": context, "plugin": "cmk_discord.py"}))
+        with open(spool / "b", "w") as f:
+            f.write(repr({"context": context, "plugin": "mail"}))
+        records = list(cmk_discord.read_notifications([str(spool)]))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["HOSTNAME"], "dns1")
+
+    def test_backlog_file(self):
+        contexts = []
+        for name in ("service/problem_critical.json", "host/problem_down.json"):
+            contexts.insert(0, {key[7:]: value for (key, value) in fixture(name).items()})
+        path = self.tmp / "backlog.mk"
+        with open(path, "w") as f:
+            f.write(repr(contexts))
+        records = list(cmk_discord.read_notifications([str(path)]))
+        self.assertEqual([r["WHAT"] for r in records], ["SERVICE", "HOST"])
+
+
+class TestBatch(unittest.TestCase):
+    """Tests for the batch command"""
+
+    def setUp(self):
+        self.state_dir = use_state_dir(self)
+        self.path = os.path.join(self.state_dir, "backlog.ndjson")
+        with open(self.path, "w") as f:
+            for i in range(40):
+                env = fixture("service/problem_critical.json")
+                env["NOTIFY_HOSTNAME"] = "host%i" % (i % 7)
+                env["NOTIFY_SERVICEOUTPUT"] = str(i)
+                f.write(json.dumps(env) + "\n")
+            f.write(json.dumps({"NOTIFY_WHAT": "SERVICE"}) + "\n")
+
+    def run_batch(self, *args, statuses=None, config=None):
+        with patch('requests.post') as mock_post, patch('sys.stderr.write') as mock_stderr, \
+                patch('cmk_discord.Config.load', return_value=cmk_discord.Config(config or {})):
+            mock_post.return_value = MagicMock(status_code=204)
+            if statuses is not None:
+                mock_post.side_effect = lambda url, **kwargs: MagicMock(
+                    status_code=statuses.pop(0) if statuses else 204)
+            code = cmk_discord.cli(["batch", self.path, "--rate", "0"] + list(args))
+        self.summary = mock_stderr.call_args_list[-1].args[0]
+        return code, mock_post
+
+    def test_inline_rendering(self):
+        code, mock_post = self.run_batch("--processes", "0")
+        self.assertEqual(code, 1)  # the invalid record
+        self.assertEqual(mock_post.call_count, 40)
+
+    def test_failed_batches_are_retried_and_counted(self):
+        config = {"batching": {"max_delay": 0.01}, "retry": {"interval": 0.01, "attempts": 2}}
+        code, mock_post = self.run_batch("--concurrency", "2", statuses=[500] * 1000, config=config)
+        self.assertEqual(code, 1)
+        self.assertEqual(self.summary, "Sent 0 notifications, 41 failed\n")
+        embeds = sum(len(call[1]['json']['embeds']) for call in mock_post.call_args_list)
+        self.assertEqual(embeds, 80)
+
+    def test_failed_batches_are_sent_on_retry(self):
+        config = {"batching": {"max_delay": 0.01}, "retry": {"interval": 0.01}}
+        code, mock_post = self.run_batch("--concurrency", "2", statuses=[500, 500, 500], config=config)
+        self.assertEqual(code, 1)  # the invalid record
+        self.assertEqual(self.summary, "Sent 40 notifications, 1 failed\n")
+        self.assertEqual(os.listdir(os.path.join(self.state_dir, "retry")), [])
+
+    def test_only_overload_decreases_concurrency(self):
+        config = {"adaptive_concurrency": {"initial": 2}, "retry": {"attempts": 1}}
+        release = cmk_discord.ConcurrencyLimiter.release
+        overloads = []
+
+        def record(limiter, latency, overloaded=False):
+            overloads.append(overloaded)
+            release(limiter, latency, overloaded)
+
+        with patch.object(cmk_discord.ConcurrencyLimiter, 'release', record):
+            self.run_batch("--concurrency", "2", statuses=[400] * 40, config=config)
+            self.assertEqual(overloads, [False] * 40)
+            del overloads[:]
+            self.run_batch("--concurrency", "2", statuses=[503] * 40, config=config)
+            self.assertEqual(overloads, [True] * 40)
+
+    def test_process_pool_keeps_host_order(self):
+        code, mock_post = self.run_batch("--processes", "2", "--concurrency", "3")
+        self.assertEqual(mock_post.call_count, 40)
+        outputs = {}
+        for call in mock_post.call_args_list:
+            embed = call[1]['json']['embeds'][0]
+            host = embed['fields'][0]['value']
+            outputs.setdefault(host, []).append(int(embed['description'].split("\n\n")[1]))
+        for host_outputs in outputs.values():
+            self.assertEqual(host_outputs, sorted(host_outputs))
+
+
+class TestPacer(unittest.TestCase):
+    """Tests for the Pacer token bucket"""
+
+    def test_spacing(self):
+        pacer = cmk_discord.Pacer(100)
+        start = cmk_discord.time.monotonic()
+        for _ in range(6):
+            pacer.wait()
+        self.assertGreaterEqual(cmk_discord.time.monotonic() - start, 0.045)
+
+
+if __name__ == '__main__':
+    unittest.main()
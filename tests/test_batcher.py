@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+import json
+import threading
+import time
+from dataclasses import replace
+from unittest.mock import patch, MagicMock
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import get_data_dir, use_state_dir
+
+URL = "https://discord.com/api/webhooks/1/a"
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def embed(i=0, size=10):
+    return {"title": "alert %i" % i, "description": "x" * size}
+
+
+def response(status=204, headers=None):
+    result = MagicMock()
+    result.status_code = status
+    result.headers = headers or {}
+    return result
+
+
+class TestBatcher(unittest.TestCase):
+    """Tests for the adaptive Batcher"""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.batcher = cmk_discord.Batcher(max_delay=2.0, target_latency=0.5, clock=self.clock)
+
+    def test_sends_immediately_when_idle(self):
+        self.batcher.add(URL, "site", embed())
+        url, site, batch = self.batcher.take()
+        self.assertEqual((url, site, len(batch)), (URL, "site", 1))
+        self.assertIsNone(self.batcher.take())
+
+    def test_accumulates_while_in_flight(self):
+        self.batcher.add(URL, "site", embed(0))
+        message = self.batcher.take()
+        for i in range(1, 13):
+            self.batcher.add(URL, "site", embed(i))
+        self.assertIsNone(self.batcher.take())
+        self.batcher.finish(*message, True, 0.1)
+        _, _, batch = self.batcher.take()
+        self.assertEqual([item[0]["title"] for item in batch], ["alert %i" % i for i in range(1, 11)])
+        self.assertEqual(self.batcher.requests, 2)
+
+    def test_packs_up_to_character_limit(self):
+        for i in range(4):
+            self.batcher.add(URL, "site", embed(i, size=2500))
+        self.assertEqual(len(self.batcher.take()[2]), 2)
+
+    def test_low_budget_waits_for_full_message_or_delay(self):
+        self.batcher.budgets[URL] = (1, 60.0)
+        for i in range(3):
+            self.batcher.add(URL, "site", embed(i))
+        self.assertIsNone(self.batcher.take())
+        self.assertEqual(self.batcher.wakeup(), 2.0)
+        self.clock.now = 2.0
+        self.assertEqual(len(self.batcher.take()[2]), 3)
+
+    def test_exhausted_budget_waits_for_reset(self):
+        self.batcher.add(URL, "site", embed())
+        message = self.batcher.take()
+        self.batcher.add(URL, "site", embed(1))
+        self.batcher.finish(*message, False, 0.1, response(429, {"Retry-After": "5"}))
+        self.assertIsNone(self.batcher.take())
+        self.assertEqual(self.batcher.wakeup(), 5.0)
+        self.clock.now = 5.0
+        self.assertIsNotNone(self.batcher.take())
+
+    def test_size_adapts_to_latency(self):
+        batcher = cmk_discord.Batcher(target_latency=0.5, max_inflight=2, clock=self.clock)
+        for latency in (2.0, 2.0, 2.0):
+            batcher.add(URL, "site", embed())
+            batcher.finish(*batcher.take(), True, latency)
+        self.assertEqual(batcher.size, 4)
+        batcher.add(URL, "site", embed(0))
+        first = batcher.take()
+        for i in range(3):
+            batcher.add(URL, "site", embed(i))
+        self.assertIsNone(batcher.take())
+        batcher.add(URL, "site", embed(3))
+        second = batcher.take()
+        self.assertEqual(len(second[2]), 4)
+        batcher.finish(*first, True, 0.01)
+        batcher.finish(*second, True, 0.01)
+        for _ in range(20):
+            batcher.add(URL, "site", embed())
+            batcher.finish(*batcher.take(), True, 0.01)
+        self.assertEqual(batcher.size, 1)
+
+    def test_sites_served_round_robin(self):
+        batcher = cmk_discord.Batcher(clock=self.clock)
+        batcher.MAX_EMBEDS = 1
+        for i in range(5):
+            batcher.add(URL, "storm", embed(i))
+        self.clock.now = 1.0
+        batcher.add(URL, "quiet", embed())
+        sites = []
+        for _ in range(3):
+            url, site, batch = batcher.take()
+            sites.append(site)
+            batcher.finish(url, site, batch, True, 0.1)
+        self.assertEqual(sites, ["storm", "quiet", "storm"])
+
+    def test_callbacks(self):
+        results = []
+        self.batcher.add(URL, "site", embed(), lambda sent, response: results.append(sent))
+        self.batcher.finish(*self.batcher.take(), False, 0.1)
+        self.assertEqual(results, [False])
+
+    def test_bounded_by_bytes(self):
+        batcher = cmk_discord.Batcher(clock=self.clock, max_bytes=3 * cmk_discord.Batcher.EMBED_BYTES)
+        # Always accepted when nothing is waiting
+        batcher.add(URL, "site", embed(0, size=5000))
+        message = batcher.take()
+        batcher.add(URL, "site", embed(1))
+        batcher.add(URL, "site", embed(2))
+        added = threading.Event()
+        thread = threading.Thread(target=lambda: (batcher.add(URL, "site", embed(3)), added.set()), daemon=True)
+        thread.start()
+        self.assertFalse(added.wait(0.05))
+        batcher.finish(*message, True, 0.1)
+        batcher.take()
+        self.assertTrue(added.wait(5))
+        self.assertEqual(batcher.bytes, cmk_discord.Batcher.EMBED_BYTES + len("alert 3") + 10)
+
+    def test_abandon(self):
+        results = []
+        self.batcher.add(URL, "site", embed(0), lambda sent, response: results.append(0))
+        message = self.batcher.take()
+        self.batcher.add(URL, "site", embed(1), lambda sent, response: results.append(1))
+        callbacks = self.batcher.abandon()
+        self.assertEqual((len(callbacks), self.batcher.pending, self.batcher.bytes), (2, {}, 0))
+        # The message in flight no longer calls back, the caller does
+        self.batcher.finish(*message, True, 0.1)
+        self.assertEqual(results, [])
+        for callback in callbacks:
+            callback(None, None)
+        self.assertEqual(sorted(results), [0, 1])
+
+
+class TestBatchedDelivery(unittest.TestCase):
+    """Tests for deliver() through a Batcher"""
+
+    def setUp(self):
+        use_state_dir(self)
+        with open(get_data_dir("2.4.0p12") / "service/problem_critical.json", "r") as f:
+            data = {key[7:]: value for (key, value) in json.load(f).items()}
+        self.ctx = cmk_discord.Context.from_dict(data)
+
+    @patch("requests.post")
+    def test_one_request_for_queued_embeds(self, post):
+        post.return_value = response()
+        config = cmk_discord.Config({"dedupe": {"ttl": 60}})
+        batcher = cmk_discord.Batcher()
+        for i in range(5):
+            self.ctx.hostname = "host%i" % i
+            cmk_discord.deliver(self.ctx, config, batcher=batcher)
+        batcher.start()
+        batcher.close()
+        post.assert_called_once()
+        self.assertEqual(len(post.call_args.kwargs["json"]["embeds"]), 5)
+        self.assertEqual(len(cmk_discord.ShardedStateStore("sent", 60).entries()), 5)
+
+    @patch("sys.stderr.write")
+    @patch("requests.post")
+    def test_done_reports_batched_outcomes(self, post, stderr):
+        post.return_value = response(500)
+        config = cmk_discord.Config({"dedupe": {"ttl": 60}})
+        batcher = cmk_discord.Batcher()
+        outcomes = []
+        cmk_discord.deliver(self.ctx, config, batcher=batcher, done=outcomes.append)
+        self.assertEqual(outcomes, [])
+        batcher.start()
+        batcher.close()
+        self.assertEqual([(route, sent) for (route, sent, _) in outcomes[0]], [(self.ctx.webhook_url, False)])
+        # The failed send can be retried
+        self.assertEqual(len(cmk_discord.ShardedStateStore("sent", 60).entries()), 0)
+
+
+    @patch("requests.post")
+    def test_routes_finish_on_concurrent_threads(self, post):
+        def slow(url, **kwargs):
+            time.sleep(0.001)
+            return response()
+
+        post.side_effect = slow
+        hooks = [URL, "https://discord.com/api/webhooks/2/b"]
+        config = cmk_discord.Config({"dedupe": {"ttl": 60}, "latency": {"resolution": 60},
+                                     "routes": [{"webhooks": hooks}]})
+        batcher = cmk_discord.Batcher(max_inflight=4)
+        outcomes = []
+        batcher.start(4)
+        for i in range(50):
+            ctx = replace(self.ctx, hostname="host%i" % i)
+            cmk_discord.deliver(ctx, config, batcher=batcher, done=outcomes.append)
+        batcher.close()
+        self.assertEqual(len(outcomes), 50)
+        self.assertTrue(all(sent for outcome in outcomes for (_, sent, _) in outcome))
+        self.assertEqual(len(cmk_discord.ShardedStateStore("sent", 60).entries()), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+import json
+import tempfile
+import threading
+import time
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import load_test_data
+
+
+class TestBoundedQueue(unittest.TestCase):
+    """Tests for the byte-budgeted BoundedQueue"""
+
+    def test_fifo(self):
+        queue = cmk_discord.BoundedQueue(100)
+        for i in range(3):
+            queue.put(i, 10)
+        self.assertEqual([queue.get() for _ in range(3)], [0, 1, 2])
+        self.assertEqual(queue.bytes, 0)
+
+    def test_oversized_item_accepted_when_empty(self):
+        queue = cmk_discord.BoundedQueue(10)
+        queue.put("big", 1000)
+        self.assertEqual(queue.get(), "big")
+
+    def test_blocks_when_over_budget(self):
+        queue = cmk_discord.BoundedQueue(25)
+        queue.put(1, 10)
+        queue.put(2, 10)
+        done = threading.Event()
+
+        def producer():
+            queue.put(3, 10)
+            done.set()
+
+        thread = threading.Thread(target=producer)
+        thread.start()
+        time.sleep(0.05)
+        self.assertFalse(done.is_set())
+        self.assertEqual(queue.get(), 1)
+        thread.join(1)
+        self.assertTrue(done.is_set())
+        self.assertEqual([queue.get(), queue.get()], [2, 3])
+
+    def test_spills_to_disk_in_order(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "spill.pickle")
+            queue = cmk_discord.BoundedQueue(25, spill_path=path)
+            for i in range(10):
+                queue.put(i, 10)
+            self.assertEqual(queue.spilled, 8)
+            self.assertEqual(len(queue), 10)
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual([queue.get() for _ in range(10)], list(range(10)))
+            self.assertFalse(os.path.exists(path))
+
+
+class TestInterning(unittest.TestCase):
+    """Tests for identifier interning in Context"""
+
+    def test_identifiers_are_shared(self):
+        first = load_test_data("service/problem_critical.json", version="2.4.0p12")
+        second = load_test_data("service/problem_critical.json", version="2.4.0p12")
+        self.assertIs(first.hostname, second.hostname)
+        self.assertIs(first.service_desc, second.service_desc)
+        self.assertIs(first.service_check_command, second.service_check_command)
+
+    def test_contexts_read_back_from_json_are_shared(self):
+        # The Dispatcher builds contexts from forwarded and persisted lines
+        first = load_test_data("service/problem_critical.json", version="2.4.0p12")
+        second = cmk_discord.Context.from_fields(json.loads(json.dumps(cmk_discord.asdict(first))))
+        self.assertIs(first.hostname, second.hostname)
+        self.assertIs(first.webhook_url, second.webhook_url)
+        self.assertIs(first.service_state, second.service_state)
+
+    def test_estimate_size_grows_with_output(self):
+        ctx = load_test_data("service/problem_critical.json", version="2.4.0p12")
+        size = ctx.estimate_size()
+        ctx.service_output = "x" * 10000
+        self.assertGreaterEqual(ctx.estimate_size(), size + 10000)
+
+
+class TestFairQueue(unittest.TestCase):
+    """Tests for the per-site round-robin FairQueue"""
+
+    def test_round_robin_keeps_order_per_key(self):
+        queue = cmk_discord.FairQueue(1000)
+        for i in range(4):
+            queue.put("a%i" % i, 10, "a")
+        queue.put("b0", 10, "b")
+        queue.put("b1", 10, "b")
+        self.assertEqual([queue.get() for _ in range(6)], ["a0", "b0", "a1", "b1", "a2", "a3"])
+        self.assertEqual((len(queue), queue.bytes), (0, 0))
+
+    def test_weights(self):
+        queue = cmk_discord.FairQueue(1000, weights={"a": 2})
+        for i in range(4):
+            queue.put("a%i" % i, 10, "a")
+            queue.put("b%i" % i, 10, "b")
+        self.assertEqual([queue.get() for _ in range(6)], ["a0", "a1", "b0", "a2", "a3", "b1"])
+
+    def test_storm_does_not_block_other_keys(self):
+        queue = cmk_discord.FairQueue(100)
+        for i in range(10):
+            queue.put(i, 10, "storm")
+        blocked = threading.Thread(target=queue.put, args=("late", 10, "storm"), daemon=True)
+        blocked.start()
+        blocked.join(0.1)
+        self.assertTrue(blocked.is_alive())
+        queue.put("other", 10, "quiet")
+        self.assertEqual([queue.get(), queue.get()], [0, "other"])
+        blocked.join(1)
+        self.assertFalse(blocked.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+import json
+from dataclasses import replace
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import load_test_data, use_state_dir
+
+
+class TestCatchUp(unittest.TestCase):
+    """Tests for collapsing large backlogs"""
+
+    def setUp(self):
+        self.service = load_test_data("service/problem_critical.json", version="2.4.0p12")
+        self.host = load_test_data("host/problem_down.json", version="2.4.0p12")
+
+    def backlog(self):
+        return [
+            replace(self.host, hostname="web1", host_state="DOWN"),
+            replace(self.service, hostname="web1", service_desc="CPU", service_state="CRITICAL"),
+            replace(self.service, hostname="web1", service_desc="Disk", service_state="WARNING"),
+            replace(self.service, hostname="web1", service_desc="CPU", service_state="OK",
+                    notification_type="RECOVERY"),
+            replace(self.host, hostname="web1", host_state="UP", notification_type="RECOVERY"),
+            replace(self.service, hostname="db1", service_desc="MySQL", service_state="CRITICAL"),
+        ]
+
+    def test_exceeded(self):
+        catch_up = cmk_discord.CatchUp(threshold=3)
+        exceeded, items = catch_up.exceeded(iter(range(3)))
+        self.assertFalse(exceeded)
+        self.assertEqual(list(items), [0, 1, 2])
+        exceeded, items = catch_up.exceeded(iter(range(10)))
+        self.assertTrue(exceeded)
+        self.assertEqual(list(items), list(range(10)))
+
+    def test_collapse(self):
+        sent = list(cmk_discord.CatchUp().collapse(self.backlog()))
+        self.assertEqual(
+            [(ctx.hostname, ctx.notification_type, ctx.service_desc) for (ctx, _) in sent],
+            [("web1", "CATCHUP", None), ("web1", "PROBLEM", "Disk"),
+             ("db1", "CATCHUP", None), ("db1", "PROBLEM", "MySQL")],
+        )
+        summary = sent[0][1].to_dict()
+        self.assertTrue(summary["title"].startswith(":clipboard: CATCHUP: Host: web1"))
+        self.assertIn("5 notifications while Discord was unreachable, 1 objects still", summary["description"])
+        self.assertEqual(summary["fields"][-1]["value"], "Disk: WARNING\nCPU: OK\nHost: UP")
+        self.assertEqual(summary["color"], cmk_discord.DiscordColor.GREEN)
+
+    @patch("requests.post")
+    def test_batch_command(self, post):
+        post.return_value = MagicMock(status_code=204)
+        path = os.path.join(use_state_dir(self, {"catch_up": {"threshold": 3}}), "backlog.ndjson")
+        with open(path, "w") as f:
+            for ctx in self.backlog():
+                data = {key.upper(): value for (key, value) in cmk_discord.asdict(ctx).items()}
+                f.write(json.dumps(data) + "\n")
+        args = SimpleNamespace(paths=[path], processes=0, concurrency=1, rate=0, webhook=None)
+        with patch("sys.stderr.write"), patch("cmk_discord.Context.from_dict", side_effect=self.backlog()):
+            self.assertEqual(cmk_discord.batch(args), 0)
+        self.assertEqual(post.call_count, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
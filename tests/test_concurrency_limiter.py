@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+import threading
+from unittest.mock import MagicMock
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestConcurrencyLimiter(unittest.TestCase):
+    """Tests for the AIMD ConcurrencyLimiter"""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.limiter = cmk_discord.ConcurrencyLimiter(8, minimum=1, initial=2, clock=self.clock)
+
+    def send(self, latency=0.1, overloaded=False):
+        self.limiter.acquire()
+        self.clock.now += latency
+        self.limiter.release(latency, overloaded)
+
+    def test_additive_increase(self):
+        for _ in range(2):
+            self.send()
+        self.assertEqual(self.limiter.stats()["limit"], 2)
+        for _ in range(3):
+            self.send()
+        self.assertEqual(self.limiter.stats()["limit"], 3)
+        for _ in range(200):
+            self.send()
+        self.assertEqual(self.limiter.stats()["limit"], 8)
+
+    def test_multiplicative_decrease_once_per_round_trip(self):
+        for _ in range(60):
+            self.send()
+        self.assertEqual(self.limiter.stats()["limit"], 8)
+        self.send(overloaded=True)
+        self.limiter.acquire()
+        self.limiter.release(0.1, True)
+        self.assertEqual(self.limiter.stats()["limit"], 4)
+        self.clock.now += 1
+        self.send(overloaded=True)
+        self.assertEqual(self.limiter.stats()["limit"], 2)
+        self.assertEqual(self.limiter.stats()["decreases"], 2)
+
+    def test_latency_spike_decreases(self):
+        for _ in range(30):
+            self.send(0.1)
+        limit = self.limiter.limit
+        self.send(0.5)
+        self.assertEqual(self.limiter.limit, limit / 2)
+        self.assertAlmostEqual(self.limiter.stats()["baseline_latency"], 0.1)
+
+    def test_overloaded(self):
+        overloaded = cmk_discord.ConcurrencyLimiter.overloaded
+        self.assertFalse(overloaded(True, MagicMock(status_code=204)))
+        self.assertTrue(overloaded(False, MagicMock(status_code=429)))
+        self.assertTrue(overloaded(False, MagicMock(status_code=502)))
+        self.assertTrue(overloaded(False, None))
+        self.assertFalse(overloaded(False, MagicMock(status_code=400)))
+
+    def test_acquire_blocks_at_limit(self):
+        self.limiter.acquire()
+        self.limiter.acquire()
+        blocked = threading.Thread(target=self.limiter.acquire, daemon=True)
+        blocked.start()
+        blocked.join(0.1)
+        self.assertTrue(blocked.is_alive())
+        self.limiter.release(0.1)
+        blocked.join(1)
+        self.assertFalse(blocked.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+import fcntl
+from dataclasses import replace
+from unittest.mock import patch, MagicMock
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import load_test_data, use_state_dir
+
+
+class TestHostCorrelation(unittest.TestCase):
+    """Tests for folding service problems into host problems"""
+
+    def setUp(self):
+        use_state_dir(self, {"correlation": {"window": 600}})
+
+        # Host dns1 goes down, its Check_MK service goes CRITICAL
+        self.host_down = load_test_data("host/problem_down.json", version="2.4.0p12")
+        self.host_up = load_test_data("host/recovery_up.json", version="2.4.0p12")
+        self.service_crit = load_test_data("service/problem_critical.json", version="2.4.0p12")
+        self.service_ok = load_test_data("service/recovery_ok.json", version="2.4.0p12")
+
+    def notify(self, ctx):
+        with patch('cmk_discord.Context.from_env', return_value=ctx), \
+                patch('requests.post') as mock_post, patch('requests.patch') as mock_patch:
+            down = ctx.what == "HOST" and ctx.host_state == "DOWN"
+            mock_post.return_value = MagicMock(status_code=200 if down else 204)
+            mock_post.return_value.json.return_value = {"id": "42"}
+            mock_patch.return_value = MagicMock(status_code=200)
+            cmk_discord.notify()
+        return mock_post, mock_patch
+
+    def test_service_problem_without_outage_is_sent(self):
+        mock_post, mock_patch = self.notify(self.service_crit)
+        mock_post.assert_called_once()
+        mock_patch.assert_not_called()
+
+    def test_host_problem_waits_for_message(self):
+        mock_post, _ = self.notify(self.host_down)
+        self.assertEqual(mock_post.call_args[1]['params'], {"wait": "true"})
+
+    def test_service_problem_is_folded(self):
+        self.notify(self.host_down)
+        mock_post, mock_patch = self.notify(self.service_crit)
+
+        mock_post.assert_not_called()
+        mock_patch.assert_called_once()
+        self.assertTrue(mock_patch.call_args[1]['url'].endswith("/messages/42"))
+        embed = mock_patch.call_args[1]['json']['embeds'][0]
+        self.assertIn("Host: dns1", embed['title'])
+        self.assertEqual(embed['fields'][0]['name'], "Services affected: 1")
+        self.assertEqual(embed['fields'][0]['value'], "Check_MK (CRITICAL)")
+
+    def test_folded_service_recovery_is_dropped(self):
+        self.notify(self.host_down)
+        self.notify(self.service_crit)
+        mock_post, mock_patch = self.notify(self.service_ok)
+        mock_post.assert_not_called()
+        mock_patch.assert_not_called()
+
+    def test_host_recovery_lists_folded_services(self):
+        self.notify(self.host_down)
+        self.notify(self.service_crit)
+        mock_post, _ = self.notify(self.host_up)
+
+        embed = mock_post.call_args[1]['json']['embeds'][0]
+        self.assertEqual(embed['fields'][0]['value'], "Check_MK (CRITICAL)")
+
+        # New service problems after the recovery are sent again
+        mock_post, mock_patch = self.notify(self.service_crit)
+        mock_post.assert_called_once()
+        mock_patch.assert_not_called()
+
+    def test_host_renotification_keeps_folded_services(self):
+        self.notify(self.host_down)
+        self.notify(self.service_crit)
+        renotification = replace(self.host_down, notification_number="2")
+        mock_post, _ = self.notify(renotification)
+        embed = mock_post.call_args[1]['json']['embeds'][0]
+        self.assertEqual(embed['fields'][0]['value'], "Check_MK (CRITICAL)")
+
+        # The folded service recovery is still dropped
+        mock_post, mock_patch = self.notify(self.service_ok)
+        mock_post.assert_not_called()
+        mock_patch.assert_not_called()
+
+    def test_partial_failure_records_sent_messages(self):
+        hooks = ["https://discord.com/api/webhooks/1/a", "https://discord.com/api/webhooks/2/b"]
+        config = cmk_discord.Config({"correlation": {"window": 600},
+                                     "routes": [{"hostname": ["dns1"], "webhooks": hooks}]})
+
+        def post(url, **kwargs):
+            response = MagicMock(status_code=500 if url == hooks[0] else 200)
+            response.json.return_value = {"id": "43"}
+            return response
+
+        with patch('cmk_discord.Config.load', return_value=config), \
+                patch('cmk_discord.Context.from_env', return_value=self.host_down), \
+                patch('requests.post', side_effect=post), patch('sys.stderr.write'):
+            with self.assertRaises(SystemExit):
+                cmk_discord.notify()
+        with patch('cmk_discord.Config.load', return_value=config):
+            mock_post, mock_patch = self.notify(self.service_crit)
+
+        mock_post.assert_not_called()
+        self.assertEqual([c[1]['url'] for c in mock_patch.call_args_list], [hooks[1] + "/messages/43"])
+
+    def test_edit_does_not_hold_the_lock(self):
+        self.notify(self.host_down)
+        store = cmk_discord.StateStore("correlation", 60)
+
+        def edit(**kwargs):
+            # Another invocation can update the outage while the edit is in flight
+            with open(store.path + ".lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            with store as other:
+                outage = other.get("monitoring/dns1")
+                if "Memory" not in outage["services"]:
+                    outage["services"]["Memory"] = "WARNING"
+                    outage["revision"] += 1
+                    other.set("monitoring/dns1", outage)
+            return MagicMock(status_code=200)
+
+        with patch('cmk_discord.Context.from_env', return_value=self.service_crit), \
+                patch('requests.post') as mock_post, patch('requests.patch', side_effect=edit) as mock_patch:
+            cmk_discord.notify()
+
+        mock_post.assert_not_called()
+        # The newer list stored meanwhile is edited in as well
+        self.assertEqual(mock_patch.call_count, 2)
+        embed = mock_patch.call_args[1]['json']['embeds'][0]
+        self.assertEqual(embed['fields'][0]['name'], "Services affected: 2")
+
+    def test_outside_window_is_sent(self):
+        self.notify(self.host_down)
+        with patch('time.time', return_value=cmk_discord.time.time() + 601):
+            mock_post, mock_patch = self.notify(self.service_crit)
+        mock_post.assert_called_once()
+        mock_patch.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
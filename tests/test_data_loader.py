@@ -5,8 +5,11 @@ Utility module for loading test data from JSON files.
 import json
 import os
 import sys
+import tempfile
+import unittest
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional
+from unittest.mock import patch
 
 # Add parent directory to path to import cmk_discord
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
@@ -154,3 +157,27 @@ def generate_test_params_for_all_versions():
                 params.append((version, category, filepath, filename))
 
     return params
+
+
+def use_state_dir(test: unittest.TestCase, config: Optional[dict] = None, **env: str) -> str:
+    """
+    Give a test its own temporary state directory for the duration of the test.
+
+    Args:
+        test: The test case, which undoes everything in its cleanups
+        config: Optional configuration data returned by a patched Config.load()
+        env: Additional environment variables to set
+
+    Returns:
+        Path of the state directory
+    """
+    tmp = tempfile.TemporaryDirectory()
+    test.addCleanup(tmp.cleanup)
+    patcher = patch.dict(os.environ, dict(env, CMK_DISCORD_STATE_DIR=tmp.name))
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    if config is not None:
+        patcher = patch('cmk_discord.Config.load', return_value=cmk_discord.Config(config))
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    return tmp.name
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+from unittest.mock import patch, MagicMock
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import load_test_data, use_state_dir
+
+
+class TestDeduplicator(unittest.TestCase):
+    """Tests for collapsing duplicate invocations"""
+
+    def setUp(self):
+        use_state_dir(self, {"dedupe": {"ttl": 3600, "inflight_timeout": 60}})
+        self.ctx = load_test_data("service/problem_critical.json", version="2.4.0p12")
+
+    def notify(self, ctx, status_code=204):
+        with patch('cmk_discord.Context.from_env', return_value=ctx), patch('requests.post') as mock_post:
+            mock_post.return_value = MagicMock(status_code=status_code)
+            try:
+                cmk_discord.notify()
+            except SystemExit:
+                pass
+        return mock_post.call_count
+
+    def test_problem_id_parsed(self):
+        self.assertEqual(self.ctx.problem_id, "notify_test_1762859618509652")
+
+    def test_per_contact_fan_in(self):
+        self.assertEqual([self.notify(self.ctx) for _ in range(3)], [1, 0, 0])
+
+    def test_different_incidents_are_sent(self):
+        self.notify(self.ctx)
+        other = load_test_data("service/problem_critical.json", version="2.4.0p12")
+        other.service_state = "WARNING"
+        self.assertEqual(self.notify(other), 1)
+
+    def test_failed_send_can_be_retried(self):
+        with patch('sys.stderr.write'):
+            self.assertEqual(self.notify(self.ctx, status_code=500), 1)
+        self.assertEqual(self.notify(self.ctx), 1)
+        self.assertEqual(self.notify(self.ctx), 0)
+
+    def test_stale_in_flight_claim(self):
+        dedupe = cmk_discord.Deduplicator(inflight_timeout=60)
+        url = self.ctx.webhook_url
+        self.assertIsNotNone(dedupe.claim(self.ctx, url))
+        self.assertIsNone(dedupe.claim(self.ctx, url))
+        with patch('time.time', return_value=cmk_discord.time.time() + 61):
+            self.assertIsNotNone(dedupe.claim(self.ctx, url))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+import json
+import socket
+import threading
+import time
+from dataclasses import asdict, replace
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import get_data_dir, use_state_dir
+
+
+HOOK_A = "https://discord.com/api/webhooks/1/a"
+HOOK_B = "https://discord.com/api/webhooks/2/b"
+
+
+def context(hostname="myhost"):
+    with open(get_data_dir("2.4.0p12") / "service/problem_critical.json", "r") as f:
+        env = json.load(f)
+    env["NOTIFY_HOSTNAME"] = hostname
+    return cmk_discord.Context.from_dict({key[7:]: value for (key, value) in env.items()})
+
+
+class TestDispatcher(unittest.TestCase):
+    """Tests for the resident Dispatcher"""
+
+    def setUp(self):
+        self.tmp = use_state_dir(self)
+        # Restored along with the rest of the environment
+        os.environ["CMK_DISCORD_CONFIG"] = os.path.join(self.tmp, "config.json")
+        self.write_config({"dispatcher": {"rate": 0}})
+        self.socket = os.path.join(self.tmp, "dispatcher.sock")
+
+    def write_config(self, data):
+        path = os.environ["CMK_DISCORD_CONFIG"]
+        with open(path, "w") as f:
+            f.write(data if isinstance(data, str) else json.dumps(data))
+        os.utime(path, (os.stat(path).st_mtime + 1,) * 2)
+
+    def test_forward_and_deliver(self):
+        delivered = threading.Event()
+        dispatcher = cmk_discord.Dispatcher(self.socket, concurrency=2)
+        with patch("cmk_discord.deliver", side_effect=lambda ctx, *args, done, **kwargs: (delivered.set(), done([]))):
+            dispatcher.start()
+            self.assertTrue(cmk_discord.forward(context(), self.socket))
+            self.assertTrue(delivered.wait(5))
+            self.assertEqual(dispatcher.drain(), 0)
+        self.assertEqual(dispatcher.stats["sent"], 1)
+        self.assertFalse(os.path.exists(self.socket))
+
+    def test_forward_without_dispatcher(self):
+        self.assertFalse(cmk_discord.forward(context(), self.socket))
+
+    def test_rejects_foreign_webhooks(self):
+        dispatcher = cmk_discord.Dispatcher(self.socket, concurrency=1)
+        with patch("cmk_discord.deliver") as deliver:
+            dispatcher.start()
+            for ctx in (replace(context(), webhook_url="https://discord.com.example.org/api/webhooks/1/a"),
+                        replace(context(), site_url="file:///etc/passwd")):
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                    connection.connect(self.socket)
+                    connection.sendall(json.dumps(asdict(ctx)).encode() + b"\n")
+                    connection.shutdown(socket.SHUT_WR)
+                    self.assertTrue(connection.recv(256).startswith(b"error Invalid"))
+            self.assertEqual(dispatcher.drain(), 0)
+        deliver.assert_not_called()
+
+    def test_sites_share_one_dispatcher(self):
+        self.write_config({"dispatcher": {"rate": 0, "socket_mode": "0660"}})
+        delivered = []
+        done = threading.Event()
+
+        def deliver(ctx, *args, **kwargs):
+            delivered.append((ctx.omd_site, ctx.hostname))
+            kwargs["done"]([])
+            if len(delivered) == 2:
+                done.set()
+
+        dispatcher = cmk_discord.Dispatcher(self.socket, concurrency=1)
+        with patch("cmk_discord.deliver", side_effect=deliver):
+            dispatcher.start()
+            self.assertEqual(oct(os.stat(self.socket).st_mode & 0o777), "0o660")
+            for site in ("site1", "site2"):
+                self.assertTrue(cmk_discord.forward(replace(context(), omd_site=site), self.socket))
+            self.assertTrue(done.wait(5))
+            dispatcher.drain()
+        self.assertEqual(sorted(delivered), [("site1", "myhost"), ("site2", "myhost")])
+        self.assertEqual(dispatcher.sites, {"site1": 1, "site2": 1})
+
+    def test_stats(self):
+        self.write_config({"dispatcher": {"rate": 0}, "adaptive_concurrency": {"initial": 2}})
+        dispatcher = cmk_discord.Dispatcher(self.socket, concurrency=4)
+        dispatcher.start()
+        self.addCleanup(dispatcher.drain)
+        with patch("sys.stdout.write") as write:
+            self.assertEqual(cmk_discord.stats(SimpleNamespace(socket=self.socket)), 0)
+        stats = json.loads("".join(call.args[0] for call in write.call_args_list))
+        self.assertEqual(stats["received"], 0)
+        self.assertEqual(stats["concurrency"]["limit"], 2)
+
+    def test_reload(self):
+        dispatcher = cmk_discord.Dispatcher(self.socket)
+        self.assertEqual(dispatcher.config.router.route(context()), [context().webhook_url])
+        self.write_config({"routes": [{"hostname": ["myhost"], "webhooks": [HOOK_A]}]})
+        self.assertTrue(dispatcher.reload())
+        self.assertEqual(dispatcher.config.router.route(context()), [HOOK_A])
+        self.assertEqual(dispatcher.config.router.route(context("otherhost")), [context().webhook_url])
+
+    def test_reload_applies_rate_weights_and_retry(self):
+        dispatcher = cmk_discord.Dispatcher(self.socket)
+        self.write_config({"dispatcher": {"rate": 2, "weights": {"critical": 4}},
+                           "retry": {"interval": 3, "attempts": 5}, "timeout": 2.5})
+        self.addCleanup(setattr, cmk_discord.DiscordWebhook, "timeout", cmk_discord.DiscordWebhook.timeout)
+        self.assertTrue(dispatcher.reload())
+        self.assertEqual(dispatcher.pacer.interval, 0.5)
+        self.assertEqual([queue.weights for queue in dispatcher.queues],
+                         [{"critical": 4}] * len(dispatcher.queues))
+        self.assertEqual((dispatcher.retry.interval, dispatcher.retry.attempts), (3, 5))
+        self.assertEqual(cmk_discord.DiscordWebhook.timeout, 2.5)
+
+    def test_reload_invalid_keeps_config(self):
+        dispatcher = cmk_discord.Dispatcher(self.socket)
+        config = dispatcher.config
+        self.write_config("{not json")
+        with patch("sys.stderr.write"):
+            self.assertFalse(dispatcher.reload())
+        self.assertIs(dispatcher.config, config)
+
+    def test_drain_persists_and_restart_sends_first(self):
+        release = threading.Event()
+        started = threading.Event()
+
+        def slow(ctx, *args, **kwargs):
+            started.set()
+            release.wait(5)
+            kwargs["done"]([])
+
+        dispatcher = cmk_discord.Dispatcher(self.socket, concurrency=1, drain_timeout=0.2)
+        with patch("cmk_discord.deliver", side_effect=slow):
+            dispatcher.start()
+            for i in range(3):
+                dispatcher.submit(context("host%i" % i))
+            self.assertTrue(started.wait(5))
+            self.assertEqual(dispatcher.drain(), 3)
+            release.set()
+
+        sent = []
+        restarted = cmk_discord.Dispatcher(self.socket, concurrency=1)
+        with patch("cmk_discord.deliver", side_effect=lambda ctx, *args, done, **kwargs: (sent.append(ctx.hostname),
+                                                                                           done([]))):
+            restarted.start()
+            restarted.drain()
+        self.assertEqual(sorted(sent), ["host0", "host1", "host2"])
+        self.assertFalse(os.path.exists(restarted.pending_path))
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("Timed out")
+            time.sleep(0.01)
+
+    @patch("sys.stderr.write")
+    @patch("requests.post")
+    def test_failed_routes_are_retried_with_backoff(self, post, stderr):
+        self.write_config({"dispatcher": {"rate": 0}, "retry": {"interval": 0.1},
+                           "routes": [{"hostname": ["myhost"], "webhooks": [HOOK_A, HOOK_B]}]})
+        statuses = {HOOK_A: [204], HOOK_B: [500, 204]}
+        calls = []
+
+        def send(url, **kwargs):
+            calls.append((time.monotonic(), url))
+            return MagicMock(status_code=statuses[url].pop(0))
+
+        post.side_effect = send
+        dispatcher = cmk_discord.Dispatcher(self.socket, concurrency=1)
+        dispatcher.start()
+        self.addCleanup(dispatcher.drain)
+        dispatcher.submit(context())
+        self.wait_for(lambda: dispatcher.stats["sent"])
+        self.assertEqual([url for (_, url) in calls], [HOOK_A, HOOK_B, HOOK_B])
+        self.assertGreaterEqual(calls[2][0] - calls[1][0], 0.1)
+        self.assertEqual((dispatcher.stats["sent"], dispatcher.stats["failed"]), (1, 1))
+
+    @patch("sys.stderr.write")
+    @patch("requests.post")
+    def test_retries_are_dropped_after_attempts(self, post, stderr):
+        self.write_config({"dispatcher": {"rate": 0}, "retry": {"interval": 0.01, "attempts": 3}})
+        post.return_value = MagicMock(status_code=500)
+        dispatcher = cmk_discord.Dispatcher(self.socket, concurrency=1)
+        dispatcher.start()
+        self.addCleanup(dispatcher.drain)
+        dispatcher.submit(context())
+        self.wait_for(lambda: dispatcher.stats["dropped"])
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual((dispatcher.stats["sent"], dispatcher.stats["failed"]), (0, 3))
+        self.assertEqual(list(dispatcher.retry.take()), [])
+
+    @patch("sys.stderr.write")
+    @patch("requests.post")
+    def test_retry_backlog_keeps_failed_routes(self, post, stderr):
+        self.write_config({"dispatcher": {"rate": 0}, "retry": {"interval": 60}, "catch_up": {"threshold": 3}})
+        dispatcher = cmk_discord.Dispatcher(self.socket, concurrency=1)
+        for i in range(4):
+            dispatcher.retry.add(replace(context(), service_desc="Service %i" % i), [HOOK_A if i % 2 else HOOK_B], 1)
+        with patch.object(dispatcher, "submit") as submit:
+            dispatcher._resubmit(dispatcher.retry.take())
+        self.assertEqual({tuple(call.args[2]) for call in submit.call_args_list}, {(HOOK_A,), (HOOK_B,)})
+        self.assertTrue(all(call.args[1] is not None for call in submit.call_args_list))
+
+    @patch("sys.stderr.write")
+    @patch("requests.post")
+    def test_retry_backlog_is_caught_up(self, post, stderr):
+        self.write_config({"dispatcher": {"rate": 0}, "retry": {"interval": 60}, "catch_up": {"threshold": 3}})
+        post.return_value = MagicMock(status_code=500)
+        dispatcher = cmk_discord.Dispatcher(self.socket, concurrency=1)
+        dispatcher.start()
+        self.addCleanup(dispatcher.drain)
+        for i in range(5):
+            ctx = replace(context(), service_desc="Service %i" % i)
+            dispatcher.submit(ctx if i == 4 else replace(ctx, notification_type="RECOVERY", service_state="OK"))
+        self.wait_for(lambda: dispatcher.stats["failed"] == 5)
+
+        # Discord is back: the failed notifications are collapsed like any other backlog
+        post.reset_mock()
+        post.return_value = MagicMock(status_code=204)
+        dispatcher._resubmit(dispatcher.retry.take())
+        self.wait_for(lambda: dispatcher.stats["sent"] == 2)
+        titles = [call.kwargs["json"]["embeds"][0]["title"] for call in post.call_args_list]
+        self.assertTrue(titles[0].startswith(":clipboard: CATCHUP: Host: myhost"))
+        self.assertEqual(len(titles), 2)
+
+    @patch("sys.stderr.write")
+    @patch("requests.post")
+    def test_drain_persists_batched_embeds(self, post, stderr):
+        self.write_config({"dispatcher": {"rate": 0}, "batching": {"max_delay": 60}, "dedupe": {"ttl": 60}})
+        release = threading.Event()
+        started = threading.Event()
+
+        def slow(url, **kwargs):
+            started.set()
+            release.wait(5)
+            return MagicMock(status_code=204)
+
+        post.side_effect = slow
+        dispatcher = cmk_discord.Dispatcher(self.socket, concurrency=1, drain_timeout=0.2)
+        dispatcher.start()
+        for i in range(3):
+            dispatcher.submit(context("host%i" % i))
+        self.assertTrue(started.wait(5))
+        # A message in flight, the other embeds wait in the batcher
+        batcher = dispatcher.batcher
+        queued = lambda: list(batcher.pending.values()) + list(batcher.sending.values())
+        self.wait_for(lambda: sum(len(items) for items in queued()) == 3)
+        self.assertEqual(dispatcher.drain(), 3)
+        release.set()
+        self.assertEqual(dispatcher.stats["sent"], 0)
+
+        post.reset_mock(side_effect=True)
+        post.return_value = MagicMock(status_code=204)
+        self.write_config({"dispatcher": {"rate": 0}, "dedupe": {"ttl": 60}})
+        restarted = cmk_discord.Dispatcher(self.socket, concurrency=1)
+        restarted.start()
+        self.wait_for(lambda: restarted.stats["sent"] == 3)
+        restarted.drain()
+        self.assertEqual(sorted(c.kwargs["json"]["embeds"][0]["fields"][0]["value"] for c in post.call_args_list),
+                         ["host0", "host1", "host2"])
+
+    def test_restart_time_and_notification_gap(self):
+        sent = []
+
+        def deliver(ctx, *args, done, **kwargs):
+            time.sleep(0.002)
+            sent.append((time.monotonic(), ctx.hostname))
+            done([])
+
+        hosts = ["host%i" % i for i in range(200)]
+        first = cmk_discord.Dispatcher(self.socket, concurrency=2, drain_timeout=1)
+        with patch("cmk_discord.deliver", side_effect=deliver):
+            first.start()
+            for hostname in hosts:
+                first.submit(context(hostname))
+            self.wait_for(lambda: sent)
+            stopping = time.monotonic()
+            persisted = first.drain()
+            restarted = cmk_discord.Dispatcher(self.socket, concurrency=2)
+            restarted.start()
+            restart = time.monotonic() - stopping
+            self.wait_for(lambda: len(sent) >= len(hosts))
+            restarted.drain()
+
+        self.assertGreater(persisted, 0)
+        # Every notification is sent exactly once across the restart
+        self.assertEqual(sorted(hostname for (_, hostname) in sent), sorted(hosts))
+        self.assertLess(restart, 1.0)
+        times = sorted(t for (t, _) in sent)
+        self.assertLess(max(b - a for (a, b) in zip(times, times[1:])), 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
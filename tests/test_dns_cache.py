@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+import socket
+from unittest.mock import patch, MagicMock
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import use_state_dir
+
+ADDRESS = (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", ("162.159.128.233", 443))
+
+
+class TestDnsCache(unittest.TestCase):
+    """Tests for the file-backed DnsCache with a stubbed resolver"""
+
+    def setUp(self):
+        use_state_dir(self)
+        self.resolver = MagicMock(return_value=([ADDRESS], 60))
+
+    def test_shared_between_instances(self):
+        self.assertEqual(cmk_discord.DnsCache(resolver=self.resolver).resolve("discord.com", 443), [ADDRESS])
+        self.assertEqual(cmk_discord.DnsCache(resolver=self.resolver).resolve("discord.com", 443), [ADDRESS])
+        self.resolver.assert_called_once_with("discord.com", 443)
+
+    def test_honors_ttl(self):
+        cache = cmk_discord.DnsCache(resolver=self.resolver)
+        cache.resolve("discord.com", 443)
+        with patch('time.time', return_value=cmk_discord.time.time() + 61):
+            cache.resolve("discord.com", 443)
+        self.assertEqual(self.resolver.call_count, 2)
+
+    def test_falls_back_when_cache_unusable(self):
+        cache = cmk_discord.DnsCache(resolver=self.resolver)
+        with patch('cmk_discord.StateStore.__enter__', side_effect=OSError("read-only")):
+            self.assertEqual(cache.resolve("discord.com", 443), [ADDRESS])
+
+    def test_installed_getaddrinfo(self):
+        original = socket.getaddrinfo
+        with cmk_discord.DnsCache(resolver=self.resolver):
+            self.assertEqual(socket.getaddrinfo("discord.com", 443, 0, socket.SOCK_STREAM), [ADDRESS])
+            self.assertEqual(socket.getaddrinfo("discord.com", 443, socket.AF_INET), [ADDRESS])
+        self.assertIs(socket.getaddrinfo, original)
+
+    def test_resolver_failure_is_raised_once(self):
+        self.resolver.side_effect = socket.gaierror("no resolver")
+        cache = cmk_discord.DnsCache(resolver=self.resolver)
+        with patch.object(cache, '_getaddrinfo', return_value=[ADDRESS]) as mock_getaddrinfo:
+            with self.assertRaises(socket.gaierror):
+                cache.getaddrinfo("discord.com", 443)
+        self.resolver.assert_called_once()
+        mock_getaddrinfo.assert_not_called()
+
+    def test_resolver_failure_without_cache_is_raised_once(self):
+        self.resolver.side_effect = socket.gaierror("no resolver")
+        cache = cmk_discord.DnsCache(resolver=self.resolver)
+        with patch('cmk_discord.StateStore.__enter__', side_effect=OSError("read-only")):
+            with self.assertRaises(socket.gaierror):
+                cache.getaddrinfo("discord.com", 443)
+        self.resolver.assert_called_once()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+from unittest.mock import patch, MagicMock
+
+import requests
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import load_test_data, use_state_dir
+
+PRIMARY = "https://discord.com/api/webhooks/1/primary"
+BACKUP = "https://discord.com/api/webhooks/2/backup"
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Tests for per-webhook health and failover"""
+
+    def setUp(self):
+        use_state_dir(self)
+        self.breaker = cmk_discord.CircuitBreaker({PRIMARY: BACKUP}, failures=3, cooldown=60)
+        self.ctx = load_test_data("service/problem_critical.json", version="2.4.0p12")
+        self.ctx.webhook_url = PRIMARY
+
+    def fail(self, url, times, now=0):
+        for _ in range(times):
+            self.breaker.observe(url, False, MagicMock(status_code=502), now=now)
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail(PRIMARY, 2)
+        self.breaker.observe(PRIMARY, True, MagicMock(status_code=204))
+        self.fail(PRIMARY, 2)
+        self.assertEqual(self.breaker.select(PRIMARY, now=1), PRIMARY)
+        self.fail(PRIMARY, 1)
+        self.assertEqual(self.breaker.select(PRIMARY, now=1), BACKUP)
+
+    def test_rate_limits_do_not_count(self):
+        for _ in range(5):
+            self.breaker.observe(PRIMARY, False, MagicMock(status_code=429))
+        self.assertEqual(self.breaker.select(PRIMARY), PRIMARY)
+
+    def test_long_rate_limit_fails_over(self):
+        self.breaker.observe(PRIMARY, False, MagicMock(status_code=429, headers={"Retry-After": "30"}), now=0)
+        self.assertEqual(self.breaker.select(PRIMARY, now=1), PRIMARY)
+        self.breaker.observe(PRIMARY, False, MagicMock(status_code=429, headers={"Retry-After": "600"}), now=0)
+        self.assertEqual(self.breaker.select(PRIMARY, now=1), BACKUP)
+        self.assertEqual(self.breaker.select(PRIMARY, now=599), BACKUP)
+
+    @patch("requests.get")
+    def test_half_open_probe(self, get):
+        self.fail(PRIMARY, 3, now=0)
+        get.return_value = MagicMock(status_code=500)
+        self.assertEqual(self.breaker.select(PRIMARY, now=30), BACKUP)
+        get.assert_not_called()
+        self.assertEqual(self.breaker.select(PRIMARY, now=61), BACKUP)
+        get.assert_called_once_with(PRIMARY, timeout=5)
+        self.assertEqual(self.breaker.select(PRIMARY, now=100), BACKUP)
+        get.return_value = MagicMock(status_code=200)
+        self.assertEqual(self.breaker.select(PRIMARY, now=122), PRIMARY)
+        self.assertEqual(self.breaker.select(PRIMARY, now=0), PRIMARY)
+
+    @patch("requests.get", side_effect=requests.ConnectionError("down"))
+    def test_fail_fast_without_available_fallback(self, get):
+        self.fail(PRIMARY, 3)
+        self.fail(BACKUP, 3)
+        self.assertIsNone(self.breaker.select(PRIMARY, now=1))
+
+    @patch("requests.post")
+    def test_deliver_fails_over(self, post):
+        config = cmk_discord.Config({"failover": {"webhooks": {PRIMARY: BACKUP}, "failures": 2}})
+        post.return_value = MagicMock(status_code=502, text="Bad Gateway")
+        for _ in range(2):
+            with self.assertRaises(SystemExit), patch("sys.stderr.write"):
+                cmk_discord.deliver(self.ctx, config)
+        post.return_value = MagicMock(status_code=204)
+        cmk_discord.deliver(self.ctx, config)
+        self.assertEqual([c.kwargs["url"] for c in post.call_args_list], [PRIMARY, PRIMARY, BACKUP])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+import time
+import datetime
+from dataclasses import replace
+from unittest.mock import patch, MagicMock
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import load_test_data, use_state_dir
+
+URL = "https://discord.com/api/webhooks/1/a"
+DAY = 86400
+
+
+class TestHistory(unittest.TestCase):
+    """Tests for the indexed local History"""
+
+    def setUp(self):
+        use_state_dir(self)
+        self.history = cmk_discord.History(retention=30)
+        self.ctx = load_test_data("service/problem_critical.json", version="2.4.0p12")
+        self.now = time.time() // DAY * DAY + 3600
+
+    def fill(self, days=10, hosts=5):
+        for day in range(days, -1, -1):
+            for host in range(hosts):
+                ctx = replace(self.ctx, hostname="host%i" % host, service_desc="CPU" if host % 2 else "Disk")
+                self.history.append(ctx, URL, "abc", 204 if host else 502, 0.2, now=self.now - day * DAY)
+
+    def test_query_newest_first(self):
+        self.fill()
+        records = self.history.query(since=30 * DAY, limit=3, now=self.now)
+        self.assertEqual([r["host"] for r in records], ["host4", "host3", "host2"])
+        self.assertEqual(records[0]["service"], "Disk")
+        self.assertEqual(records[0]["webhook"], cmk_discord.WebhookPool._key(URL))
+
+    def test_indexed_filters(self):
+        self.fill()
+        records = self.history.query(host="host3", since=30 * DAY, now=self.now)
+        self.assertEqual(len(records), 11)
+        self.assertEqual({r["host"] for r in records}, {"host3"})
+        self.assertTrue(os.path.exists(os.path.join(self.history.directory,
+                                                    cmk_discord.History._day(self.now - DAY) + ".idx")))
+        self.assertEqual(len(self.history.query(host="host3", service="Disk", since=30 * DAY, now=self.now)), 0)
+        self.assertEqual(len(self.history.query(service="Disk", since=30 * DAY, now=self.now)), 33)
+        self.assertEqual(len(self.history.query(status="failed", since=30 * DAY, now=self.now)), 11)
+
+    def test_time_range(self):
+        self.fill()
+        records = self.history.query(since=2 * DAY, until=self.now - 3 * DAY, now=self.now)
+        self.assertEqual(len(records), 15)
+
+    def test_cli_absolute_range(self):
+        self.fill()
+        day = datetime.datetime.fromtimestamp(self.now - 3 * DAY)
+        args = ["history", "--from", day.strftime("%Y-%m-%d 00:00"), "--until", day.strftime("%Y-%m-%d 23:59")]
+        with patch("sys.stderr.write"), patch("builtins.print") as output:
+            self.assertEqual(cmk_discord.cli(args), 0)
+        self.assertEqual(output.call_count, 5)
+        self.assertTrue(all(call.args[0].startswith(day.strftime("%Y-%m-%d")) for call in output.call_args_list))
+
+    def test_retention_by_segment(self):
+        self.fill(days=40, hosts=1)
+        days = sorted(name for name in os.listdir(self.history.directory) if name.endswith(".ndjson"))
+        self.assertEqual(len(days), 31)
+
+    def test_recorded_on_delivery(self):
+        config = cmk_discord.Config({"history": {"retention": 7}})
+        with patch("requests.post", return_value=MagicMock(status_code=204)):
+            cmk_discord.deliver(self.ctx, config)
+        records = cmk_discord.History().query()
+        self.assertEqual((records[0]["host"], records[0]["status"]), (self.ctx.hostname, 204))
+        self.assertEqual(len(records[0]["hash"]), 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
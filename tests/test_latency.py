@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+import time
+from dataclasses import replace
+from unittest.mock import patch, MagicMock
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import load_test_data, use_state_dir
+
+URL = "https://discord.com/api/webhooks/1/a"
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    """Tests for the event-to-acknowledgement latency histogram"""
+
+    def setUp(self):
+        use_state_dir(self)
+        self.ctx = load_test_data("service/problem_critical.json", version="2.4.0p12")
+
+    def test_microtime_parsed(self):
+        self.assertEqual(self.ctx.microtime, "1762859460000000")
+        ctx = replace(self.ctx, microtime="1762859460250000")
+        self.assertIn(":00.250000", cmk_discord.Embed.from_context(ctx).timestamp)
+
+    def test_buckets(self):
+        for seconds in (0.0005, 0.01, 0.3, 2.0, 45.0):
+            value = cmk_discord.LatencyHistogram.bucket_value(cmk_discord.LatencyHistogram.bucket(seconds))
+            self.assertLess(abs(value - max(seconds, 0.001)) / max(seconds, 0.001), 0.2)
+
+    def test_percentiles_per_interval(self):
+        histogram = cmk_discord.LatencyHistogram(resolution=3600)
+        event = (time.time() - 7200) // 3600 * 3600
+        self.ctx = replace(self.ctx, microtime=str(int(event * 1000000)))
+        for i in range(100):
+            histogram.record(self.ctx, URL, now=event + 0.5 + (i == 99) * 30)
+        histogram.record(replace(self.ctx, microtime=str(int((event + 3600) * 1000000))), URL, now=event + 3602)
+        histogram.record(replace(self.ctx, omd_site="other"), URL, now=event + 10)
+
+        rows = histogram.query(site=self.ctx.omd_site, url=URL, since=86400, now=event + 7200)
+        self.assertEqual([row[1] for row in rows], [100, 1])
+        start, count, p50, p90, p99, maximum = rows[0]
+        self.assertAlmostEqual(p50, 0.5, delta=0.1)
+        self.assertAlmostEqual(p99, 0.5, delta=0.1)
+        self.assertAlmostEqual(maximum, 30, delta=6)
+        self.assertAlmostEqual(rows[1][2], 2, delta=0.4)
+        self.assertEqual(histogram.query(url="https://discord.com/api/webhooks/2/b", now=event), [])
+        self.assertEqual(sum(row[1] for row in histogram.query(interval=86400, now=event + 7200)), 102)
+
+    def test_recorded_on_delivery(self):
+        config = cmk_discord.Config({"latency": {"resolution": 60}})
+        with patch("requests.post", return_value=MagicMock(status_code=204)):
+            cmk_discord.deliver(self.ctx, config)
+        rows = cmk_discord.LatencyHistogram(resolution=60).query(since=120)
+        self.assertEqual(rows[0][1], 1)
+
+    def test_duration(self):
+        self.assertEqual([cmk_discord.duration(t) for t in ("90", "15m", "6h", "7d")], [90, 900, 21600, 604800])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+from unittest.mock import patch, MagicMock
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import load_test_data, use_state_dir
+
+URLS = ["https://discord.com/api/webhooks/%i/token" % i for i in range(4)]
+
+
+def response(status_code=204, headers=None):
+    mock_response = MagicMock(status_code=status_code)
+    mock_response.headers = headers or {}
+    return mock_response
+
+
+class TestWebhookPool(unittest.TestCase):
+    """Tests for WebhookPool selection"""
+
+    def setUp(self):
+        use_state_dir(self)
+        self.ctx = load_test_data("service/problem_critical.json", version="2.4.0p12")
+
+    def other_host(self, hostname):
+        ctx = load_test_data("service/problem_critical.json", version="2.4.0p12")
+        ctx.hostname = hostname
+        return ctx
+
+    def test_consistent_per_host(self):
+        pool = cmk_discord.WebhookPool(URLS)
+        first = pool.select(self.ctx)
+        self.assertEqual({pool.select(self.ctx) for _ in range(5)}, {first})
+        hosts = {pool.select(self.other_host("host%i" % i)) for i in range(50)}
+        self.assertEqual(hosts, set(URLS))
+
+    def test_consistent_skips_exhausted(self):
+        pool = cmk_discord.WebhookPool(URLS)
+        first = pool.select(self.ctx)
+        pool.observe(first, response(headers={"X-RateLimit-Remaining": "0", "X-RateLimit-Reset-After": "5"}))
+        second = pool.select(self.ctx)
+        self.assertNotEqual(second, first)
+        self.assertEqual(pool.select(self.ctx), second)
+
+    def test_reserves_budget(self):
+        pool = cmk_discord.WebhookPool(URLS)
+        first = pool.select(self.ctx)
+        pool.observe(first, response(headers={"X-RateLimit-Remaining": "2", "X-RateLimit-Reset-After": "5"}))
+        self.assertEqual(pool.select(self.ctx), first)
+        self.assertEqual(pool.select(self.ctx), first)
+        self.assertNotEqual(pool.select(self.ctx), first)
+
+    def test_too_many_requests(self):
+        pool = cmk_discord.WebhookPool(URLS[:2])
+        first = pool.select(self.ctx)
+        pool.observe(first, response(429, headers={"Retry-After": "10"}))
+        self.assertNotEqual(pool.select(self.ctx), first)
+
+    def test_all_exhausted_uses_earliest_reset(self):
+        pool = cmk_discord.WebhookPool(URLS[:2])
+        pool.observe(URLS[0], response(headers={"X-RateLimit-Remaining": "0", "X-RateLimit-Reset-After": "9"}))
+        pool.observe(URLS[1], response(headers={"X-RateLimit-Remaining": "0", "X-RateLimit-Reset-After": "3"}))
+        self.assertEqual(pool.select(self.ctx), URLS[1])
+
+    def test_least_loaded(self):
+        pool = cmk_discord.WebhookPool(URLS[:3], strategy="least_loaded")
+        for url, remaining in zip(URLS, ["1", "4", "2"]):
+            pool.observe(url, response(headers={"X-RateLimit-Remaining": remaining, "X-RateLimit-Reset-After": "5"}))
+        self.assertEqual(pool.select(self.ctx), URLS[1])
+
+    @patch('sys.stderr.write')
+    def test_invalid_strategy(self, mock_stderr):
+        with self.assertRaises(SystemExit):
+            cmk_discord.WebhookPool(URLS, strategy="random")
+
+    @patch('requests.post')
+    @patch('cmk_discord.Context.from_env')
+    def test_notify_uses_pool(self, mock_from_env, mock_post):
+        self.ctx.webhook_url = URLS[0]
+        mock_from_env.return_value = self.ctx
+        mock_post.return_value = response()
+        config = cmk_discord.Config({"pools": {"webhooks": [URLS]}})
+        with patch('cmk_discord.Config.load', return_value=config):
+            cmk_discord.notify()
+
+        self.assertEqual(mock_post.call_args[1]['url'], cmk_discord.WebhookPool(URLS).select(self.ctx))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+import pstats
+from unittest.mock import patch, MagicMock
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import load_latest_test_data, use_state_dir
+
+
+class TestProfiler(unittest.TestCase):
+    """Tests for the opt-in profiler hook"""
+
+    def setUp(self):
+        self.tmp = use_state_dir(self)
+
+    def test_disabled_by_default(self):
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertIsNone(cmk_discord.Profiler.from_config(cmk_discord.Config({})))
+
+    def test_enabled_by_env(self):
+        with patch.dict(os.environ, {"CMK_DISCORD_PROFILE": "10"}):
+            profiler = cmk_discord.Profiler.from_config(cmk_discord.Config({}))
+        self.assertEqual(profiler.sample, 10)
+        self.assertEqual(profiler.directory, os.path.join(self.tmp, "profiles"))
+
+    @patch('requests.post')
+    @patch('cmk_discord.Context.from_env')
+    def test_main_writes_rotated_reports(self, mock_from_env, mock_post):
+        mock_from_env.return_value = load_latest_test_data("service", "problem_critical.json")
+        mock_post.return_value = MagicMock(status_code=204)
+        config = cmk_discord.Config({"profile": {"sample": 1, "directory": self.tmp, "keep": 2}})
+
+        with patch('cmk_discord.Config.load', return_value=config):
+            for _ in range(3):
+                cmk_discord.main()
+
+        files = sorted(os.listdir(self.tmp))
+        self.assertEqual(len([f for f in files if f.endswith(".pstats")]), 2)
+        self.assertEqual(len([f for f in files if f.endswith(".malloc.txt")]), 2)
+        stats = pstats.Stats(os.path.join(self.tmp, [f for f in files if f.endswith(".pstats")][0]))
+        self.assertTrue(any(func[2] == "notify" for func in stats.stats))
+        self.assertEqual(mock_post.call_count, 3)
+
+    def test_sampling_skips_profiling(self):
+        profiler = cmk_discord.Profiler(1000, self.tmp)
+        func = MagicMock()
+        with patch('random.random', return_value=0.5):
+            profiler.run(func)
+        func.assert_called_once()
+        self.assertEqual(os.listdir(self.tmp), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
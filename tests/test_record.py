@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+import gzip
+import json
+from unittest.mock import patch, MagicMock
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import get_data_dir, use_state_dir
+
+
+def load_env(version, path):
+    with open(os.path.join(get_data_dir(version), path), "r") as f:
+        return json.load(f)
+
+
+class TestRecorder(unittest.TestCase):
+    """Tests for recording sampled contexts into a corpus"""
+
+    def setUp(self):
+        self.tmp = use_state_dir(self)
+        self.env = load_env("2.4.0p12", "service/problem_critical.json")
+        self.env["NOTIFY_CONTACTEMAIL"] = "oncall@example.com"
+        self.env["NOTIFY_HOSTNAME"] = "db01.internal"
+
+    def from_env(self, config):
+        with patch.dict(os.environ, self.env, clear=True):
+            return cmk_discord.Context.from_env(cmk_discord.Recorder.from_config(config))
+
+    def read_corpus(self):
+        records = {}
+        for (root, _, files) in os.walk(self.tmp):
+            for name in files:
+                path = os.path.join(root, name)
+                with gzip.open(path, "rt") as f:
+                    records[os.path.relpath(path, self.tmp)] = [json.loads(line) for line in f]
+        return records
+
+    def test_disabled_by_default(self):
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertIsNone(cmk_discord.Recorder.from_config(cmk_discord.Config({})))
+
+    def test_enabled_by_env(self):
+        with patch.dict(os.environ, {"CMK_DISCORD_RECORD": "10"}):
+            recorder = cmk_discord.Recorder.from_config(cmk_discord.Config({}))
+        self.assertEqual(recorder.sample, 10)
+        self.assertEqual(recorder.directory, os.path.join(self.tmp, "corpus"))
+        self.assertEqual(recorder.version, "unknown")
+
+    def test_version_from_site(self):
+        os.symlink("../../versions/2.4.0p12.cre", os.path.join(self.tmp, "version"))
+        with patch.dict(os.environ, {"OMD_ROOT": self.tmp}):
+            self.assertEqual(cmk_discord.Recorder.get_version(), "2.4.0p12")
+
+    def test_records_redacted_context_in_fixture_layout(self):
+        config = cmk_discord.Config({"record": {"sample": 1, "directory": self.tmp, "version": "2.4.0p12",
+                                                "redact": ["NOTIFY_CONTACTEMAIL", "HOSTNAME"]}})
+        for _ in range(2):
+            ctx = self.from_env(config)
+        self.assertEqual(ctx.hostname, "db01.internal")
+
+        corpus = self.read_corpus()
+        self.assertEqual(list(corpus), [os.path.join("2.4.0p12", "service", "problem_critical.ndjson.gz")])
+        records = next(iter(corpus.values()))
+        self.assertEqual(len(records), 2)
+        record = records[0]
+        self.assertEqual(record["NOTIFY_PARAMETER_1"], cmk_discord.Recorder.WEBHOOK_REDACTED)
+        self.assertEqual(record["NOTIFY_PARAMETERS"],
+                         cmk_discord.Recorder.WEBHOOK_REDACTED + " https://checkmkhost.mycompany.com/my_monitoring")
+        self.assertEqual(record["NOTIFY_SERVICEOUTPUT"], self.env["NOTIFY_SERVICEOUTPUT"])
+        self.assertNotIn("db01", json.dumps(record))
+        self.assertNotIn("oncall@", json.dumps(record))
+        self.assertEqual(len(record["NOTIFY_HOSTNAME"]), len("db01.internal"))
+        self.assertEqual(record["NOTIFY_HOSTNAME"], records[1]["NOTIFY_HOSTNAME"])
+
+        # The corpus replays like any other trace
+        replayed = list(cmk_discord.read_notifications(
+            [os.path.join(self.tmp, "2.4.0p12", "service", "problem_critical.ndjson.gz")]
+        ))
+        self.assertEqual(len(replayed), 2)
+        cmk_discord.Context.from_dict(replayed[0]).validate()
+
+    @patch("requests.post")
+    def test_main_records(self, mock_post):
+        mock_post.return_value = MagicMock(status_code=204)
+        config = cmk_discord.Config({"record": {"sample": 1, "directory": self.tmp, "version": "2.4.0p12"}})
+        with patch.dict(os.environ, self.env, clear=True), patch("cmk_discord.Config.load", return_value=config):
+            cmk_discord.main()
+        self.assertEqual(list(self.read_corpus()), [os.path.join("2.4.0p12", "service", "problem_critical.ndjson.gz")])
+        mock_post.assert_called_once()
+
+    def test_host_notification_file(self):
+        self.env = load_env("2.4.0p12", "host/problem_down.json")
+        config = cmk_discord.Config({"record": {"sample": 1, "directory": self.tmp, "version": "2.4.0p12"}})
+        self.from_env(config)
+        self.assertEqual(list(self.read_corpus()), [os.path.join("2.4.0p12", "host", "problem_down.ndjson.gz")])
+
+    def test_size_cap(self):
+        config = cmk_discord.Config({"record": {"sample": 1, "directory": self.tmp, "max_bytes": 3000}})
+        for _ in range(20):
+            self.from_env(config)
+        recorder = cmk_discord.Recorder.from_config(config)
+        self.assertLessEqual(recorder.size(), 3000)
+        self.assertGreater(recorder.size(), 0)
+
+    def test_sampling_and_errors_never_fail(self):
+        config = cmk_discord.Config({"record": {"sample": 1000, "directory": self.tmp}})
+        with patch("random.random", return_value=0.5):
+            self.from_env(config)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+        blocked = os.path.join(self.tmp, "file")
+        open(blocked, "w").close()
+        config = cmk_discord.Config({"record": {"sample": 1, "directory": blocked}})
+        self.assertEqual(self.from_env(config).hostname, "db01.internal")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+import re
+import json
+import time
+import tempfile
+from dataclasses import replace
+from unittest.mock import patch, MagicMock
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import load_test_data, use_state_dir
+
+DB_HOOK = "https://discord.com/api/webhooks/1/db"
+NET_HOOK = "https://discord.com/api/webhooks/2/net"
+PROD_HOOK = "https://discord.com/api/webhooks/3/prod"
+
+
+class TestRouter(unittest.TestCase):
+    """Tests for Router.route()"""
+
+    def setUp(self):
+        # dns1, tags include "prod" and "lan", labels cmk/os_family=linux
+        self.ctx = load_test_data("service/problem_critical.json", version="2.4.0p12")
+
+    def test_default_webhook_without_rules(self):
+        router = cmk_discord.Router([])
+        self.assertEqual(router.route(self.ctx), [self.ctx.webhook_url])
+
+    def test_host_tags(self):
+        router = cmk_discord.Router([
+            {"host_tags": ["prod", "lan"], "webhooks": [PROD_HOOK]},
+            {"host_tags": ["prod", "wan"], "webhooks": [NET_HOOK]},
+        ])
+        self.assertEqual(router.route(self.ctx), [PROD_HOOK])
+
+    def test_host_labels_and_contact_groups(self):
+        router = cmk_discord.Router([
+            {"host_labels": {"cmk/os_family": "linux"}, "contact_groups": ["all"], "webhooks": [DB_HOOK]},
+            {"host_labels": {"cmk/os_family": "windows"}, "webhooks": [NET_HOOK]},
+        ])
+        self.assertEqual(router.route(self.ctx), [DB_HOOK])
+
+    def test_hostname_exact_and_regex(self):
+        router = cmk_discord.Router([
+            {"hostname": ["dns"], "webhooks": [NET_HOOK]},
+            {"hostname": ["dns1"], "webhooks": [DB_HOOK]},
+            {"hostname": ["~dns[0-9]+"], "webhooks": [PROD_HOOK]},
+        ])
+        self.assertEqual(router.route(self.ctx), [DB_HOOK, PROD_HOOK])
+
+    def test_service_pattern(self):
+        router = cmk_discord.Router([
+            {"service": ["Check_"], "webhooks": [DB_HOOK]},
+            {"service": ["Filesystem"], "webhooks": [NET_HOOK]},
+        ])
+        self.assertEqual(router.route(self.ctx), [DB_HOOK])
+
+    def test_service_pattern_never_matches_host_notifications(self):
+        ctx = load_test_data("host/problem_down.json", version="2.4.0p12")
+        router = cmk_discord.Router([{"service": [".*"], "webhooks": [DB_HOOK]}])
+        self.assertEqual(router.route(ctx), [ctx.webhook_url])
+
+    def test_multiple_rules_and_final(self):
+        router = cmk_discord.Router([
+            {"host_tags": ["prod"], "webhooks": [PROD_HOOK, DB_HOOK]},
+            {"hostname": ["dns1"], "webhooks": [DB_HOOK], "final": True},
+            {"webhooks": [NET_HOOK]},
+        ])
+        self.assertEqual(router.route(self.ctx), [PROD_HOOK, DB_HOOK])
+
+    @patch('sys.stderr.write')
+    def test_invalid_webhook(self, mock_stderr):
+        with self.assertRaises(SystemExit) as cm:
+            cmk_discord.Router([{"webhooks": ["https://invalid.com/webhook"]}])
+        self.assertEqual(cm.exception.code, 2)
+
+    def test_many_rules(self):
+        rules = [{"hostname": ["host%i" % i], "webhooks": [DB_HOOK]} for i in range(2000)]
+        rules += [{"hostname": ["~web%i-" % i], "host_tags": ["prod"], "webhooks": [NET_HOOK]} for i in range(2000)]
+        rules += [{"service": ["Service %i" % i], "webhooks": [NET_HOOK]} for i in range(3000)]
+        rules += [{"hostname": ["~dns"], "service": ["Oracle %i" % i], "webhooks": [NET_HOOK]} for i in range(1000)]
+        rules += [{"service": ["(?i:oracle %i)" % i], "webhooks": [NET_HOOK]} for i in range(1000)]
+        rules.append({"hostname": ["~dns"], "host_tags": ["prod"], "webhooks": [PROD_HOOK]})
+        rules.append({"service": ["Check_"], "webhooks": [DB_HOOK]})
+        router = cmk_discord.Router(rules)
+        self.assertEqual(router.route(self.ctx), [PROD_HOOK, DB_HOOK])
+
+        start = time.perf_counter()
+        for _ in range(100):
+            router.route(self.ctx)
+        self.assertLess((time.perf_counter() - start) / 100, 0.001)
+
+    def test_literal_prefix(self):
+        self.assertEqual(cmk_discord.PrefixIndex.literal_prefix("Filesystem /var"), "Filesystem /var")
+        self.assertEqual(cmk_discord.PrefixIndex.literal_prefix("db[0-9]+"), "db")
+        self.assertEqual(cmk_discord.PrefixIndex.literal_prefix("web1?"), "web")
+        self.assertEqual(cmk_discord.PrefixIndex.literal_prefix("(?i:oracle)"), "")
+        self.assertEqual(cmk_discord.PrefixIndex.literal_prefix("CPU|Memory"), "")
+
+    def test_index_matches_full_evaluation(self):
+        rules = [
+            {"hostname": ["~db0[12]", "mail"], "webhooks": [DB_HOOK]},
+            {"hostname": ["~d"], "service": ["Check", "(?i:cpu)"], "webhooks": [NET_HOOK]},
+            {"service": ["Check_MK$"], "host_tags": ["prod"], "webhooks": [PROD_HOOK]},
+        ]
+        router = cmk_discord.Router(rules)
+        for hostname in ("dns1", "db01", "mail", "web"):
+            for service in ("Check_MK", "CPU load", "Memory"):
+                ctx = replace(self.ctx, hostname=hostname, service_desc=service)
+                expected = [
+                    rule["webhooks"][0] for rule in rules
+                    if (not rule.get("hostname") or any(
+                        re.match(name[1:] if name[0] == "~" else re.escape(name) + "$", hostname)
+                        for name in rule["hostname"]))
+                    and (not rule.get("service") or any(re.match(p, service) for p in rule["service"]))
+                ]
+                self.assertEqual(router.route(ctx), expected or [self.ctx.webhook_url], (hostname, service))
+
+
+class TestConfig(unittest.TestCase):
+    """Tests for Config.load()"""
+
+    def setUp(self):
+        self.tmp = use_state_dir(self)
+
+    def test_missing_file(self):
+        config = cmk_discord.Config.load("/nonexistent/cmk_discord.json")
+        self.assertEqual(config.data, {})
+        self.assertEqual(config.section("routes"), {})
+
+    def test_cached_by_mtime(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cmk_discord.json")
+            with open(path, "w") as f:
+                json.dump({"routes": [{"webhooks": [DB_HOOK]}]}, f)
+            config = cmk_discord.Config.load(path)
+            self.assertIs(cmk_discord.Config.load(path), config)
+
+            with open(path, "w") as f:
+                json.dump({"routes": []}, f)
+            os.utime(path, ns=(0, 0))
+            self.assertIsNot(cmk_discord.Config.load(path), config)
+
+    def test_router_persisted_by_mtime(self):
+        path = os.path.join(self.tmp, "cmk_discord.json")
+        with open(path, "w") as f:
+            json.dump({"routes": [{"hostname": ["~dns"], "service": ["Check_"], "webhooks": [DB_HOOK]}]}, f)
+        ctx = load_test_data("service/problem_critical.json", version="2.4.0p12")
+        self.assertEqual(cmk_discord.Config.load(path).router.route(ctx), [DB_HOOK])
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp, "routers"))), 1)
+
+        # Another invocation loads the compiled rules
+        cmk_discord.Config._cache.clear()
+        with patch.object(cmk_discord.Router, '_compile_rule') as mock_compile:
+            self.assertEqual(cmk_discord.Config.load(path).router.route(ctx), [DB_HOOK])
+        mock_compile.assert_not_called()
+
+        with open(path, "w") as f:
+            json.dump({"routes": [{"service": ["Memory"], "webhooks": [NET_HOOK]}]}, f)
+        os.utime(path, (os.stat(path).st_mtime + 1,) * 2)
+        self.assertEqual(cmk_discord.Config.load(path).router.route(ctx), [ctx.webhook_url])
+
+    @patch('sys.stderr.write')
+    def test_invalid_file(self, mock_stderr):
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+            f.write("{not json")
+            f.flush()
+            with self.assertRaises(SystemExit) as cm:
+                cmk_discord.Config.load(f.name)
+        self.assertEqual(cm.exception.code, 2)
+
+    @patch('requests.post')
+    @patch('cmk_discord.Context.from_env')
+    def test_main_sends_to_routed_webhooks(self, mock_from_env, mock_post):
+        mock_from_env.return_value = load_test_data("service/problem_critical.json", version="2.4.0p12")
+        mock_post.return_value = MagicMock(status_code=204)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cmk_discord.json")
+            with open(path, "w") as f:
+                json.dump({"routes": [{"host_tags": ["prod"], "webhooks": [DB_HOOK, NET_HOOK]}]}, f)
+            with patch.dict(os.environ, {"CMK_DISCORD_CONFIG": path}):
+                cmk_discord.main()
+
+        self.assertEqual([c[1]['url'] for c in mock_post.call_args_list], [DB_HOOK, NET_HOOK])
+
+    @patch('sys.stderr.write')
+    @patch('requests.post')
+    @patch('cmk_discord.Context.from_env')
+    def test_main_sends_to_all_routes_when_one_fails(self, mock_from_env, mock_post, mock_stderr):
+        mock_from_env.return_value = load_test_data("service/problem_critical.json", version="2.4.0p12")
+        mock_post.side_effect = lambda url, **kwargs: MagicMock(status_code=500 if url == DB_HOOK else 204)
+        config = cmk_discord.Config({"routes": [{"host_tags": ["prod"], "webhooks": [DB_HOOK, NET_HOOK, PROD_HOOK]}]})
+        with patch('cmk_discord.Config.load', return_value=config):
+            with self.assertRaises(SystemExit) as cm:
+                cmk_discord.main()
+
+        self.assertEqual(cm.exception.code, 1)
+        self.assertEqual([c[1]['url'] for c in mock_post.call_args_list], [DB_HOOK, NET_HOOK, PROD_HOOK])
+
+
+if __name__ == '__main__':
+    unittest.main()
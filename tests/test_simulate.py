@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+import json
+from pathlib import Path
+from unittest.mock import patch
+
+# Add the scripts directory to path to import the simulator
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts')))
+
+import simulate
+from tests.test_data_loader import use_state_dir
+
+
+class TestSimulate(unittest.TestCase):
+    """Smoke tests for scripts/simulate.py"""
+
+    def setUp(self):
+        self.tmp = Path(use_state_dir(self))
+
+    def run_main(self, *args):
+        with patch("builtins.print") as output, patch("sys.stderr.write") as stderr:
+            self.assertEqual(simulate.main(["--count", "200", "--rate", "10", "--hosts", "20"] + list(args)), 0)
+        return json.loads(output.call_args.args[0]), stderr
+
+    def test_synthetic_trace(self):
+        result, _ = self.run_main()
+        self.assertEqual(result["alerts"], 200)
+        self.assertEqual(result["delivered"] + result["dropped"], 200)
+        self.assertLessEqual(result["requests"], 200 + result["throttled"] + result["server_errors"])
+
+    def test_unsimulated_sections_are_reported(self):
+        path = self.tmp / "cmk_discord.json"
+        path.write_text(json.dumps({"throttle": {"window": 60}, "batching": {"max_delay": 1}}))
+        result, stderr = self.run_main("--config", str(path))
+        self.assertEqual(result["alerts"], 200)
+        stderr.assert_called_once_with("Not simulated, every alert is sent: throttle\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+import threading
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import use_state_dir
+
+
+class TestStateStore(unittest.TestCase):
+    """Tests for the file-backed StateStore"""
+
+    def setUp(self):
+        use_state_dir(self)
+
+    def test_persists_between_transactions(self):
+        with cmk_discord.StateStore("test", 60) as store:
+            store.set("a", {"value": 1})
+        with cmk_discord.StateStore("test", 60) as store:
+            self.assertEqual(store.get("a"), {"value": 1})
+            store.delete("a")
+        with cmk_discord.StateStore("test", 60) as store:
+            self.assertIsNone(store.get("a"))
+
+    def test_expiry(self):
+        with cmk_discord.StateStore("test", 60) as store:
+            store.set("old", 1, expires=1)
+            store.set("new", 2)
+        with cmk_discord.StateStore("test", 60) as store:
+            self.assertIsNone(store.get("old"))
+            self.assertEqual(store.get("new"), 2)
+            self.assertGreater(store.expires("new"), 0)
+
+    def test_corrupt_file_is_reset(self):
+        store = cmk_discord.StateStore("test", 60)
+        with open(store.path, "w") as f:
+            f.write("{broken")
+        with store:
+            self.assertEqual(store.entries, {})
+
+
+    def test_shared_between_threads(self):
+        store = cmk_discord.StateStore("test", 60)
+
+        def writer(prefix):
+            for i in range(100):
+                with store:
+                    store.set("%s%i" % (prefix, i), i)
+
+        threads = [threading.Thread(target=writer, args=(prefix,)) for prefix in "ab"]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with store:
+            self.assertEqual(len(store.entries), 200)
+
+
+    def test_sharded(self):
+        store = cmk_discord.ShardedStateStore("test", 60, shards=4)
+        for i in range(20):
+            with store.shard("key%i" % i) as shard:
+                shard.set("key%i" % i, i)
+        sizes = []
+        for shard in store.shards:
+            with shard:
+                sizes.append(len(shard.entries))
+        self.assertEqual(sum(sizes), 20)
+        self.assertLess(max(sizes), 20)
+        self.assertEqual(store.entries()["key7"][1], 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+import json
+from unittest.mock import patch, MagicMock
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import load_test_data, use_state_dir
+
+WEBHOOK = "https://discord.com/api/webhooks/1/team"
+
+
+class TestTemplate(unittest.TestCase):
+    """Tests for compiled message templates"""
+
+    def setUp(self):
+        self.tmp = use_state_dir(self)
+        cmk_discord.Template._cache.clear()
+        self.ctx = load_test_data("service/problem_critical.json")
+        self.ctx.notification_comment = None
+
+    def write(self, spec, name="team.json"):
+        path = os.path.join(self.tmp, name)
+        with open(path, "w") as f:
+            json.dump(spec, f)
+        return path
+
+    def render(self, spec):
+        embed = cmk_discord.Embed.from_context(self.ctx)
+        embed.template = cmk_discord.Template.load(self.write(spec))
+        return embed.to_dict()
+
+    def test_names_and_filters(self):
+        embed = self.render({
+            "title": "{{ emoji }} {{ hostname | upper }}/{{ subject }}",
+            "description": "{{ previous_state }} -> {{ state }}: {{ output | truncate(10) }}",
+            "footer": "{{ omd_site }} {{ host_output | default(\"n/a\") }}",
+        })
+        self.assertEqual(embed["title"], ":rotating_light: WEBSERVER01/HTTP")
+        self.assertEqual(embed["description"], "OK -> CRITICAL: Connect...")
+        self.assertEqual(embed["footer"], {"text": "production n/a"})
+
+    def test_defaults_to_hard_coded_parts(self):
+        expected = cmk_discord.Embed.from_context(self.ctx).to_dict()
+        embed = self.render({"footer": "custom"})
+        self.assertEqual(embed["title"], expected["title"])
+        self.assertEqual(embed["description"], expected["description"])
+        self.assertEqual(embed["fields"], expected["fields"])
+        self.assertEqual(embed["url"], expected["url"])
+
+    def test_conditionals(self):
+        spec = {"description": "{% if notification_comment %}Comment: {{ notification_comment }}"
+                               "{% else %}No comment{% endif %}"}
+        self.assertEqual(self.render(spec)["description"], "No comment")
+        self.ctx.notification_comment = "on it"
+        self.assertEqual(self.render(spec)["description"], "Comment: on it")
+
+    def test_fields_skip_empty_values(self):
+        embed = self.render({"fields": [
+            {"name": "Host", "value": "{{ hostname }}", "inline": True},
+            {"name": "Comment", "value": "{{ notification_comment }}"},
+        ]})
+        self.assertEqual(embed["fields"], [{"name": "Host", "value": "webserver01", "inline": True}])
+
+    def test_notes_are_kept(self):
+        embed = cmk_discord.Embed.from_context(self.ctx)
+        embed.notes = [{"name": "Note", "value": "x", "inline": False}]
+        embed.template = cmk_discord.Template.load(self.write({"fields": []}))
+        self.assertEqual(embed.to_dict()["fields"], embed.notes)
+
+    @patch('sys.stderr.write')
+    def test_invalid_templates(self, mock_stderr):
+        for spec in ({"title": "{{ nonexistent }}"}, {"title": "{{ hostname | shout }}"},
+                     {"title": "{% if hostname %}unterminated"}):
+            cmk_discord.Template._cache.clear()
+            with self.assertRaises(SystemExit):
+                cmk_discord.Template.load(self.write(spec, name="bad%i.json" % len(str(spec))))
+
+    def test_cached_in_memory_and_on_disk(self):
+        path = self.write({"title": "{{ hostname }}"})
+        template = cmk_discord.Template.load(path)
+        self.assertIs(cmk_discord.Template.load(path), template)
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp, "templates"))), 1)
+
+        cmk_discord.Template._cache.clear()
+        with patch('builtins.compile') as mock_compile:
+            reloaded = cmk_discord.Template.load(path)
+        mock_compile.assert_not_called()
+        embed = cmk_discord.Embed.from_context(self.ctx)
+        self.assertEqual(reloaded.render(self.ctx, embed)["title"], "webserver01")
+
+        # Bytecode of an older compiler is not executed
+        cmk_discord.Template._cache.clear()
+        with patch.object(cmk_discord.Template, 'COMPILER_VERSION', cmk_discord.Template.COMPILER_VERSION + 1):
+            cmk_discord.Template.load(path)
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp, "templates"))), 2)
+
+    def test_compiled_in_memory_without_state_dir(self):
+        path = self.write({"title": "{{ hostname }}"})
+        with patch.dict(os.environ, {"CMK_DISCORD_STATE_DIR": "/proc/nope"}):
+            template = cmk_discord.Template.load(path)
+        embed = cmk_discord.Embed.from_context(self.ctx)
+        self.assertEqual(template.render(self.ctx, embed)["title"], "webserver01")
+
+        # A bytecode cache that cannot be written to
+        cmk_discord.Template._cache.clear()
+        with patch('os.replace', side_effect=OSError(30, "Read-only file system")):
+            template = cmk_discord.Template.load(path)
+        self.assertEqual(template.render(self.ctx, embed)["title"], "webserver01")
+        self.assertEqual(os.listdir(os.path.join(self.tmp, "templates")), [])
+
+    @patch('requests.post')
+    @patch('cmk_discord.Context.from_env')
+    def test_template_per_route(self, mock_from_env, mock_post):
+        mock_from_env.return_value = self.ctx
+        mock_post.return_value = MagicMock(status_code=204)
+        config = cmk_discord.Config({"routes": [
+            {"webhooks": [WEBHOOK], "template": self.write({"title": "Team {{ hostname }}"})},
+            {"webhooks": [self.ctx.webhook_url]},
+        ]})
+        with patch('cmk_discord.Config.load', return_value=config):
+            cmk_discord.notify()
+
+        titles = {c[1]['url']: c[1]['json']['embeds'][0]['title'] for c in mock_post.call_args_list}
+        self.assertEqual(titles[WEBHOOK], "Team webserver01")
+        self.assertEqual(titles[self.ctx.webhook_url], ":rotating_light: PROBLEM: HTTP")
+
+
+if __name__ == '__main__':
+    unittest.main()
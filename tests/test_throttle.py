@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+import unittest
+import sys
+import os
+from dataclasses import replace
+from unittest.mock import patch, MagicMock
+
+# Add parent directory to path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'notifications')))
+
+import cmk_discord
+from tests.test_data_loader import load_test_data, use_state_dir
+
+
+class TestThrottle(unittest.TestCase):
+    """Tests for renotification throttling"""
+
+    def setUp(self):
+        use_state_dir(self)
+        self.ctx = replace(load_test_data("service/problem_critical.json", version="2.4.0p12"),
+                           service_output="CRIT - 98.7% used")
+
+    def check(self, throttle, ctx, now):
+        action, since = throttle.check(ctx, now=now)
+        if action == "send":
+            throttle.sent(ctx, since, now=now)
+        return action, since
+
+    def renotify(self, number, **changes):
+        return replace(self.ctx, notification_number=str(number), **changes)
+
+    def notify(self, ctx, config, status_code=204):
+        with patch('cmk_discord.Context.from_env', return_value=ctx), \
+                patch('cmk_discord.Config.load', return_value=cmk_discord.Config(config)), \
+                patch('requests.post') as mock_post, patch('sys.stderr.write'):
+            mock_post.return_value = MagicMock(status_code=status_code)
+            cmk_discord.notify()
+        return mock_post.call_args.kwargs["json"]["embeds"][0] if mock_post.called else None
+
+    def test_notification_number_parsed(self):
+        self.assertEqual(self.ctx.notification_number, "1")
+
+    def test_unchanged_renotification_summarized(self):
+        throttle = cmk_discord.Throttle()
+        self.assertEqual(self.check(throttle, self.ctx, now=1000)[0], "send")
+        self.assertEqual(self.check(throttle, self.renotify(2), now=1000 + 3 * 3600), ("summarize", 1000))
+
+    def test_changed_output_or_state_sent(self):
+        throttle = cmk_discord.Throttle(mode="suppress")
+        self.check(throttle, self.ctx, now=0)
+        self.assertEqual(self.check(throttle, self.renotify(2), now=60)[0], "suppress")
+        self.assertEqual(self.check(throttle, self.renotify(3, service_output="other"), now=120)[0], "send")
+        self.assertEqual(self.check(throttle, self.renotify(4, service_output="other", service_state="WARNING"),
+                                    now=180), ("send", 180))
+
+    def test_ignore_numbers(self):
+        throttle = cmk_discord.Throttle(ignore_numbers=True)
+        self.check(throttle, self.ctx, now=0)
+        self.assertEqual(self.check(throttle, self.renotify(2, service_output="CRIT - 99.1% used"), now=60)[0],
+                         "summarize")
+
+    def test_escalation(self):
+        throttle = cmk_discord.Throttle(escalate=[5], escalate_every=3600)
+        self.check(throttle, self.ctx, now=0)
+        self.assertEqual(self.check(throttle, self.renotify(2), now=60)[0], "summarize")
+        self.assertEqual(self.check(throttle, self.renotify(5), now=120)[0], "send")
+        self.assertEqual(self.check(throttle, self.renotify(6), now=180)[0], "summarize")
+        self.assertEqual(self.check(throttle, self.renotify(7), now=3720)[0], "send")
+
+    def test_recovery_resets(self):
+        throttle = cmk_discord.Throttle()
+        self.check(throttle, self.ctx, now=0)
+        self.check(throttle, replace(self.ctx, notification_type="RECOVERY", service_state="OK"), now=60)
+        self.assertEqual(self.check(throttle, self.renotify(2), now=120), ("send", 120))
+
+    def test_rules_do_not_interfere(self):
+        throttle = cmk_discord.Throttle()
+        self.check(throttle, self.ctx, now=0)
+        other = self.renotify(2, webhook_url="https://discord.com/api/webhooks/2/other")
+        self.assertEqual(self.check(throttle, other, now=60)[0], "send")
+        self.assertEqual(self.check(throttle, self.renotify(2), now=60)[0], "summarize")
+
+    def test_duration(self):
+        self.assertEqual([cmk_discord.Throttle.duration(s) for s in (2700, 5400, 3 * 3600 + 600, 2 * 86400 + 4 * 3600)],
+                         ["45m", "1h 30m", "3h", "2d 4h"])
+
+    def test_deliver(self):
+        config = {"throttle": {"mode": "summarize"}}
+        self.assertIn(self.ctx.service_output, self.notify(self.ctx, config)["description"])
+        embed = self.notify(self.renotify(2), config)
+        self.assertIn("Still CRITICAL for 0m (notification 2)", embed["description"])
+        self.assertNotIn(self.ctx.service_output, embed["description"])
+        self.assertIsNone(self.notify(self.renotify(3), {"throttle": {"mode": "suppress"}}))
+
+    def test_failed_send_is_not_remembered(self):
+        config = {"throttle": {"mode": "suppress"}}
+        with self.assertRaises(SystemExit):
+            self.notify(self.ctx, config, status_code=500)
+        embed = self.notify(self.renotify(2), config)
+        self.assertIn(self.ctx.service_output, embed["description"])
+        self.assertIsNone(self.notify(self.renotify(3), config))
+
+
+if __name__ == '__main__':
+    unittest.main()
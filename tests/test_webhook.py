@@ -34,6 +34,16 @@ class TestDiscordWebhookSend(unittest.TestCase):
         call_kwargs = mock_post.call_args[1]
         self.assertEqual(call_kwargs['url'], webhook_url)
         self.assertIn('json', call_kwargs)
+        self.assertEqual(call_kwargs['timeout'], 10.0)
+
+    @patch('requests.post')
+    def test_configured_timeout(self, mock_post):
+        mock_post.return_value = MagicMock(status_code=HTTPStatus.NO_CONTENT.value)
+        ctx = load_latest_test_data("service", "problem_critical.json")
+        self.addCleanup(setattr, cmk_discord.DiscordWebhook, "timeout", cmk_discord.DiscordWebhook.timeout)
+        cmk_discord.DiscordWebhook.configure(cmk_discord.Config({"timeout": 2.5}))
+        cmk_discord.DiscordWebhook(ctx.webhook_url, cmk_discord.Embed.from_context(ctx), ctx.omd_site).send()
+        self.assertEqual(mock_post.call_args[1]['timeout'], 2.5)
 
     @patch('requests.post')
     @patch('sys.stderr.write')